@@ -0,0 +1,363 @@
+#!/bin/python
+# -*- coding: utf-8 -*-
+# Mock iControl REST server for the sslo_o365_update.py REST backend ("backend": "rest")
+#
+# Purpose: serves the part of the iControl REST API the REST backend uses (sys version, application
+# service, URL categories, sys file/ltm external data groups, iFiles and transactions) from memory,
+# so the REST backend can be exercised without a BIG-IP.
+#
+# Usage:
+#   python o365_rest_mock.py --selftest                     -> run the REST backend checks (transaction,
+#                                                              translation, chunked URL categories, inventory,
+#                                                              replay, tmsh fallback) against a mock on a free port
+#   python o365_rest_mock.py --port 8199                    -> serve on 127.0.0.1:8199 until interrupted
+#   python o365_rest_mock.py --port 8199 --fail_transactions -> reject every transaction (commands are replayed)
+#
+# Point the script at a served mock with the system settings "backend": "rest" and
+# "rest_url": "http://localhost:8199". Every request is printed with its status.
+#
+# Not a BIG-IP: objects are only checked for existence (create/modify/delete), and ltm external data
+# groups for the sys file data group they link to. Data group checksums are computed from the local
+# source-path file ("SHA1:<size>:<sha1>"), as BIG-IP reports them.
+
+import os, sys, json, copy, hashlib, threading, argparse, socket, shutil, tempfile
+
+if sys.version_info[0] < 3:
+    import BaseHTTPServer as httpserver
+    import SocketServer as socketserver
+    from urllib import unquote
+else:
+    import http.server as httpserver
+    import socketserver
+    from urllib.parse import unquote
+
+## REST collections served (the same modules as rest_modules in sslo_o365_update.py)
+mock_collections = [
+    "/mgmt/tm/sys/application/service",
+    "/mgmt/tm/sys/url-db/url-category",
+    "/mgmt/tm/sys/file/data-group",
+    "/mgmt/tm/ltm/data-group/external",
+    "/mgmt/tm/sys/file/ifile"
+]
+
+
+##-----------------------------------------------------------------------
+## Mock REST state
+##  Purpose: in-memory objects ({collection: {"~Common~folder~name": object}}) and open transactions
+##  ({transaction id: [(method, collection, key, body)]})
+##-----------------------------------------------------------------------
+class mockRestState:
+
+    def __init__(self):
+        self.objects = dict([(x, {}) for x in mock_collections])
+        self.transactions = {}
+        self.next_transaction = 1
+        self.fail_transactions = False
+        self.lock = threading.Lock()
+
+
+    ##-----------------------------------------------------------------------
+    ## Apply function
+    ##  Purpose: apply one create/modify/delete to a set of objects
+    ##  Parameters:
+    ##      objects         = {collection: {key: object}} to change
+    ##      method          = POST, PATCH or DELETE
+    ##      collection      = REST collection URI
+    ##      key             = object key ("~Common~o365_update.app~name"), None for POST
+    ##      body            = request body (dictionary)
+    ##  Returns: (status code, response dictionary)
+    ##-----------------------------------------------------------------------
+    def apply(self, objects, method, collection, key, body):
+        items = objects[collection]
+        if method == "POST":
+            body = dict(body)
+            if collection == "/mgmt/tm/sys/application/service" and "subPath" not in body:
+                ## Application services live in their own folder (o365_update -> o365_update.app)
+                body["subPath"] = body["name"] + ".app"
+            key = "~" + body.get("partition", "Common") + ("~" + body["subPath"] if "subPath" in body else "") + "~" + body["name"]
+            if key in items:
+                return 409, {"code": 409, "message": "The requested object (" + key.replace("~", "/") + ") already exists."}
+            item = {"name": body["name"], "partition": body.get("partition", "Common"), "fullPath": key.replace("~", "/")}
+            if "subPath" in body:
+                item["subPath"] = body["subPath"]
+        elif key not in items:
+            return 404, {"code": 404, "message": "Object not found - " + key.replace("~", "/")}
+        elif method == "DELETE":
+            del items[key]
+            return 200, {}
+        else:
+            item = dict(items[key])
+
+        for name, value in body.items():
+            if name not in ("name", "partition", "subPath"):
+                item[name] = value
+
+        if collection == "/mgmt/tm/ltm/data-group/external" and "externalFileName" in item:
+            if item["externalFileName"].replace("/", "~") not in objects["/mgmt/tm/sys/file/data-group"]:
+                return 400, {"code": 400, "message": "External file " + item["externalFileName"] + " does not exist."}
+        if collection == "/mgmt/tm/sys/file/data-group" and "sourcePath" in body:
+            try:
+                f = open(body["sourcePath"].replace("file:", "", 1), "rb")
+                content = f.read()
+                f.close()
+            except (IOError, OSError):
+                return 400, {"code": 400, "message": "Unable to read " + body["sourcePath"]}
+            item["checksum"] = "SHA1:" + str(len(content)) + ":" + hashlib.sha1(content).hexdigest()
+
+        items[key] = item
+        return 200, item
+
+
+    ##-----------------------------------------------------------------------
+    ## Commit function
+    ##  Purpose: apply the requests of a transaction, all or nothing
+    ##  Parameters:
+    ##      transaction     = transaction id
+    ##  Returns: (status code, response dictionary)
+    ##-----------------------------------------------------------------------
+    def commit(self, transaction):
+        requests = self.transactions.pop(transaction, None)
+        if requests is None:
+            return 404, {"code": 404, "message": "Transaction " + str(transaction) + " not found."}
+        if self.fail_transactions:
+            return 400, {"code": 400, "message": "Transaction failed (mock --fail_transactions)."}
+
+        objects = copy.deepcopy(self.objects)
+        for method, collection, key, body in requests:
+            status, response = self.apply(objects, method, collection, key, body)
+            if status >= 300:
+                return 400, {"code": 400, "message": "Transaction failed: " + response["message"]}
+        self.objects = objects
+        return 200, {"transId": transaction, "state": "COMPLETED"}
+
+
+
+##-----------------------------------------------------------------------
+## Mock REST handler
+##  Purpose: HTTP/1.1 (keep-alive) request handler for mockRestState
+##-----------------------------------------------------------------------
+class mockRestHandler(httpserver.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PATCH(self):
+        self.dispatch("PATCH")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+
+    ##-----------------------------------------------------------------------
+    ## Dispatch function
+    ##  Purpose: route a request to the version, transaction or object handling and send the response
+    ##  Parameters:
+    ##      method          = HTTP method
+    ##-----------------------------------------------------------------------
+    def dispatch(self, method):
+        state = self.server.state
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length).decode("utf-8")) if length else {}
+        path = self.path.split("?")[0]
+        transaction = self.headers.get("X-F5-REST-Coordination-Id")
+
+        with state.lock:
+            status, response = 404, {"code": 404, "message": "Unsupported URI " + path}
+            if path == "/mgmt/tm/sys/version" and method == "GET":
+                status, response = 200, {"kind": "tm:sys:version:versionstats", "entries": {}}
+
+            elif path == "/mgmt/tm/transaction" and method == "POST":
+                transaction = state.next_transaction
+                state.next_transaction += 1
+                state.transactions[transaction] = []
+                status, response = 200, {"transId": transaction, "state": "STARTED"}
+
+            elif path.startswith("/mgmt/tm/transaction/") and method == "PATCH":
+                status, response = state.commit(int(path.split("/")[-1]))
+
+            else:
+                for collection in mock_collections:
+                    if path == collection or path.startswith(collection + "/"):
+                        key = unquote(path[len(collection) + 1:]) or None
+                        if method == "GET" and key is None:
+                            status, response = 200, {"items": list(state.objects[collection].values())}
+                        elif method == "GET":
+                            if key in state.objects[collection]:
+                                status, response = 200, state.objects[collection][key]
+                            else:
+                                status, response = 404, {"code": 404, "message": "Object not found - " + key.replace("~", "/")}
+                        elif transaction is not None:
+                            if int(transaction) not in state.transactions:
+                                status, response = 404, {"code": 404, "message": "Transaction " + transaction + " not found."}
+                            else:
+                                state.transactions[int(transaction)].append((method, collection, key, body))
+                                status, response = 200, {"transId": int(transaction), "evalOrder": len(state.transactions[int(transaction)])}
+                        else:
+                            status, response = state.apply(state.objects, method, collection, key, body)
+                        break
+
+        content = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            sys.stdout.write("%s %s\n" % (self.log_date_time_string(), format % args))
+            sys.stdout.flush()
+
+
+
+class mockRestServer(socketserver.ThreadingMixIn, httpserver.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+##-----------------------------------------------------------------------
+## Start function
+##  Purpose: start a mock REST server in a background thread
+##  Parameters:
+##      port            = TCP port on 127.0.0.1 (0 for a free port)
+##      quiet           = don't print the requests
+##  Returns: server (server.state is the mockRestState, server.server_address[1] the port)
+##-----------------------------------------------------------------------
+def start(port, quiet=False):
+    server = mockRestServer(("127.0.0.1", port), mockRestHandler)
+    server.state = mockRestState()
+    server.quiet = quiet
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+##-----------------------------------------------------------------------
+## Selftest function
+##  Purpose: run restExecutor from sslo_o365_update.py (next to this file) against a mock on a free port
+##  Returns: 0 if every check passed, 1 otherwise
+##-----------------------------------------------------------------------
+def selftest():
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import sslo_o365_update as o365
+
+    server = start(0, True)
+    state = server.state
+    work_directory = tempfile.mkdtemp()
+    checks = []
+
+    def check(name, ok):
+        sys.stdout.write(("PASS  " if ok else "FAIL  ") + name + "\n")
+        checks.append(ok)
+
+    def category_urls():
+        category = state.objects["/mgmt/tm/sys/url-db/url-category"].get("~Common~o365_update.app~" + o365.o365_category.replace("\\", ""), {})
+        return dict([(x["name"], x["type"]) for x in category.get("urls", [])])
+
+    try:
+        manager = o365.o365UrlManagement()
+        manager.work_directory = work_directory
+        manager.log_level = 0
+        manager.backend = "rest"
+        manager.rest_url = "http://127.0.0.1:" + str(server.server_address[1])
+        manager.url_chunk_size = 2
+
+        ## Availability - the REST backend is selected when the API answers
+        executor = manager.create_executor()
+        manager.executor = executor
+        check("available: REST executor selected", isinstance(executor, o365.restExecutor))
+
+        ## Transaction and translation - create every object type, the URL category in 3 chunks
+        source = work_directory + "/" + o365.o365_dg_ipv4
+        f = open(source, "w")
+        f.write("network 10.0.0.0/8,\n")
+        f.close()
+        entries = dict([("https://host%d.example.com/" % i, "exact-match") for i in range(5)])
+        entries["https://*.example.net/"] = "glob-match"
+        executor.add("create sys application service o365_update traffic-group traffic-group-local-only device-group none")
+        executor.add("create /sys file data-group o365_update.app/" + o365.o365_dg_ipv4 + " source-path file:" + source + " type ip")
+        executor.add("create /ltm data-group external o365_update.app/" + o365.o365_dg_ipv4 + " external-file-name o365_update.app/" + o365.o365_dg_ipv4)
+        manager.url_category_commands(o365.o365_category, entries, sorted(entries), [], create=True)
+        commands = len(executor.commands)
+        results = executor.submit()
+        check("transaction: " + str(commands) + " commands applied in one transaction", len(results) == commands and all([x["ok"] and "seconds" not in x for x in results]))
+        check("translation: chunked URL category created with all entries", category_urls() == entries)
+        content = open(source, "rb").read()
+        check("translation: data group loaded (checksum)", executor.read_property("sys file data-group o365_update.app/" + o365.o365_dg_ipv4, "checksum") == "SHA1:" + str(len(content)) + ":" + hashlib.sha1(content).hexdigest())
+
+        ## Inventory
+        check("inventory: objects and data group link listed", executor.load_inventory() and executor.exists("sys url-db url-category o365_update.app/" + o365.o365_category) and executor.exists("sys application service o365_update.app/o365_update") and executor.external_file_name(o365.o365_dg_ipv4) == "o365_update.app/" + o365.o365_dg_ipv4)
+
+        ## Chunked add/delete merged with the live entries (REST replaces the whole urls list)
+        latest = dict(entries)
+        for url in sorted(entries)[:2]:
+            del latest[url]
+        for i in range(5, 8):
+            latest["https://host%d.example.com/" % i] = "exact-match"
+        manager.url_category_commands(o365.o365_category, latest, sorted([x for x in latest if x not in entries]), sorted([x for x in entries if x not in latest]))
+        results = executor.submit()
+        check("translation: chunked add/delete merged with the live entries", all([x["ok"] for x in results]) and category_urls() == latest)
+
+        ## Replay - a failed transaction is replayed one command at a time, with per-command results
+        state.fail_transactions = True
+        executor.add("modify /sys file data-group o365_update.app/" + o365.o365_dg_ipv4 + " source-path file:" + source)
+        executor.add("modify /sys file data-group o365_update.app/Missing source-path file:" + source)
+        results = executor.submit()
+        check("replay: per-command results after a failed transaction", [x["ok"] for x in results] == [True, False] and all(["seconds" in x for x in results]))
+        executor.add("delete sys file data-group o365_update.app/" + o365.o365_dg_ipv4)
+        results = executor.submit(True, False)
+        check("replay: no replay when disabled (staged switch, rollback)", [x["ok"] for x in results] == [False] and "~Common~o365_update.app~" + o365.o365_dg_ipv4 in state.objects["/mgmt/tm/sys/file/data-group"])
+        state.fail_transactions = False
+
+        ## Fallback - tmsh when the API doesn't answer
+        closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        closed.bind(("127.0.0.1", 0))
+        port = closed.getsockname()[1]
+        closed.close()
+        fallback = o365.o365UrlManagement()
+        fallback.work_directory = work_directory
+        fallback.log_level = 0
+        fallback.backend = "rest"
+        fallback.rest_url = "http://127.0.0.1:" + str(port)
+        check("fallback: tmsh executor when REST is not available", not isinstance(fallback.create_executor(), o365.restExecutor))
+
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    sys.stdout.write(str(checks.count(True)) + " of " + str(len(checks)) + " checks passed.\n")
+    return 0 if all(checks) else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Mock iControl REST server for the sslo_o365_update.py REST backend.")
+    parser.add_argument("--port", type = int, default = 8199, help = "TCP port on 127.0.0.1 (default 8199).")
+    parser.add_argument("--fail_transactions", action = 'store_true', help = "Reject every transaction, so commands are replayed one at a time.")
+    parser.add_argument("--selftest", action = 'store_true', help = "Run the REST backend checks against a mock on a free port and exit.")
+    args = parser.parse_args()
+
+    if args.selftest:
+        sys.exit(selftest())
+
+    server = start(args.port)
+    server.state.fail_transactions = args.fail_transactions
+    sys.stdout.write("Mock iControl REST server on http://127.0.0.1:" + str(args.port) + " (fail transactions: " + str(args.fail_transactions) + "). Ctrl-C to stop.\n")
+    sys.stdout.flush()
+    try:
+        while True:
+            threading.Event().wait(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -13,6 +13,33 @@ version = "7.3.0"
 # >>> NOTE: THIS VERSION OF THE OFFICE 365 SCRIPT IS SUPPORTED BY SSL ORCHESTRATOR 5.0 OR HIGHER <<<
 #
 # Updated for SSL Orchestrator by Kevin Stewart, SSA, F5 Networks
+# Update 20261017 - to support performance and operational enhancements
+#   - Updated to support incremental updates via the Microsoft "changes" web method (local record set in working directory)
+#   - Updated to support a compressed, versioned endpoints snapshot cache (config-only changes and failed fetches use the cache)
+#   - Updated to submit all BIG-IP object changes of a run through one tmsh session as a single cli transaction
+#   - Updated to apply only added/removed entries to existing URL categories (local manifest per category)
+#   - Updated to filter excluded_urls with a suffix trie built once per run
+#   - Updated to make excluded_ips CIDR-aware (prefix tree subtraction, requires the python ipaddress module)
+#   - Updated to aggregate IPv4/IPv6 data group prefixes into a minimal covering set before upload
+#   - Updated to classify endpoint records in a single pass (per URL/IP membership masks)
+#   - Updated to answer --search from a local search index written at update time (live tmsh lookup if stale)
+#   - Updated to support --searchfile bulk search (file or stdin, CSV or JSON output)
+#   - Updated to support IP address search of the IPv4/IPv6 data groups (longest prefix match)
+#   - Updated to write run status once per run (iFile only modified when the status changes, last_run time kept locally)
+#   - Updated to resolve and parse the configuration iFile once (cached pointer validated by the filestore mtime)
+#   - Updated to support --daemon mode (VERSION polling every poll_interval seconds, full update only on change)
+#   - Updated to run an update when the configuration changed since the last applied state (ex. service areas)
+#   - Updated to prepare the independent output objects concurrently (bounded worker pool, per-object results)
+#   - Updated to support an iControl REST backend (pooled keep-alive connections, REST transactions, tmsh fallback)
+#   - Updated to list all o365_update.app objects once per run (inventory) for the create/modify decisions
+#   - Updated to load URL category changes in chunks of url_chunk_size entries (per-chunk size and timing logged)
+#   - Updated to support a staged apply_mode (blue/green data group generations, verified, switched in one transaction) and --rollback
+#   - Updated to support --plan (dry run: planned operations, entry deltas per object, apply cost estimate calibrated by measured runs)
+#   - Updated to record per-phase and per-object timings and entry counts of every run (local run status and o365_update.prom)
+#   - Updated to support --profile [TOP] and --profile_memory (cProfile/tracemalloc profile and summary in the log directory)
+#   - Updated to write the log through one buffered handle per run, rotated by size/age (gzip, log_keep files), optionally as JSON lines
+#   - Updated to send event messages over one /dev/log socket (buffered per run) instead of running /usr/bin/logger per event
+#   - Updated to keep a run history (o365_history.jsonl: version, trigger, phase durations, per-object deltas) and support --history [N]
 # Update 20220613 - to enable hash-based change detection
 # Update 20220504 - to enable URL category search feature
 # Update 20220412 - to enable separate allow, optimize, default, and all URL include blocks
@@ -139,7 +166,7 @@ version = "7.3.0"
 #        "allow" : []
 #       }
 #
-#     Excluded IPs (IP must be exact match to IP as it exists in JSON record - IP/CIDR mask cannot be modified)
+#     Excluded IPs (IP/CIDR networks - any covered O365 prefix is removed, and larger O365 prefixes are split around the excluded network)
 #     Provide IPs in list format - ex. ["191.234.140.0/22", "2620:1ec:a92::152/128"]
 #     "excluded_ips": []
 #
@@ -149,6 +176,17 @@ version = "7.3.0"
 #         "working_directory":"/shared/o365"    -> Working directory for running configuration files
 #         "retry_attempts":3                    -> Number of times to try a network operation (URL update). Setting to 0 disables retry. Default is 3 attempts
 #         "retry_delay":300                     -> Number of seconds to wait between retries. Default is 300 seconds (5 minutes)
+#         "snapshot_retention":5                -> Number of endpoints snapshots (per instance/version) to keep in the working directory. Default is 5
+#         "poll_interval":300                   -> Used with --daemon. Number of seconds between VERSION checks. Default is 300 seconds (5 minutes)
+#         "backend":"tmsh"                      -> How BIG-IP objects are changed: 'tmsh' or 'rest' (local iControl REST, falls back to tmsh if unavailable). Default is tmsh
+#         "rest_url":"http://localhost:8100"    -> Used with backend 'rest'. Local iControl REST URL
+#         "url_chunk_size":5000                 -> Maximum number of URL category entries per tmsh command. Larger changes are split into chunks. Default is 5000
+#         "apply_mode":"direct"                 -> 'direct' or 'staged' (data groups are loaded into a shadow generation, verified, then switched with the URL categories in one transaction). Default is direct
+#         "log_max_size":10                     -> Size (MB) at which the log file is rotated (gzip compressed). Default is 10
+#         "log_max_age":30                      -> Age (days) at which the log file is rotated. Setting to 0 disables age rotation. Default is 30
+#         "log_keep":5                          -> Number of rotated (compressed) log files to keep. Default is 5
+#         "log_format":"text"                   -> 'text' or 'json' (one JSON object per line). Default is text
+#         "history_keep":500                    -> Number of runs to keep in the run history (o365_history.jsonl). Default is 500
 #
 #     "schedule":
 #         "periods":"monthly|weekly|daily|none" -> When to trigger updates ('monthly', 'weekly', 'daily', or 'none') -- default(none)
@@ -173,14 +211,28 @@ version = "7.3.0"
 # further testing or modification.
 #-----------------------------------------------------------------------
 
-import platform, fnmatch, uuid, os, pwd, re, json, time, datetime, sys, argparse, copy, ssl, hashlib
+import platform, fnmatch, uuid, os, pwd, re, json, time, datetime, sys, argparse, copy, ssl, hashlib, gzip, csv, threading, base64, cProfile, pstats, atexit, socket, tempfile
 
 if platform.python_version().startswith("2."):
     import commands as shell
     import urllib2 as urlrequest
+    import httplib as httpclient
 elif platform.python_version().startswith("3."):
     import subprocess as shell
     from urllib import request as urlrequest
+    from http import client as httpclient
+
+## ipaddress is standard on python3 (and an optional backport on python2) - without it excluded_ips falls back to "ends-with" matching
+try:
+    import ipaddress
+except ImportError:
+    ipaddress = None
+
+## tracemalloc (python3) is only used by --profile_memory
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
 
 #-----------------------------------------------------------------------
 # Default JSON configuration
@@ -233,7 +285,18 @@ json_config_data = {
         "ca_bundle": "ca-bundle.crt",
         "working_directory": "/shared/o365",
         "retry_attempts":3,
-        "retry_delay":300
+        "retry_delay":300,
+        "snapshot_retention":5,
+        "poll_interval":300,
+        "backend":"tmsh",
+        "rest_url":"http://localhost:8100",
+        "url_chunk_size":5000,
+        "apply_mode":"direct",
+        "log_max_size":10,
+        "log_max_age":30,
+        "log_keep":5,
+        "log_format":"text",
+        "history_keep":500
     },
     "schedule":{
         "periods":"none",
@@ -273,1042 +336,4109 @@ o365_dg_allow = "Office_365_Managed_Allow"
 o365_dg_ipv4 = "Office_365_Managed_IPv4"
 o365_dg_ipv6 = "Office_365_Managed_IPv6"
 
+## Record classification membership mask bits (see classify_records)
+mask_all = 0x001
+mask_optimize = 0x002
+mask_default = 0x004
+mask_allow = 0x008
+mask_required = 0x010
+mask_common = 0x020
+mask_exchange = 0x040
+mask_sharepoint = 0x080
+mask_skype = 0x100
+category_masks = {"Optimize": mask_optimize, "Default": mask_default, "Allow": mask_allow}
+
+## Maximum number of output objects (URL categories, data groups) prepared concurrently
+max_workers = 4
+
+## iControl REST backend - local (on-box) user, request timeout (seconds), and tmsh module paths to REST collections
+rest_user = "admin:"
+rest_timeout = 60
+rest_modules = {
+    "sys application service": "/mgmt/tm/sys/application/service",
+    "sys url-db url-category": "/mgmt/tm/sys/url-db/url-category",
+    "sys file data-group": "/mgmt/tm/sys/file/data-group",
+    "ltm data-group external": "/mgmt/tm/ltm/data-group/external",
+    "sys file ifile": "/mgmt/tm/sys/file/ifile"
+}
+
+## Configuration iFile filestore and cached pointer to its latest revision (see configLoader)
+ifile_directory = "/config/filestore/files_d/Common_d/ifile_d/"
+config_pointer_file = "/var/tmp/o365_config_path.json"
+
+## Data group filestore (read by --plan for the entries currently loaded)
+datagroup_directory = "/config/filestore/files_d/Common_d/data_group_d/"
+
+## --plan apply cost model (seconds per submit, per command, per loaded entry), scaled by the measured cost of previous runs
+plan_cost_submit = 2.0
+plan_cost_command = 0.5
+plan_cost_entry = 0.002
+
 ## Microsoft Web Service URLs
 url_ms_o365_endpoints = "endpoints.office.com"
 url_ms_o365_version = "endpoints.office.com"
 uri_ms_o365_version = "/version?ClientRequestId="
 
 
-class o365UrlManagement:
+##-----------------------------------------------------------------------
+## Config loader
+##  Purpose: resolves the active configuration iFile revision and parses it once per process. The
+##  resolved path is cached in a small pointer file, validated by the mtime of the iFile filestore
+##  directory (a new iFile revision adds a file to it), so most runs skip the directory scan and the
+##  stat of every revision.
+##  Example:
+##      loader = configLoader()
+##      o365_config, config_data = loader.load()
+##-----------------------------------------------------------------------
+class configLoader:
 
-    ## Init function (set local variables)
-    def __init__(self):
-        self.customer_endpoint = ""
-        self.service_areas_common = ""
-        self.service_areas_exchange = ""
-        self.service_areas_sharepoint = ""
-        self.service_areas_skype = ""
-        self.output_url_categories = ""
-        self.output_url_datagroups = ""
-        self.output_ip_datagroups = ""
-        self.o365_categories_all = ""
-        self.o365_categories_optimize = ""
-        self.o365_categories_default = ""
-        self.o365_categories_allow = ""
-        self.only_required = ""
-        self.excluded_urls = ""
-        self.included_urls_allow = ""
-        self.included_urls_optimized = ""
-        self.included_urls_default = ""
-        self.included_urls_all = ""
-        self.excluded_ips = ""
-        self.log_level = ""
-        self.ca_bundle = ""
-        self.work_directory = ""
-        self.json_config = ""
-        self.json_config_file = ""
-        self.force_update = False
-        self.config_data = ""
-        self.logdir = ""
-        self.retry_attempts = 0
-        self.retry_delay = 0
+    def __init__(self, pointer_file=config_pointer_file):
+        self.pointer_file = pointer_file
+        self.path = ""
+        self.mtime = None
+        self.config_data = None
 
 
     ##-----------------------------------------------------------------------
-    ## Logging function
-    ##  Purpose: sends a message to the log file
-    ##  Parameters:
-    ##      lev         = level of this meesage
-    ##      log_lev     = system configured log level (for comparison)
-    ##      log_dir     = location of log file
-    ##      msg         = log message
-    ##  Example:
-    ##      self.log(2, self.log_level, self.logdir, "Application service not found. Creating o365_update.app/o365_update")
+    ## Resolve function
+    ##  Purpose: return the path of the latest configuration iFile revision ("" if there is none)
+    ##  Parameters: none
     ##-----------------------------------------------------------------------
-    def log(self, lev, log_lev, log_dir, msg):
-        ## Create the log directory if it's doesn't exist
-        if not os.path.isdir(log_dir):
-                os.mkdir(log_dir)
+    def resolve(self):
+        mtime = os.stat(ifile_directory).st_mtime
+        if self.path != "" and self.mtime == mtime:
+            return self.path
 
-        ## Create the log file if it doesn't exist
-        if not os.path.exists(log_dir + "/o365_update"):
-            f = open(log_dir + "/o365_update", "w")
-            f.write("\n")
-            f.flush()
+        ## Cached pointer from a previous run
+        try:
+            f = open(self.pointer_file, "r")
+            pointer = json.loads(f.read())
             f.close()
+            if pointer["mtime"] == mtime and self.valid(pointer["path"]) and os.path.isfile(pointer["path"]):
+                ## Another run resolved a new revision - the parsed configuration is stale
+                if pointer["path"] != self.path or mtime != self.mtime:
+                    self.config_data = None
+                self.path = pointer["path"]
+                self.mtime = mtime
+                return self.path
+        except:
+            pass
 
-        if int(log_lev) >= int(lev):
-            log_string = "{0:%Y-%m-%d %H:%M:%S}".format(datetime.datetime.now()) + " " + msg + "\n"
-            f = open(log_dir + "/o365_update", "a")
-            f.write(log_string)
-            f.flush()
+        ## Find all versions of the configuration iFile
+        entry_array = []
+        for entry in os.listdir(ifile_directory):
+            if fnmatch.fnmatch(entry, "*o365_config.json*"):
+                entry_array.append(ifile_directory + entry)
+
+        if not entry_array:
+            return ""
+
+        ## Find the latest version of the configuration iFile
+        self.path = max(entry_array, key=os.path.getctime)
+        self.mtime = mtime
+        self.config_data = None
+        try:
+            f = open(self.pointer_file + ".tmp", "w")
+            f.write(json.dumps({"path": self.path, "mtime": mtime}))
             f.close()
-        return
+            os.rename(self.pointer_file + ".tmp", self.pointer_file)
+        except:
+            pass
+
+        return self.path
+
 
     ##-----------------------------------------------------------------------
-    ## Event logging function
-    ##  Purpose: sends a message using /usr/bin/logger to /var/log/apm for tracking events
+    ## Valid function
+    ##  Purpose: return True if a cached path names a configuration iFile revision
     ##  Parameters:
-    ##      lev         = level of this meesage
-    ##      msg         = log message
-    ##  Example:
-    ##      self.event_log(2, "VERSION request to MS web service was successful.")
+    ##      path            = cached path
     ##-----------------------------------------------------------------------
-    def event_log(self, lev, msg):
-        ## For event logs 1 -> error, 2 -> notice
-        level = "error" if lev == 1 else "notice"
-
-        ## local1 logs to /var/log/apm, and the SSLO product subset is C4.
-        ## Use 1000 for log msg id to not collide with log messages on BIGIP
-        log_cmd = "/usr/bin/logger -p local1." + level + " \"01c41000: " + msg + "\""
-        result = shell.getoutput(log_cmd)
+    def valid(self, path):
+        return path.startswith(ifile_directory) and "/" not in path[len(ifile_directory):] and fnmatch.fnmatch(os.path.basename(path), "*o365_config.json*")
 
 
     ##-----------------------------------------------------------------------
-    ## Show help function
-    ##  Purpose: shows the help syntax
+    ## Load function
+    ##  Purpose: return (path, parsed configuration) of the latest configuration iFile revision, parsed
+    ##  once per revision. Returns ("", None) if there is no configuration iFile.
     ##  Parameters: none
     ##-----------------------------------------------------------------------
-    def show_help(self):
-        print("Office 365 URL Management Script. Version: " + version)
-        print("\nCommand line options for this application are:\n")
-        print("--help                       -> Show this help message and exit.")
-        print("--install                    -> Install the script.")
-        print("--uninstall                  -> Uninstall the script.")
-        print("--full_uninstall             -> Uninstall the script. Remove everything.")
-        print("--force                      -> Force an update.\n")
-        print("--config CONFIG              -> Used with --install. Provide alternate JSON configuration information from a serialized JSON string object.")
-        print("--config_file CONFIG_FILE    -> Used with --install. Provide alternate JSON configuration information from a JSON file.\n")
-        print("--printconfig                -> Show the running configuration.\n")
-        print("--search                     -> Search the Office365 URL categories.\n")
+    def load(self):
+        path = self.resolve()
+        if path == "":
+            return "", None
 
-        print("Examples:")
-        print("Install with default configuration           ->  python " + os.path.basename(__file__) + " --install")
-        print("Install with serialized JSON configuration   ->  python " + os.path.basename(__file__) + " --install --config ${json_string}")
-        print("Install with JSON file:                      ->  python " + os.path.basename(__file__) + " --install --configfile file.json")
-        print("Install and force immediate URL update       ->  python " + os.path.basename(__file__) + " --install --force")
-        print("Force an update                              ->  python " + os.path.basename(__file__) + " --force")
-        print("Uninstall but keep categories/datagroups     ->  python " + os.path.basename(__file__) + " --uninstall")
-        print("Uninstall and remove categories/datagroups   ->  python " + os.path.basename(__file__) + " --full_uninstall")
-        print("Search for a URL in the Office365 categories ->  python " + os.path.basename(__file__) + " --search https://smtp.office365.com\n\n")
-        sys.exit(0)
+        if self.config_data is None:
+            f = open(path, "r")
+            f_content = f.read()
+            f.close()
+            self.config_data = json.loads(f_content)
+
+        return path, self.config_data
 
 
     ##-----------------------------------------------------------------------
-    ## Get config function
-    ##  Purpose: reads the JSON/iFile configuration into (self) local variables
+    ## Invalidate function
+    ##  Purpose: forget the resolved path and parsed configuration (ex. after modifying the iFile)
     ##  Parameters: none
     ##-----------------------------------------------------------------------
-    def get_config(self):
+    def invalidate(self):
+        self.path = ""
+        self.mtime = None
+        self.config_data = None
         try:
-            ## Find all versions of the configuration iFile
-            o365_config = ""
-            entry_array = []
-            fileList = os.listdir('/config/filestore/files_d/Common_d/ifile_d/')
-            pattern = "*o365_config.json*"
-            for entry in fileList:
-                if fnmatch.fnmatch(entry, pattern):
-                    entry_array.append("/config/filestore/files_d/Common_d/ifile_d/" + entry)
-
-            ## Find the latest version of the configuration iFile
-            if entry_array:
-                o365_config = max(entry_array, key=os.path.getctime)
-
-            if o365_config == "":
-                sys.stderr.write("\nIt appears that O365 URL Updater configuration has not been saved yet. Aborting (1000).\n\n[help-info] To install this script, issue the command \"" + os.path.basename(__file__) + " --install\"\n")
-                self.show_help()
+            os.remove(self.pointer_file)
+        except:
+            pass
 
-            try:
-                f = open(o365_config, "r")
-                f_content = f.read()
-                f.close()
-                self.config_data = json.loads(f_content)
 
-                ## Read configuration parameters from the json config
-                self.customer_endpoint           = self.config_data["endpoint"]
-                self.service_area_common         = self.config_data["service_areas"]["common"]
-                self.service_area_exchange       = self.config_data["service_areas"]["exchange"]
-                self.service_area_sharepoint     = self.config_data["service_areas"]["sharepoint"]
-                self.service_area_skype          = self.config_data["service_areas"]["skype"]
-                self.output_url_categories       = self.config_data["outputs"]["url_categories"]
-                self.output_url_datagroups       = self.config_data["outputs"]["url_datagroups"]
-                self.output_ip_datagroups        = self.config_data["outputs"]["ip_datagroups"]
-                self.o365_categories_all         = self.config_data["o365_categories"]["all"]
-                self.o365_categories_optimize    = self.config_data["o365_categories"]["optimize"]
-                self.o365_categories_default     = self.config_data["o365_categories"]["default"]
-                self.o365_categories_allow       = self.config_data["o365_categories"]["allow"]
-                self.only_required               = self.config_data["only_required"]
-                self.excluded_urls               = self.config_data["excluded_urls"]
-                self.included_urls_allow         = self.config_data["included_urls"]["allow"]
-                self.included_urls_optimized     = self.config_data["included_urls"]["optimized"]
-                self.included_urls_default       = self.config_data["included_urls"]["default"]
-                self.included_urls_all           = self.config_data["included_urls"]["all"]
-                self.excluded_ips                = self.config_data["excluded_ips"]
-                self.log_level                   = self.config_data["system"]["log_level"]
-                self.ca_bundle                   = self.config_data["system"]["ca_bundle"]
-                self.work_directory              = self.config_data["system"]["working_directory"]
-                self.logdir                      = self.config_data["system"]["working_directory"] + "/log"
-                self.retry_attempts              = self.config_data["system"]["retry_attempts"]
-                self.retry_delay                 = self.config_data["system"]["retry_delay"]
-                self.schedule_periods            = self.config_data["schedule"]["periods"]
-                self.schedule_run_date           = self.config_data["schedule"]["run_date"]
-                self.schedule_run_time           = self.config_data["schedule"]["run_time"]
-                self.schedule_start_date         = self.config_data["schedule"]["start_date"]
-                self.schedule_start_time         = self.config_data["schedule"]["start_time"]
-                self.status                      = self.config_data["status"]
 
-            except:
-                sys.stderr.write("\nERROR: It appears the JSON configuration file is either missing or corrupt. Aborting (1001).\n[help-info] Run the script again with the --install option to repair\n.")
-                self.show_help()
+##-----------------------------------------------------------------------
+## Run logger
+##  Purpose: writes the log file through one buffered handle per process instead of opening, writing
+##  and closing it for every message. The file is rotated (gzip compressed, log_keep files kept) when
+##  it reaches log_max_size MB or log_max_age days, and can be written as JSON lines.
+##  Example:
+##      logger = runLogger()
+##      logger.configure(10, 30, 5, "text")
+##      logger.write("/shared/o365/log", 1, "Completed O365 URL/IP address update process")
+##-----------------------------------------------------------------------
+class runLogger:
 
-        except:
-            sys.stderr.write("\nERROR: It appears that O365 URL Updater configuration has not been saved yet. Aborting (1002).\n\n[help-info] To install this script, issue the command \"" + os.path.basename(__file__) + " --install\"\n")
-            self.show_help()
+    def __init__(self):
+        self.handle = None
+        self.path = ""
+        self.size = 0
+        ## time.time() of the first message of the current log file (see expired)
+        self.started = 0
+        self.max_size = 10 * 1048576
+        self.max_age = 30
+        self.keep = 5
+        self.format = "text"
+        ## Messages are written from the output worker threads
+        self.lock = threading.Lock()
 
 
     ##-----------------------------------------------------------------------
-    ## Show running configuration function
-    ##  Purpose: prints the running configuration to stdout
-    ##  Parmeters: none
+    ## Configure function
+    ##  Purpose: set the rotation and format settings (system configuration)
+    ##  Parameters:
+    ##      max_size        = rotation size in MB
+    ##      max_age         = rotation age in days (0 = no age rotation)
+    ##      keep            = number of rotated files to keep
+    ##      log_format      = "text" or "json"
     ##-----------------------------------------------------------------------
-    def print_config(self):
-        self.get_config()
-        this_json = json.dumps(self.config_data, indent = 4)
-        print(this_json)
-        sys.exit(1)
+    def configure(self, max_size, max_age, keep, log_format):
+        self.max_size = max_size * 1048576
+        self.max_age = max_age
+        self.keep = keep
+        self.format = log_format
+
 
-    
     ##-----------------------------------------------------------------------
-    ## Search function
-    ##  Purpose: search for a URL in the Office365 categories
-    ##  Parmeters: URL (ex. https://smtp.office365.com)
+    ## Write function
+    ##  Purpose: write one message to the log file of a log directory (buffered)
+    ##  Parameters:
+    ##      log_dir         = log directory
+    ##      lev             = level of the message
+    ##      msg             = log message
     ##-----------------------------------------------------------------------
-    def search(self, url):
-        CAT_ALL = "o365_update.app/Office_365_All(Managed)"
-        CAT_ALLOW = "o365_update.app/Office_365_Allow(Managed)" 
-        CAT_OPT = "o365_update.app/Office_365_Optimized(Managed)"
-        CAT_DEF = "o365_update.app/Office_365_Default(Managed)"
+    def write(self, log_dir, lev, msg):
+        with self.lock:
+            if self.handle is None or self.path != log_dir + "/o365_update":
+                self.open(log_dir)
+            elif self.expired():
+                self.rotate()
 
-        if not ((url.startswith("https://")) or (url.startswith("http://"))):
-            print("\nURL argument format must include protocol")
-            print("Example: python o365_lookup.py https://smtp.office365.com\n")
-            sys.exit(0)
+            present = datetime.datetime.now()
+            if self.format == "json":
+                log_string = json.dumps({"time": present.strftime("%Y-%m-%dT%H:%M:%S"), "level": lev, "pid": os.getpid(), "message": msg}) + "\n"
+            else:
+                log_string = "{0:%Y-%m-%d %H:%M:%S}".format(present) + " " + msg + "\n"
+            self.handle.write(log_string)
+            self.size += len(log_string)
 
-        found_list = []
-
-        ## ALL Search
-        result = shell.getoutput("tmsh -a list sys url-db url-category \"" + CAT_ALL + "\" urls | grep -E '\s+http.*' | sed -e 's/ //g;s/{//g;s/\\\//g'")
-        for x in result.splitlines():
-            pattern = x.rstrip("/")
-            match = fnmatch.fnmatch(url, pattern)
-            if (match):
-                found_list.append("Office_365_All(Managed):\t" + pattern)
-
-        ## ALLOW Search
-        result = shell.getoutput("tmsh -a list sys url-db url-category \"" + CAT_ALLOW + "\" urls | grep -E '\s+http.*' | sed -e 's/ //g;s/{//g;s/\\\//g'")
-        for x in result.splitlines():
-            pattern = x.rstrip("/")
-            match = fnmatch.fnmatch(url, pattern)
-            if (match):
-                found_list.append("Office_365_Allow(Managed):\t" + pattern)
-
-        ## OPT Search
-        result = shell.getoutput("tmsh -a list sys url-db url-category \"" + CAT_OPT + "\" urls | grep -E '\s+http.*' | sed -e 's/ //g;s/{//g;s/\\\//g'")
-        for x in result.splitlines():
-            pattern = x.rstrip("/")
-            match = fnmatch.fnmatch(url, pattern)
-            if (match):
-                found_list.append("Office_365_Optimized(Managed):\t" + pattern)
-
-        ## DEF Search
-        result = shell.getoutput("tmsh -a list sys url-db url-category \"" + CAT_DEF + "\" urls | grep -E '\s+http.*' | sed -e 's/ //g;s/{//g;s/\\\//g'")
-        for x in result.splitlines():
-            pattern = x.rstrip("/")
-            match = fnmatch.fnmatch(url, pattern)
-            if (match):
-                found_list.append("Office_365_Default(Managed):\t" + pattern)
-        
-        if (len(found_list) > 0):
-            print("\nThe following URL matches were discovered:\n") 
-            for found_url in found_list:
-                print(found_url)
-                
-            print("\n\n")
+            if self.size >= self.max_size:
+                self.rotate()
 
+
+    ##-----------------------------------------------------------------------
+    ## Open function
+    ##  Purpose: open the log file of a log directory for appending, rotating it first if it is too
+    ##  large or too old (the age is read from its first timestamp)
+    ##  Parameters:
+    ##      log_dir         = log directory
+    ##-----------------------------------------------------------------------
+    def open(self, log_dir):
+        self.close()
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        self.path = log_dir + "/o365_update"
+
+        if os.path.isfile(self.path):
+            self.size = os.path.getsize(self.path)
+            self.started = time.time() - self.age()
+            if self.size >= self.max_size or self.expired():
+                self.rotate()
+                return
         else:
-            print("\nNo URL matches were found\n")
+            self.size = 0
+            self.started = time.time()
 
-        sys.exit(1)
+        self.handle = open(self.path, "a")
 
 
     ##-----------------------------------------------------------------------
-    ## URL parser function
-    ##  Purpose: clean up an return URLs submitted in JSON config
-    ##      - no http://
-    ##      - no https://
-    ##      - no trailing /
-    ##      - no wildcards (*)
-    ##      - remove resulting duplicates
-    ##  Prameters: URL list
+    ## Expired function
+    ##  Purpose: return True if the current log file is older than max_age. Checked on every write and
+    ##  flush, so a long running process (--daemon) also rotates by age.
+    ##  Parameters: none
     ##-----------------------------------------------------------------------
-    def url_parser(self, urllist):
-        urlscleaned = []
-        for url in urllist:
-            ## convert all to lowercase
-            this_url = url.lower()
+    def expired(self):
+        return self.max_age > 0 and self.size > 0 and time.time() - self.started > self.max_age * 86400
 
-            ## test for http://www.foo.com => convert to www.foo.com
-            if this_url.startswith("http://"):
-                this_url = this_url.replace("http://","")
 
-            ## test for https://www.foo.com => convert to www.foo.com
-            if this_url.startswith("https://"):
-                this_url = this_url.replace("https://","")
+    ##-----------------------------------------------------------------------
+    ## Age function
+    ##  Purpose: return the age (seconds) of the current log file from its first timestamp, or 0
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def age(self):
+        try:
+            f = open(self.path, "r")
+            for line in f:
+                ## JSON lines are parsed - python2 doesn't keep the key order, so "time" isn't always first
+                if line.startswith("{"):
+                    line = json.loads(line)["time"]
+                match = re.match(r'^(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})', line)
+                if match:
+                    f.close()
+                    first = datetime.datetime.strptime(match.group(1) + " " + match.group(2), "%Y-%m-%d %H:%M:%S")
+                    return (datetime.datetime.now() - first).total_seconds()
+                if line.strip() != "":
+                    break
+            f.close()
+        except:
+            pass
+        return 0
 
-            ## test for and remove trailing /
-            if this_url.endswith("/"):
-                this_url = this_url[:-1]
 
-            ## remove any wildcards (*)
-            this_url = this_url.replace("*","")
+    ##-----------------------------------------------------------------------
+    ## Rotate function
+    ##  Purpose: compress the log file to o365_update.1.gz (shifting the older files, keeping log_keep)
+    ##  and start a new log file
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def rotate(self):
+        self.close()
+        ## Another process (ex. --daemon and a cron run) may have rotated the file already
+        try:
+            fin = open(self.path, "rb")
+        except (IOError, OSError):
+            fin = None
 
-            urlscleaned.append(this_url)
+        if fin is not None:
+            try:
+                if os.path.isfile(self.path + "." + str(self.keep) + ".gz"):
+                    os.remove(self.path + "." + str(self.keep) + ".gz")
+                for i in range(self.keep - 1, 0, -1):
+                    if os.path.isfile(self.path + "." + str(i) + ".gz"):
+                        os.rename(self.path + "." + str(i) + ".gz", self.path + "." + str(i + 1) + ".gz")
+
+                fout = gzip.open(self.path + ".1.gz", "wb")
+                while True:
+                    data = fin.read(1048576)
+                    if not data:
+                        break
+                    fout.write(data)
+                fout.close()
+                os.remove(self.path)
+            except (IOError, OSError):
+                pass
+            fin.close()
 
-        ## de-duplicate and return the remaining list
-        urlsdeduped = list(set(urlscleaned))
-        return urlsdeduped
+        self.handle = open(self.path, "a")
+        self.size = 0
+        self.started = time.time()
 
 
     ##-----------------------------------------------------------------------
-    ## Hash function
-    ##  Purpose: get the hash of a supplied parameter and return the hash value
-    ##  Parameters:
-    ##      jsonstr     = supplied JSON configuration
+    ## Flush function
+    ##  Purpose: write the buffered messages to the log file (ex. at the end of a run), or rotate it if it expired
+    ##  Parameters: none
     ##-----------------------------------------------------------------------
-    def get_hashedValue(self, input):
-        input.sort()
-        return hashlib.md5(str(input).encode('utf-8')).hexdigest()
+    def flush(self):
+        with self.lock:
+            if self.handle is not None:
+                if self.expired():
+                    self.rotate()
+                else:
+                    self.handle.flush()
+
 
     ##-----------------------------------------------------------------------
-    ## JSON update function
-    ##  Purpose: update imported json data to include required attributes and/or defaults if keys are omitted
-    ##  Parameters:
-    ##      jsonstr     = supplied JSON configuration
+    ## Close function
+    ##  Purpose: flush and close the log file
+    ##  Parameters: none
     ##-----------------------------------------------------------------------
-    def update_json(self, jsonstr):
-        json_data = copy.deepcopy(json_config_data)
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
 
-        ##status
-        if "status" in jsonstr:
-            if "description" in jsonstr["status"]:
-                json_data["status"]["description"] = jsonstr["status"]["description"]
-            else:
-                json_data["status"]["description"] = ""
 
-            if "last_run" in jsonstr["status"]:
-                json_data["status"]["last_run"] = jsonstr["status"]["last_run"]
-            else:
-                json_data["status"]["last_run"] = ""
 
-            if "next_run" in jsonstr["status"]:
-                json_data["status"]["next_run"] = jsonstr["status"]["next_run"]
-            else:
-                json_data["status"]["next_run"] = ""
+##-----------------------------------------------------------------------
+## Syslog sender
+##  Purpose: sends event messages to the local syslog socket (/dev/log) - what /usr/bin/logger -p
+##  local1.<level> did, without a process per event. One socket is kept open, and events are buffered
+##  during a run and sent by flush (end of run, exit, or a full buffer).
+##  Example:
+##      sender = syslogSender()                  (or syslogSender("/tmp/test.sock") for a local listener)
+##      sender.send(2, "VERSION request to MS web service was successful.")
+##      sender.flush()
+##-----------------------------------------------------------------------
+class syslogSender:
 
-            if "last_hash_includedUrls" in jsonstr["status"]:
-                json_data["status"]["last_hash_includedUrls"] = jsonstr["status"]["last_hash_includedUrls"]
-            else:
-                json_data["status"]["last_hash_includedUrls"] = {}
+    def __init__(self, address="/dev/log"):
+        self.address = address
+        self.sock = None
+        ## Stream sockets need a frame terminator after every message (see connect)
+        self.stream = False
+        self.pending = []
+        ## Same tag as /usr/bin/logger (the user name)
+        self.tag = pwd.getpwuid(os.getuid()).pw_name
+        ## Events are sent from the output worker threads
+        self.lock = threading.Lock()
 
-            if "last_hash_excludedUrls" in jsonstr["status"]:
-                json_data["status"]["last_hash_excludedUrls"] = jsonstr["status"]["last_hash_excludedUrls"]
-            else:
-                json_data["status"]["last_hash_excludedUrls"] = ""
 
-            if "last_hash_excludedIPs" in jsonstr["status"]:
-                json_data["status"]["last_hash_excludedIPs"] = jsonstr["status"]["last_hash_excludedIPs"]
-            else:
-                json_data["status"]["last_hash_excludedIPs"] = ""
+    ##-----------------------------------------------------------------------
+    ## Send function
+    ##  Purpose: buffer one event message
+    ##  Parameters:
+    ##      lev             = 1 -> error, 2 -> notice
+    ##      msg             = event message
+    ##-----------------------------------------------------------------------
+    def send(self, lev, msg):
+        ## local1 logs to /var/log/apm, and the SSLO product subset is C4.
+        ## Use 1000 for log msg id to not collide with log messages on BIGIP
+        severity = 3 if lev == 1 else 5
+        message = "<" + str(17 * 8 + severity) + ">" + time.strftime("%b %d %H:%M:%S") + " " + self.tag + ": 01c41000: " + " ".join(msg.splitlines())[:4000]
+        ## Encoded once here. On python2 a str is already bytes, and encoding non-ASCII bytes would raise UnicodeDecodeError
+        if not isinstance(message, bytes):
+            message = message.encode('utf-8', 'replace')
+        with self.lock:
+            self.pending.append(message)
+            if len(self.pending) >= 100:
+                self.flush_pending()
 
-        ## endpoint
-        if "endpoint" in jsonstr:
-            json_data["endpoint"] = jsonstr["endpoint"]
 
-            ## Input validation: ensure value is one of: Worldwide, USGovDoD, USGovGCCHigh, China, or Germany
-            if json_data["endpoint"] not in {"Worldwide", "USGovDoD", "USGovGCCHigh", "China", "Germany"}:
-                raise Exception('Endpoint value must be one of: \"Worldwide\", \"USGovDoD\", \"USGovGCCHigh\", \"China\", or \"Germany\". [1014]')
-                sys.exit(1)
+    ##-----------------------------------------------------------------------
+    ## Flush function
+    ##  Purpose: send the buffered event messages
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def flush(self):
+        with self.lock:
+            self.flush_pending()
 
-        ## service_areas
-        if "service_areas" in jsonstr:
 
-            ## service_areas:common
-            if "common" in jsonstr["service_areas"]:
-                json_data["service_areas"]["common"] = jsonstr["service_areas"]["common"]
+    ##-----------------------------------------------------------------------
+    ## Flush pending function
+    ##  Purpose: send the buffered event messages (lock held). A broken socket (ex. syslog restarted)
+    ##  is reconnected once, otherwise the remaining messages are dropped.
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def flush_pending(self):
+        pending = self.pending
+        self.pending = []
+        for i in range(len(pending)):
+            for attempt in (1, 2):
+                try:
+                    if self.sock is None:
+                        self.connect()
+                    if self.stream:
+                        ## NUL terminated, as logging.handlers.SysLogHandler frames stream messages
+                        self.sock.sendall(pending[i] + b"\000")
+                    else:
+                        self.sock.send(pending[i])
+                    break
+                except (socket.error, OSError):
+                    self.close_socket()
+                    if attempt == 2:
+                        sys.stderr.write("WARNING: syslog " + self.address + " unavailable, " + str(len(pending) - i) + " event messages dropped.\n")
+                        return
 
-                ## Input validation: ensure value is boolean
-                if type(json_data["service_areas"]["common"]) != bool:
-                    raise Exception('Service Areas "common" value must be a Boolean True or False. [1021]')
-                    sys.exit(1)
-            else:
-                ## Default True
-                json_data["service_areas"]["common"] = True
 
-            ## service_areas:exchange
-            if "exchange" in jsonstr["service_areas"]:
-                json_data["service_areas"]["exchange"] = jsonstr["service_areas"]["exchange"]
+    ##-----------------------------------------------------------------------
+    ## Connect function
+    ##  Purpose: connect to the syslog socket (datagram, or stream if the socket is a stream socket)
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.connect(self.address)
+            self.stream = False
+        except (socket.error, OSError):
+            sock.close()
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.address)
+            self.stream = True
+        self.sock = sock
 
-                ## Input validation: ensure value is boolean
-                if type(json_data["service_areas"]["exchange"]) != bool:
-                    raise Exception('Service Areas "exchange" value must be a Boolean True or False. [1011]')
-                    sys.exit(1)
-            else:
-                ## Default False
-                json_data["service_areas"]["exchange"] = False
 
-            ## service_areas:sharepoint
-            if "sharepoint" in jsonstr["service_areas"]:
-                json_data["service_areas"]["sharepoint"] = jsonstr["service_areas"]["sharepoint"]
+    ##-----------------------------------------------------------------------
+    ## Close socket function
+    ##  Purpose: close the syslog socket
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def close_socket(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except:
+                pass
+            self.sock = None
 
-                ## Input validation: ensure value is boolean
-                if type(json_data["service_areas"]["sharepoint"]) != bool:
-                    raise Exception('Service Areas "sharepoint" value must be a Boolean True or False. [1012]')
-                    sys.exit(1)
-            else:
-                ## Default False
-                json_data["service_areas"]["sharepoint"] = False
 
-            ## service_areas:skype
-            if "skype" in jsonstr["service_areas"]:
-                json_data["service_areas"]["skype"] = jsonstr["service_areas"]["skype"]
+    ##-----------------------------------------------------------------------
+    ## Close function
+    ##  Purpose: send the buffered event messages and close the socket (at exit)
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def close(self):
+        with self.lock:
+            self.flush_pending()
+            self.close_socket()
 
-                ## Input validation: ensure value is boolean
-                if type(json_data["service_areas"]["skype"]) != bool:
-                    raise Exception('Service Areas "skype" value must be a Boolean True or False. [1017]')
-                    sys.exit(1)
-            else:
-                ## Default False
-                json_data["service_areas"]["skype"] = False
-        else:
-            ## No service_areas block defined, set defaults
-            json_data["service_areas"]["common"] = True
-            json_data["service_areas"]["exchange"] = False
-            json_data["service_areas"]["sharepoint"] = False
-            json_data["service_areas"]["skype"] = False
 
-        ## outputs
-        if "outputs" in jsonstr:
 
-            ## outputs:url_categories
-            if "url_categories" in jsonstr["outputs"]:
-                json_data["outputs"]["url_categories"] = jsonstr["outputs"]["url_categories"]
+##-----------------------------------------------------------------------
+## TMSH executor
+##  Purpose: collects the planned tmsh commands for a run and submits them through a single tmsh
+##  session (batch file), as one cli transaction by default. If the transaction is rejected the
+##  commands are replayed one at a time so independent changes still apply, and every command
+##  gets its own result. load_inventory lists every o365_update.app object once, so the create or
+##  modify decisions of a run don't each start a tmsh process.
+##  Example:
+##      self.executor.load_inventory()
+##      self.executor.add("modify /sys file data-group o365_update.app/O365_IPv4 source-path file:/shared/o365/O365_IPv4", "/shared/o365/O365_IPv4")
+##      results = self.executor.submit()
+##-----------------------------------------------------------------------
+class tmshExecutor:
 
-                ## Input validation: ensure value is boolean
-                if type(json_data["outputs"]["url_categories"]) != bool:
-                    raise Exception('Outputs "url_categories" value must be a Boolean True or False. [1019]')
-                    sys.exit(1)
-            else:
-                ## Default True
-                json_data["outputs"]["url_categories"] = True
+    def __init__(self, manager):
+        self.manager = manager
+        self.commands = []
+        self.cleanup = []
+        ## Commands are queued from the output worker threads
+        self.lock = threading.Lock()
+        ## {tmsh module path: {object name: URL category entries, external data group link or {}}} (see load_inventory)
+        self.inventory = None
 
-            ## outputs:url_datagroups
-            if "url_datagroups" in jsonstr["outputs"]:
-                json_data["outputs"]["url_datagroups"] = jsonstr["outputs"]["url_datagroups"]
 
-                ## Input validation: ensure value is boolean
-                if type(json_data["outputs"]["url_datagroups"]) != bool:
-                    raise Exception('Outputs "url_datagroups" value must be a Boolean True or False. [1010]')
-                    sys.exit(1)
-            else:
-                ## Default False
-                json_data["outputs"]["url_datagroups"] = False
+    ##-----------------------------------------------------------------------
+    ## Run function
+    ##  Purpose: run a single (read-only) tmsh command immediately and return its output
+    ##  Parameters:
+    ##      command         = tmsh command without the "tmsh -a" prefix
+    ##-----------------------------------------------------------------------
+    def run(self, command):
+        return shell.getoutput("tmsh -a " + command)
 
-            ## outputs:ip_datagroups
-            if "ip_datagroups" in jsonstr["outputs"]:
-                json_data["outputs"]["ip_datagroups"] = jsonstr["outputs"]["ip_datagroups"]
 
-                ## Input validation: ensure value is boolean
-                if type(json_data["outputs"]["ip_datagroups"]) != bool:
-                    raise Exception('Outputs "ip_datagroups" value must be a Boolean True or False. [1037]')
-                    sys.exit(1)
-            else:
-                ## Default False
-                json_data["outputs"]["ip_datagroups"] = False
+    ##-----------------------------------------------------------------------
+    ## Run batch function
+    ##  Purpose: run tmsh commands through one tmsh session (batch file on stdin) and return the output.
+    ##  Chunked URL category commands are larger than a single shell argument may be (128 KB), so
+    ##  changes are never passed on the command line.
+    ##  Parameters:
+    ##      commands        = list of tmsh commands without the "tmsh -a" prefix
+    ##-----------------------------------------------------------------------
+    def run_batch(self, commands):
+        ## Commands are written for the shell (ex. "Office_365_All\(Managed\)"), the batch file is read by tmsh directly.
+        ## A unique file per batch - a --daemon run and a cron/--force/--rollback run can submit at the same time.
+        fd, batch_file = tempfile.mkstemp(prefix="tmsh_batch_", dir=self.manager.work_directory)
+        f = os.fdopen(fd, "w")
+        for command in commands:
+            f.write(command.replace("\\(", "(").replace("\\)", ")") + "\n")
+        f.flush()
+        f.close()
+        output = shell.getoutput("tmsh -a < " + batch_file)
+        os.remove(batch_file)
+        return output
 
-        else:
-            ## No outputs block defined, set defaults
-            json_data["outputs"]["url_categories"] = True
-            json_data["outputs"]["url_datagroups"] = False
-            json_data["outputs"]["ip_datagroups"] = True
 
-        ## o365_categories
-        if "o365_categories" in jsonstr:
+    ##-----------------------------------------------------------------------
+    ## Exists function
+    ##  Purpose: return True if a BIG-IP object exists
+    ##  Parameters:
+    ##      path            = tmsh module path and object name (ex. "sys file data-group o365_update.app/O365_IPv4")
+    ##-----------------------------------------------------------------------
+    def exists(self, path):
+        if self.inventory is not None:
+            tokens = self.tokenize(path)
+            return tokens[-1] in self.inventory[" ".join(tokens[:-1]).lstrip("/")]
+        return self.lookup(path)
 
-            ## o365_categories:all
-            if "all" in jsonstr["o365_categories"]:
-                json_data["o365_categories"]["all"] = jsonstr["o365_categories"]["all"]
 
-                ## Input validation: ensure value is boolean
-                if type(json_data["o365_categories"]["all"]) != bool:
-                    raise Exception('O365 Categories "all" value must be a Boolean True or False. [1013]')
-                    sys.exit(1)
-            else:
-                ## Default True
-                json_data["o365_categories"]["all"] = True
+    ##-----------------------------------------------------------------------
+    ## URL category entries function
+    ##  Purpose: return the entries of a URL category ({url: type}), or None if it doesn't exist
+    ##  Parameters:
+    ##      category_name   = URL category name in the o365_update.app folder
+    ##-----------------------------------------------------------------------
+    def url_category_entries(self, category_name):
+        if self.inventory is not None:
+            return self.inventory["sys url-db url-category"].get("o365_update.app/" + category_name.replace("\\", ""))
+        return self.read_url_category(category_name)
 
-            ## o365_categories:optimize
-            if "optimize" in jsonstr["o365_categories"]:
-                json_data["o365_categories"]["optimize"] = jsonstr["o365_categories"]["optimize"]
 
-                ## Input validation: ensure value is boolean
-                if type(json_data["o365_categories"]["optimize"]) != bool:
-                    raise Exception('O365 Categories "optimize" value must be a Boolean True or False. [1026]')
-                    sys.exit(1)
-            else:
-                ## Default False
-                json_data["o365_categories"]["optimize"] = False
+    ##-----------------------------------------------------------------------
+    ## External file name function
+    ##  Purpose: return the sys file data group an ltm external data group is linked to, or None
+    ##  Parameters:
+    ##      dg_name         = ltm external data group name in the o365_update.app folder
+    ##-----------------------------------------------------------------------
+    def external_file_name(self, dg_name):
+        if self.inventory is not None:
+            return self.inventory["ltm data-group external"].get("o365_update.app/" + dg_name, {}).get("external-file-name")
+        return self.read_property("ltm data-group external o365_update.app/" + dg_name, "external-file-name")
 
-            ## o365_categories:default
-            if "default" in jsonstr["o365_categories"]:
-                json_data["o365_categories"]["default"] = jsonstr["o365_categories"]["default"]
 
-                ## Input validation: ensure value is boolean
-                if type(json_data["o365_categories"]["default"]) != bool:
-                    raise Exception('O365 Categories "default" value must be a Boolean True or False. [1027]')
-                    sys.exit(1)
-            else:
-                ## Default False
-                json_data["o365_categories"]["default"] = False
+    ##-----------------------------------------------------------------------
+    ## Read property function
+    ##  Purpose: return a single property of a BIG-IP object (live), or None
+    ##  Parameters:
+    ##      path            = tmsh module path and object name
+    ##      property        = tmsh property name (ex. "checksum")
+    ##-----------------------------------------------------------------------
+    def read_property(self, path, property):
+        match = re.search("^\\s+" + property + "\\s+\"?([^\"\\s]+)\"?\\s*$", self.run("list " + path + " " + property), re.M)
+        if not match:
+            return None
+        return match.group(1).replace("/Common/", "")
 
-            ## o365_categories:allow
-            if "allow" in jsonstr["o365_categories"]:
-                json_data["o365_categories"]["allow"] = jsonstr["o365_categories"]["allow"]
 
-                ## Input validation: ensure value is boolean
-                if type(json_data["o365_categories"]["allow"]) != bool:
-                    raise Exception('O365 Categories "allow" value must be a Boolean True or False. [1028]')
-                    sys.exit(1)
-            else:
-                ## Default False
-                json_data["o365_categories"]["allow"] = False
-        else:
-            ## No o365_categories block defined, set defaults
-            json_data["o365_categories"]["all"] = True
-            json_data["o365_categories"]["optimize"] = False
-            json_data["o365_categories"]["default"] = False
-            json_data["o365_categories"]["allow"] = False
+    ##-----------------------------------------------------------------------
+    ## Lookup function
+    ##  Purpose: return True if a BIG-IP object exists (live)
+    ##  Parameters:
+    ##      path            = tmsh module path and object name
+    ##-----------------------------------------------------------------------
+    def lookup(self, path):
+        return "was not found" not in self.run("list " + path)
 
-        ## only_required
-        if "only_required" in jsonstr:
-            json_data["only_required"] = jsonstr["only_required"]
 
-            ## Input validation: ensure value is boolean
-            if type(json_data["only_required"]) != bool:
-                raise Exception('The "only_required" value must be a Boolean True or False. [1029]')
-                sys.exit(1)
-        else:
-            ## Default True
-            json_data["only_required"] = True
+    ##-----------------------------------------------------------------------
+    ## Read URL category function
+    ##  Purpose: return the entries of a URL category (live), or None if it doesn't exist
+    ##  Parameters:
+    ##      category_name   = URL category name in the o365_update.app folder
+    ##-----------------------------------------------------------------------
+    def read_url_category(self, category_name):
+        result = self.run("list sys url-db url-category o365_update.app/" + category_name + " urls")
+        if "was not found" in result:
+            return None
+        return self.manager.parse_url_category(result)
 
-        ## excluded_urls
-        if "excluded_urls" in jsonstr:
-            json_data["excluded_urls"] = self.url_parser(jsonstr["excluded_urls"])
-        else:
-            ## Default []
-            json_data["excluded_urls"] = []
 
-        ## included_urls
-        if "included_urls" in jsonstr:
-            #json_data["included_urls"] = jsonstr["included_urls"]
-            if "allow" in jsonstr["included_urls"]:
-                json_data["included_urls"]["allow"] = self.url_parser(jsonstr["included_urls"]["allow"])
-            if "optimized" in jsonstr["included_urls"]:
-                json_data["included_urls"]["optimized"] = self.url_parser(jsonstr["included_urls"]["optimized"])
-            if "default" in jsonstr["included_urls"]:
-                json_data["included_urls"]["default"] = self.url_parser(jsonstr["included_urls"]["default"])
-            if "all" in jsonstr["included_urls"]:
-                json_data["included_urls"]["all"] = self.url_parser(jsonstr["included_urls"]["all"])
-        else:
-            ## Default []
-            json_data["included_urls"] = {}
-            json_data["included_urls"]["allow"] = []
-            json_data["included_urls"]["optimized"] = []
-            json_data["included_urls"]["default"] = []
-            json_data["included_urls"]["all"] = []
+    ##-----------------------------------------------------------------------
+    ## Load inventory function
+    ##  Purpose: list every object under o365_update.app in one tmsh session (one-line output) and keep
+    ##  it as the inventory for exists/url_category_entries until the next submit. If the listing
+    ##  reports an error the inventory isn't used and objects are checked one at a time.
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def load_inventory(self):
+        fd, batch_file = tempfile.mkstemp(prefix="tmsh_inventory_", dir=self.manager.work_directory)
+        f = os.fdopen(fd, "w")
+        f.write("cd /Common\n")
+        for module in rest_modules:
+            f.write("list " + module + " recursive one-line\n")
+        f.flush()
+        f.close()
+        output = shell.getoutput("tmsh -a < " + batch_file)
+        os.remove(batch_file)
 
-        ## excluded_ips
-        if "excluded_ips" in jsonstr:
-            json_data["excluded_ips"] = jsonstr["excluded_ips"]
-        else:
-            ## Default []
-            json_data["excluded_ips"] = []
+        inventory = dict([(module, {}) for module in rest_modules])
+        for line in output.splitlines():
+            if line.strip() == "":
+                continue
+            tokens = self.tokenize(line)
+            for module in rest_modules:
+                if " ".join(tokens[:len(module.split())]) == module:
+                    break
+            else:
+                self.manager.log(1, self.manager.log_level, self.manager.logdir, "tmsh inventory not used, unexpected output: " + line[:200])
+                return False
 
-        ## system
-        if "system" in jsonstr:
+            name = tokens[len(module.split())]
+            if not name.startswith("o365_update.app/"):
+                continue
 
-            ## system:log_level
-            if "log_level" in jsonstr["system"]:
-                json_data["system"]["log_level"] = jsonstr["system"]["log_level"]
+            entries = {}
+            if module == "sys url-db url-category" and "urls" in tokens:
+                i = tokens.index("urls")
+                for url, properties in self.parse_block(tokens, i + 1)[0]:
+                    entries[url] = properties.get("type", "exact-match")
+            elif module == "ltm data-group external" and "external-file-name" in tokens:
+                entries["external-file-name"] = tokens[tokens.index("external-file-name") + 1].replace("/Common/", "")
+            inventory[module][name] = entries
 
-                ## Input validation: ensure value is an integer
-                if type(json_data["system"]["log_level"]) != int:
-                    raise Exception('The System "log level" value must be an integer between 0 and 2. [1018]')
-                    sys.exit(1)
+        self.inventory = inventory
+        self.manager.log(2, self.manager.log_level, self.manager.logdir, "tmsh inventory: " + str(sum([len(x) for x in inventory.values()])) + " o365_update.app objects.")
+        return True
 
-                ## Input validation: ensure value is an integer between 0 and 2
-                if json_data["system"]["log_level"] < 0 or json_data["system"]["log_level"] > 2:
-                    raise Exception('The System "log level" value must be an integer between 0 and 2. [1031]')
-                    sys.exit(1)
+
+    ##-----------------------------------------------------------------------
+    ## Add function
+    ##  Purpose: queue a tmsh command for the next submit
+    ##  Parameters:
+    ##      command         = tmsh command without the "tmsh -a" prefix
+    ##      cleanup         = optional local file to remove once the batch has been submitted
+    ##-----------------------------------------------------------------------
+    def add(self, command, cleanup=None):
+        with self.lock:
+            if command not in self.commands:
+                self.commands.append(command)
+            if cleanup is not None and cleanup not in self.cleanup:
+                self.cleanup.append(cleanup)
+
+
+    ##-----------------------------------------------------------------------
+    ## Submit function
+    ##  Purpose: submit all queued commands through one tmsh session and return per-command results
+    ##  Parameters:
+    ##      transaction     = wrap the batch in a cli transaction (all or nothing)
+    ##      replay          = replay the commands one at a time if the transaction fails
+    ##  Returns: list of {"command", "ok", "output"} dictionaries in queue order ("seconds" is added
+    ##  to the results of commands replayed one at a time)
+    ##-----------------------------------------------------------------------
+    def submit(self, transaction=True, replay=True):
+        commands = self.commands
+        self.commands = []
+        results = []
+        ## The submitted changes make the inventory stale
+        self.inventory = None
+
+        if commands:
+            start = time.time()
+            if transaction:
+                output = self.run_batch(["create cli transaction"] + commands + ["submit cli transaction"])
             else:
-                ## Default 1
-                json_data["system"]["log_level"] = 1
+                output = self.run_batch(commands)
+            self.manager.log(2, self.manager.log_level, self.manager.logdir, "Submitted " + str(len(commands)) + " tmsh commands in one session (transaction: " + str(transaction) + ") in " + "%.3f" % (time.time() - start) + " seconds.")
+
+            errors = [x for x in output.splitlines() if x.strip() != ""]
+            names = [self.object_name(x) for x in commands]
+            for command, name in zip(commands, names):
+                command_errors = [x for x in errors if name != "" and name in x]
+                results.append({"command": command, "ok": not command_errors, "output": "\n".join(command_errors)})
+
+            ## An error that names none of the objects can't be attributed - it fails the whole batch
+            unattributed = [x for x in errors if not [name for name in names if name != "" and name in x]]
+            if unattributed:
+                results = [x if not x["ok"] else {"command": x["command"], "ok": False, "output": "\n".join(unattributed)} for x in results]
+
+            if transaction and errors and not replay:
+                ## The transaction was rolled back - nothing was applied
+                self.manager.log(1, self.manager.log_level, self.manager.logdir, "tmsh transaction failed, no changes applied: " + " ".join(errors))
+                results = [{"command": x["command"], "ok": False, "output": x["output"] or "transaction rolled back"} for x in results]
+
+            elif transaction and errors:
+                ## The transaction was rolled back - replay one command at a time for per-command results
+                self.manager.log(1, self.manager.log_level, self.manager.logdir, "tmsh transaction failed, replaying commands individually: " + " ".join(errors))
+                results = []
+                for command in commands:
+                    start = time.time()
+                    output = self.run_batch([command])
+                    results.append({"command": command, "ok": output.strip() == "", "output": output.strip(), "seconds": time.time() - start})
+                    self.manager.log(2, self.manager.log_level, self.manager.logdir, "Replayed " + self.object_name(command) + " (" + str(len(command)) + " bytes) in " + "%.3f" % (time.time() - start) + " seconds.")
+
+            for result in results:
+                if not result["ok"]:
+                    self.manager.log(1, self.manager.log_level, self.manager.logdir, "tmsh command failed: " + result["command"][:200] + " -> " + result["output"])
+
+        for cleanup_file in self.cleanup:
+            try:
+                os.remove(cleanup_file)
+            except:
+                pass
+        self.cleanup = []
 
-            ## system:ca_bundle
-            if "ca_bundle" in jsonstr["system"]:
-                json_data["system"]["ca_bundle"] = jsonstr["system"]["ca_bundle"]
+        return results
+
+
+    ##-----------------------------------------------------------------------
+    ## Object name function
+    ##  Purpose: return the o365_update.app object name a command refers to (used to attribute errors)
+    ##  Parameters:
+    ##      command         = tmsh command
+    ##-----------------------------------------------------------------------
+    def object_name(self, command):
+        match = re.search("o365_update\\.app/([^\\s\"]+)", command)
+        if not match:
+            return ""
+        return match.group(1).replace("\\(", "(").replace("\\)", ")")
+
+
+    ##-----------------------------------------------------------------------
+    ## Parse block function
+    ##  Purpose: parse a tmsh collection block ({ item { key value } item { } ... })
+    ##  Parameters:
+    ##      tokens          = command tokens
+    ##      start           = index of the opening brace
+    ##  Returns: ([(item, {key: value})], index after the closing brace)
+    ##-----------------------------------------------------------------------
+    def parse_block(self, tokens, start):
+        items = []
+        i = start + 1
+        while tokens[i] != "}":
+            name = tokens[i]
+            properties = {}
+            i += 1
+            if tokens[i] == "{":
+                i += 1
+                while tokens[i] != "}":
+                    properties[tokens[i]] = tokens[i + 1]
+                    i += 2
+                i += 1
+            items.append((name, properties))
+
+        return items, i + 1
+
+
+    ##-----------------------------------------------------------------------
+    ## Tokenize function
+    ##  Purpose: split a tmsh command into tokens (quotes grouped, backslash escapes removed)
+    ##  Parameters:
+    ##      command         = tmsh command
+    ##-----------------------------------------------------------------------
+    def tokenize(self, command):
+        tokens = []
+        token = None
+        quoted = False
+        i = 0
+        while i < len(command):
+            c = command[i]
+            if c == "\\" and i + 1 < len(command):
+                token = (token or "") + command[i + 1]
+                i += 1
+            elif c == '"':
+                quoted = not quoted
+                token = token or ""
+            elif c.isspace() and not quoted:
+                if token is not None:
+                    tokens.append(token)
+                token = None
             else:
-                ## Default ca-bundle.crt
-                json_data["system"]["ca_bundle"] = "ca-bundle.crt"
+                token = (token or "") + c
+            i += 1
 
-            ## system:working_directory
-            if "working_directory" in jsonstr["system"]:
-                json_data["system"]["working_directory"] = jsonstr["system"]["working_directory"]
+        if token is not None:
+            tokens.append(token)
+        return tokens
+
+
+
+##-----------------------------------------------------------------------
+## iControl REST executor
+##  Purpose: alternative to tmshExecutor (system "backend": "rest"). Talks to the local iControl REST
+##  API over a small pool of keep-alive connections instead of starting a tmsh process per call, and
+##  returns the status code and error message of every change. The queued commands are the same tmsh
+##  commands the tmsh executor takes - they are translated into REST requests and submitted as one
+##  REST transaction, replayed one at a time if the transaction fails (as the tmsh executor does).
+##  Example:
+##      executor = restExecutor(self, "http://localhost:8100")
+##      executor.add("modify /sys file data-group o365_update.app/O365_IPv4 source-path file:/shared/o365/O365_IPv4", "/shared/o365/O365_IPv4")
+##      results = executor.submit()
+##-----------------------------------------------------------------------
+class restExecutor(tmshExecutor):
+
+    def __init__(self, manager, rest_url):
+        tmshExecutor.__init__(self, manager)
+        match = re.match(r"^(https?)://([^:/]+)(?::(\d+))?", rest_url)
+        self.scheme = match.group(1)
+        self.host = match.group(2)
+        self.port = int(match.group(3)) if match.group(3) else (443 if self.scheme == "https" else 80)
+        ## Local (on-box) iControl REST authentication
+        self.auth = "Basic " + base64.b64encode(rest_user.encode('utf-8')).decode('utf-8')
+        self.idle = []
+        ## {URL category name: entries} after the commands translated so far (chunked URL category changes)
+        self.url_pending = {}
+
+
+    ##-----------------------------------------------------------------------
+    ## Request function
+    ##  Purpose: send one REST request over a pooled keep-alive connection
+    ##  Parameters:
+    ##      method          = HTTP method
+    ##      uri             = request URI (ex. /mgmt/tm/sys/version)
+    ##      body            = optional JSON body (dictionary)
+    ##      transaction     = optional REST transaction id
+    ##  Returns: (status code, parsed JSON response or {})
+    ##-----------------------------------------------------------------------
+    def request(self, method, uri, body=None, transaction=None):
+        headers = {"Authorization": self.auth, "Content-Type": "application/json", "Connection": "keep-alive"}
+        if transaction is not None:
+            headers["X-F5-REST-Coordination-Id"] = str(transaction)
+        if body is not None:
+            body = json.dumps(body)
+
+        ## A pooled connection may have been closed by the server - retry once on a new connection
+        for attempt in (1, 2):
+            with self.lock:
+                connection = self.idle.pop() if self.idle else None
+            if connection is None:
+                if self.scheme == "https":
+                    connection = httpclient.HTTPSConnection(self.host, self.port, timeout=rest_timeout, context=ssl._create_unverified_context())
+                else:
+                    connection = httpclient.HTTPConnection(self.host, self.port, timeout=rest_timeout)
+            try:
+                connection.request(method, uri, body, headers)
+                response = connection.getresponse()
+                content = response.read()
+                status = response.status
+            except Exception:
+                connection.close()
+                if attempt == 2:
+                    raise
+                continue
+
+            with self.lock:
+                self.idle.append(connection)
+            try:
+                return status, json.loads(content.decode('utf-8'))
+            except ValueError:
+                return status, {}
+
+
+    ##-----------------------------------------------------------------------
+    ## Available function
+    ##  Purpose: return True if the iControl REST API answers
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def available(self):
+        try:
+            status, response = self.request("GET", "/mgmt/tm/sys/version")
+            return status == 200
+        except Exception:
+            return False
+
+
+    ##-----------------------------------------------------------------------
+    ## Run function
+    ##  Purpose: run a single tmsh command immediately and return "" or its error message
+    ##  Parameters:
+    ##      command         = tmsh command without the "tmsh -a" prefix
+    ##-----------------------------------------------------------------------
+    def run(self, command):
+        result = self.send(command)
+        return result["output"]
+
+
+    ##-----------------------------------------------------------------------
+    ## Lookup function
+    ##  Purpose: return True if a BIG-IP object exists (live)
+    ##  Parameters:
+    ##      path            = tmsh module path and object name
+    ##-----------------------------------------------------------------------
+    def lookup(self, path):
+        tokens = self.tokenize(path)
+        status, response = self.request("GET", self.object_uri(" ".join(tokens[:-1]), tokens[-1]))
+        return status == 200
+
+
+    ##-----------------------------------------------------------------------
+    ## Read property function
+    ##  Purpose: return a single property of a BIG-IP object (live), or None
+    ##  Parameters:
+    ##      path            = tmsh module path and object name
+    ##      property        = tmsh property name (ex. "checksum")
+    ##-----------------------------------------------------------------------
+    def read_property(self, path, property):
+        tokens = self.tokenize(path)
+        status, response = self.request("GET", self.object_uri(" ".join(tokens[:-1]), tokens[-1]))
+        value = response.get(re.sub("-([a-z])", lambda x: x.group(1).upper(), property))
+        if status != 200 or value is None:
+            return None
+        return str(value).replace("/Common/", "")
+
+
+    ##-----------------------------------------------------------------------
+    ## Read URL category function
+    ##  Purpose: return the entries of a URL category (live), or None if it doesn't exist
+    ##  Parameters:
+    ##      category_name   = URL category name in the o365_update.app folder
+    ##-----------------------------------------------------------------------
+    def read_url_category(self, category_name):
+        status, response = self.request("GET", self.object_uri("sys url-db url-category", "o365_update.app/" + category_name.replace("\\", "")))
+        if status != 200:
+            return None
+        return self.url_entries(response)
+
+
+    ##-----------------------------------------------------------------------
+    ## Load inventory function
+    ##  Purpose: list every object under o365_update.app with one request per object type
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def load_inventory(self):
+        inventory = {}
+        try:
+            for module in rest_modules:
+                status, response = self.request("GET", rest_modules[module])
+                if status != 200:
+                    raise Exception(response.get("message", "HTTP " + str(status)))
+                inventory[module] = {}
+                for item in response.get("items", []):
+                    if item.get("subPath") == "o365_update.app" and "externalFileName" in item:
+                        inventory[module]["o365_update.app/" + item["name"]] = {"external-file-name": item["externalFileName"].replace("/Common/", "")}
+                    elif item.get("subPath") == "o365_update.app":
+                        inventory[module]["o365_update.app/" + item["name"]] = self.url_entries(item)
+                    elif module == "sys application service" and item.get("fullPath", "").startswith("/Common/o365_update.app/"):
+                        inventory[module]["o365_update.app/" + item["name"]] = {}
+        except Exception as e:
+            self.manager.log(1, self.manager.log_level, self.manager.logdir, "REST inventory not used: " + str(e))
+            return False
+
+        self.inventory = inventory
+        return True
+
+
+    ##-----------------------------------------------------------------------
+    ## URL entries function
+    ##  Purpose: return the entries ({url: type}) of a REST URL category object
+    ##  Parameters:
+    ##      item            = REST object
+    ##-----------------------------------------------------------------------
+    def url_entries(self, item):
+        return dict([(x["name"].replace("\\", ""), x.get("type", "exact-match")) for x in item.get("urls", [])])
+
+
+    ##-----------------------------------------------------------------------
+    ## Submit function
+    ##  Purpose: submit all queued commands as one REST transaction and return per-command results
+    ##  Parameters:
+    ##      transaction     = use a REST transaction (all or nothing)
+    ##      replay          = send the commands one at a time if the transaction fails
+    ##  Returns: list of {"command", "ok", "output"} dictionaries in queue order ("seconds" is added
+    ##  to the results of commands sent one at a time)
+    ##-----------------------------------------------------------------------
+    def submit(self, transaction=True, replay=True):
+        commands = self.commands
+        self.commands = []
+        results = []
+        ## The submitted changes make the inventory stale
+        self.inventory = None
+
+        if commands:
+            self.url_pending = {}
+            if transaction:
+                results = self.submit_transaction(commands)
+
+            if transaction and not results and not replay:
+                ## The transaction was rolled back - nothing was applied
+                results = [{"command": command, "ok": False, "output": "transaction rolled back"} for command in commands]
+
+            if not results:
+                ## The transaction was rolled back - start again from the live URL categories
+                self.url_pending = {}
+                for command in commands:
+                    start = time.time()
+                    results.append(self.send(command))
+                    results[-1]["seconds"] = time.time() - start
+
+            self.manager.log(2, self.manager.log_level, self.manager.logdir, "Submitted " + str(len(commands)) + " commands through iControl REST (transaction: " + str(transaction) + ").")
+            for result in results:
+                if not result["ok"]:
+                    self.manager.log(1, self.manager.log_level, self.manager.logdir, "REST command failed: " + result["command"][:200] + " -> " + result["output"])
+
+        for cleanup_file in self.cleanup:
+            try:
+                os.remove(cleanup_file)
+            except:
+                pass
+        self.cleanup = []
+
+        return results
+
+
+    ##-----------------------------------------------------------------------
+    ## Submit transaction function
+    ##  Purpose: submit commands as one REST transaction
+    ##  Parameters:
+    ##      commands        = list of tmsh commands
+    ##  Returns: list of results, or [] if the transaction failed (the commands are then replayed one at a time)
+    ##-----------------------------------------------------------------------
+    def submit_transaction(self, commands):
+        try:
+            ## Translate first - URL category changes read the current entries, which can't be done inside the transaction
+            requests = [self.translate(command) for command in commands]
+
+            status, response = self.request("POST", "/mgmt/tm/transaction", {})
+            if status != 200:
+                raise Exception(response.get("message", "HTTP " + str(status)))
+            transaction = response["transId"]
+
+            for method, uri, body in requests:
+                status, response = self.request(method, uri, body, transaction)
+                if status >= 300:
+                    raise Exception(response.get("message", "HTTP " + str(status)))
+
+            status, response = self.request("PATCH", "/mgmt/tm/transaction/" + str(transaction), {"state": "VALIDATING"})
+            if status >= 300 or response.get("state", "COMPLETED") == "FAILED":
+                raise Exception(response.get("message", response.get("failureReason", "HTTP " + str(status))))
+
+        except Exception as e:
+            self.manager.log(1, self.manager.log_level, self.manager.logdir, "REST transaction failed, replaying commands individually: " + str(e))
+            return []
+
+        return [{"command": command, "ok": True, "output": ""} for command in commands]
+
+
+    ##-----------------------------------------------------------------------
+    ## Send function
+    ##  Purpose: send one command as REST request(s) outside a transaction
+    ##  Parameters:
+    ##      command         = tmsh command
+    ##  Returns: {"command", "ok", "output"} dictionary
+    ##-----------------------------------------------------------------------
+    def send(self, command):
+        try:
+            method, uri, body = self.translate(command)
+            status, response = self.request(method, uri, body)
+        except Exception as e:
+            return {"command": command, "ok": False, "output": str(e)}
+
+        if status >= 300:
+            return {"command": command, "ok": False, "output": str(response.get("code", status)) + ": " + response.get("message", "")}
+        return {"command": command, "ok": True, "output": ""}
+
+
+    ##-----------------------------------------------------------------------
+    ## Translate function
+    ##  Purpose: translate a create/modify/delete tmsh command into a REST request
+    ##  Parameters:
+    ##      command         = tmsh command (ex. "modify /sys file data-group o365_update.app/X source-path file:/shared/o365/X")
+    ##  Returns: (method, uri, body)
+    ##-----------------------------------------------------------------------
+    def translate(self, command):
+        tokens = self.tokenize(command)
+        verb = tokens[0]
+        for module in rest_modules:
+            if " ".join(tokens[1:len(module.split()) + 1]).lstrip("/") == module:
+                break
+        else:
+            raise Exception("Unsupported command for the REST backend: " + command[:200])
+
+        name = tokens[len(module.split()) + 1]
+        if verb == "delete":
+            return "DELETE", self.object_uri(module, name), None
+
+        body = {}
+        url_changes = []
+        properties = tokens[len(module.split()) + 2:]
+        i = 0
+        while i < len(properties):
+            key = properties[i]
+            if key == "urls":
+                ## urls replace-all-with|add|delete { ... }
+                items, next_i = self.parse_block(properties, i + 2)
+                url_changes.append((properties[i + 1], items))
+                i = next_i
+                continue
+            value = properties[i + 1]
+            if key in ("app-service", "external-file-name", "traffic-group") and not value.startswith("/"):
+                value = "/Common/" + value
+            body[re.sub("-([a-z])", lambda x: x.group(1).upper(), key)] = value
+            i += 2
+
+        if url_changes:
+            body["urls"] = self.apply_url_changes(name, url_changes)
+
+        if verb == "create":
+            if "/" in name:
+                body["subPath"], body["name"] = name.rsplit("/", 1)
             else:
-                ## Default "/shared/o365"
-                json_data["system"]["working_directory"] = "/shared/o365"
+                body["name"] = name
+            body["partition"] = "Common"
+            return "POST", rest_modules[module], body
 
-            ## system:retry_attempts
-            if "retry_attempts" in jsonstr["system"]:
+        return "PATCH", self.object_uri(module, name), body
 
-                ## Input validation: ensure value is an integer
-                if type(json_data["system"]["retry_attempts"]) != int:
-                    raise Exception('The System "retry_attempts" value must be an integer. [1040]')
-                    sys.exit(1)
 
-                ## Input validation: ensure value is an integer 0 or higher
-                if json_data["system"]["retry_attempts"] < 0:
-                    raise Exception('The System "retry_attemps" value must be an integer 0 or higher. A 0 value disables retry attempts. [1041]')
-                    sys.exit(1)
+    ##-----------------------------------------------------------------------
+    ## Apply URL changes function
+    ##  Purpose: return the full REST urls list of a URL category after replace-all-with/add/delete changes
+    ##  Parameters:
+    ##      name            = URL category name (ex. "o365_update.app/Office_365_All(Managed)")
+    ##      url_changes     = list of (operation, [(url, properties)])
+    ##-----------------------------------------------------------------------
+    def apply_url_changes(self, name, url_changes):
+        entries = None
+        for operation, items in url_changes:
+            if operation == "replace-all-with":
+                entries = {}
+            elif entries is None and name in self.url_pending:
+                ## An earlier chunk of this category in the same submit
+                entries = dict(self.url_pending[name])
+            elif entries is None:
+                ## add/delete apply to the current entries - REST replaces the whole list
+                entries = self.url_category_entries(name.split("/")[-1]) or {}
+
+            for url, properties in items:
+                if operation == "delete":
+                    entries.pop(url, None)
+                else:
+                    entries[url] = properties.get("type", "exact-match")
 
-                json_data["system"]["retry_attempts"] = jsonstr["system"]["retry_attempts"]
+        self.url_pending[name] = entries
+        return [{"name": x, "type": entries[x]} for x in sorted(entries)]
+
+
+    ##-----------------------------------------------------------------------
+    ## Object URI function
+    ##  Purpose: return the REST URI of an object
+    ##  Parameters:
+    ##      module          = tmsh module path (ex. "sys file data-group")
+    ##      name            = object name (ex. "o365_update.app/O365_IPv4")
+    ##-----------------------------------------------------------------------
+    def object_uri(self, module, name):
+        return rest_modules[module.lstrip("/")] + "/" + urlrequest.quote("~Common~" + name.replace("/", "~"), "~()._-:")
+
+
+
+##-----------------------------------------------------------------------
+## URL suffix trie
+##  Purpose: matches URLs against the excluded_urls list in one pass per URL. Exclusions are stored
+##  by reversed domain labels, with the leftmost (possibly partial) label of each exclusion kept as a
+##  suffix at the node it hangs off, so matching is the same as "url.endswith(exclusion)" for every
+##  exclusion (ex. ".digicert.com" matches "ocsp.digicert.com", "bit.ly" matches "rabbit.ly").
+##  Example:
+##      trie = urlSuffixTrie([".digicert.com", "platform.linkedin.com"])
+##      trie.match("ocsp.digicert.com")  -> True
+##-----------------------------------------------------------------------
+class urlSuffixTrie:
+
+    def __init__(self, exclusions):
+        ## node = [children {label: node}, leftmost label suffixes {suffix}]
+        self.root = [{}, set()]
+        self.cache = {}
+        for exclusion in exclusions:
+            self.insert(exclusion)
+
+
+    ##-----------------------------------------------------------------------
+    ## Insert function
+    ##  Purpose: add an exclusion to the trie
+    ##  Parameters:
+    ##      exclusion       = URL suffix (ex. ".digicert.com")
+    ##-----------------------------------------------------------------------
+    def insert(self, exclusion):
+        labels = exclusion.split(".")
+        node = self.root
+        for label in reversed(labels[1:]):
+            if label not in node[0]:
+                node[0][label] = [{}, set()]
+            node = node[0][label]
+        node[1].add(labels[0])
+        self.cache = {}
+
+
+    ##-----------------------------------------------------------------------
+    ## Match function
+    ##  Purpose: return True if the URL ends with any exclusion
+    ##  Parameters:
+    ##      url             = URL (ex. "ocsp.digicert.com")
+    ##-----------------------------------------------------------------------
+    def match(self, url):
+        if url in self.cache:
+            return self.cache[url]
+
+        found = False
+        node = self.root
+        labels = url.split(".")
+        for label in reversed(labels):
+            ## The URL label at this depth must end with one of the exclusion's leftmost labels
+            if node[1]:
+                for i in range(len(label) + 1):
+                    if label[i:] in node[1]:
+                        found = True
+                        break
+            if found or label not in node[0]:
+                break
+            node = node[0][label]
+
+        self.cache[url] = found
+        return found
+
+
+
+##-----------------------------------------------------------------------
+## IP prefix tree
+##  Purpose: subtracts the excluded_ips networks from the Microsoft IPv4/IPv6 prefixes. Exclusions are
+##  stored in a binary (radix) tree per address family. Each prefix is walked once: it is dropped if an
+##  exclusion covers it, kept as-is if no exclusion overlaps it, and otherwise split into the largest
+##  sub-prefixes that remain (ex. 52.96.0.0/14 minus 52.96.11.0/24).
+##  Exclusions that are not valid networks (or all exclusions, without the ipaddress module) keep the
+##  previous "ends-with" string matching.
+##  Example:
+##      tree = ipPrefixTree(["52.96.11.0/24"])
+##      tree.subtract(["52.96.0.0/14"])  -> ["52.96.0.0/21", "52.96.8.0/23", "52.96.10.0/24", ...]
+##-----------------------------------------------------------------------
+class ipPrefixTree:
+
+    def __init__(self, exclusions):
+        ## node = [child 0, child 1, excluded]
+        self.roots = {4: [None, None, False], 6: [None, None, False]}
+        self.legacy = []
+        for exclusion in exclusions:
+            network = self.parse(exclusion)
+            if network is None:
+                self.legacy.append(exclusion)
             else:
-                ## Default 3 retry attempts
-                json_data["system"]["retry_attempts"] = 3
+                self.insert(network)
 
-            ## system:retry_delay
-            if "retry_delay" in jsonstr["system"]:
 
-                ## Input validation: ensure value is an integer
-                if type(json_data["system"]["retry_delay"]) != int:
-                    raise Exception('The System "retry_delay" value must be an integer. [1042]')
-                    sys.exit(1)
+    ##-----------------------------------------------------------------------
+    ## Parse function
+    ##  Purpose: return an ipaddress network for an IP/CIDR string, or None if it isn't one
+    ##  Parameters:
+    ##      value           = IP or IP/CIDR string
+    ##-----------------------------------------------------------------------
+    def parse(self, value):
+        if ipaddress is None:
+            return None
+        try:
+            return ipaddress.ip_network(u"" + value.strip(), strict=False)
+        except ValueError:
+            return None
+
+
+    ##-----------------------------------------------------------------------
+    ## Insert function
+    ##  Purpose: add an excluded network to the tree
+    ##  Parameters:
+    ##      network         = ipaddress network
+    ##-----------------------------------------------------------------------
+    def insert(self, network):
+        node = self.roots[network.version]
+        address = int(network.network_address)
+        for depth in range(network.prefixlen):
+            if node[2]:
+                ## Already covered by a shorter exclusion
+                return
+            bit = (address >> (network.max_prefixlen - 1 - depth)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, False]
+            node = node[bit]
+        node[0] = None
+        node[1] = None
+        node[2] = True
+
+
+    ##-----------------------------------------------------------------------
+    ## Subtract function
+    ##  Purpose: remove the excluded networks from a list of prefixes
+    ##  Parameters:
+    ##      prefixes        = list of IP/CIDR strings
+    ##  Returns: list of IP/CIDR strings covering exactly the remaining addresses
+    ##-----------------------------------------------------------------------
+    def subtract(self, prefixes):
+        remaining = []
+        for prefix in prefixes:
+            if [x for x in self.legacy if prefix.endswith(x)]:
+                continue
+
+            network = self.parse(prefix)
+            if network is None:
+                remaining.append(prefix)
+                continue
+
+            ## Walk down to the prefix - an excluded node on the way covers the whole prefix
+            node = self.roots[network.version]
+            address = int(network.network_address)
+            for depth in range(network.prefixlen):
+                if node is None or node[2]:
+                    break
+                node = node[(address >> (network.max_prefixlen - 1 - depth)) & 1]
+
+            if node is None:
+                remaining.append(prefix)
+            elif not node[2]:
+                self.split(network, node, remaining)
+
+        return remaining
+
+
+    ##-----------------------------------------------------------------------
+    ## Split function
+    ##  Purpose: append the parts of a network not covered by the exclusions below a tree node
+    ##  Parameters:
+    ##      network         = ipaddress network
+    ##      node            = tree node at the network's prefix length
+    ##      remaining       = output list
+    ##-----------------------------------------------------------------------
+    def split(self, network, node, remaining):
+        if node is None:
+            remaining.append(str(network))
+        elif not node[2]:
+            for bit, subnet in enumerate(network.subnets()):
+                self.split(subnet, node[bit], remaining)
+
+
+
+##-----------------------------------------------------------------------
+## URL search index
+##  Purpose: answers URL searches from a set of URL category entries. Exact-match entries are held
+##  in a hash per category, glob-match entries in a trie keyed by the reversed literal trailing labels
+##  of their host, so a lookup only runs fnmatch against the few patterns that share the URL's domain
+##  suffix. Matching is the same as fnmatch against each category entry.
+##  Example:
+##      index = urlSearchIndex({"Office_365_All(Managed)": {"exact": ["https://smtp.office365.com"], "glob": ["https://*.office.com"]}})
+##      index.match("https://www.office.com")  -> [("Office_365_All(Managed)", "https://*.office.com")]
+##-----------------------------------------------------------------------
+class urlSearchIndex:
+
+    def __init__(self, categories):
+        ## Categories in the order they are reported
+        self.names = [x.replace("\\", "") for x in (o365_category, o365_category_allow, o365_category_optimized, o365_category_default) if x.replace("\\", "") in categories]
+        self.exact = {}
+        ## node = [children {label: node}, [(category, pattern)]]
+        self.root = [{}, []]
+        for name in self.names:
+            self.exact[name] = set(categories[name]["exact"])
+            for pattern in categories[name]["glob"]:
+                self.insert(name, pattern)
+
+
+    ##-----------------------------------------------------------------------
+    ## Insert function
+    ##  Purpose: add a glob pattern under the literal trailing labels of its host
+    ##  Parameters:
+    ##      name            = category name
+    ##      pattern         = URL glob pattern (ex. "https://*.office.com")
+    ##-----------------------------------------------------------------------
+    def insert(self, name, pattern):
+        node = self.root
+        for label in reversed(pattern.split("://", 1)[-1].split(".")):
+            if "*" in label or "?" in label or "[" in label:
+                break
+            if label not in node[0]:
+                node[0][label] = [{}, []]
+            node = node[0][label]
+        node[1].append((name, pattern))
+
+
+    ##-----------------------------------------------------------------------
+    ## Match function
+    ##  Purpose: return the (category, pattern) matches for a URL
+    ##  Parameters:
+    ##      url             = URL including protocol (ex. https://smtp.office365.com)
+    ##-----------------------------------------------------------------------
+    def match(self, url):
+        matches = []
+
+        ## Glob candidates - every pattern on the path of the URL's reversed host labels
+        candidates = []
+        node = self.root
+        for label in reversed(url.split("://", 1)[-1].split(".")):
+            candidates += node[1]
+            if label not in node[0]:
+                node = None
+                break
+            node = node[0][label]
+        if node is not None:
+            candidates += node[1]
+
+        for name in self.names:
+            if url in self.exact[name]:
+                matches.append((name, url))
+            for candidate_name, pattern in candidates:
+                if candidate_name == name and fnmatch.fnmatch(url, pattern):
+                    matches.append((name, pattern))
+
+        return matches
+
+
+
+##-----------------------------------------------------------------------
+## IP lookup tree
+##  Purpose: answers IP searches from the IPv4/IPv6 data group prefix lists with a binary radix tree
+##  per address family. A lookup walks the address bits once and returns the longest matching prefix.
+##  Requires the python ipaddress module.
+##  Example:
+##      tree = ipLookupTree({"Office_365_Managed_IPv4": ["40.96.0.0/13", "40.97.12.0/24"]})
+##      tree.match("40.97.12.5")  -> [("Office_365_Managed_IPv4", "40.97.12.0/24")]
+##-----------------------------------------------------------------------
+class ipLookupTree:
+
+    def __init__(self, networks):
+        ## node = [child 0, child 1, (data group, prefix) or None]
+        self.roots = {4: [None, None, None], 6: [None, None, None]}
+        for name in sorted(networks):
+            for prefix in networks[name]:
+                try:
+                    network = ipaddress.ip_network(u"" + prefix.strip(), strict=False)
+                except ValueError:
+                    continue
+                self.insert(name, network)
+
+
+    ##-----------------------------------------------------------------------
+    ## Insert function
+    ##  Purpose: add a data group prefix to the tree
+    ##  Parameters:
+    ##      name            = data group name
+    ##      network         = ipaddress network
+    ##-----------------------------------------------------------------------
+    def insert(self, name, network):
+        node = self.roots[network.version]
+        address = int(network.network_address)
+        for depth in range(network.prefixlen):
+            bit = (address >> (network.max_prefixlen - 1 - depth)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        node[2] = (name, str(network))
+
+
+    ##-----------------------------------------------------------------------
+    ## Match function
+    ##  Purpose: return the longest prefix match for an IP address
+    ##  Parameters:
+    ##      ip              = IPv4 or IPv6 address string (ex. 40.97.12.5)
+    ##  Returns: list with the (data group, prefix) match, empty if no prefix covers the address
+    ##-----------------------------------------------------------------------
+    def match(self, ip):
+        try:
+            address = ipaddress.ip_address(u"" + ip.strip())
+        except ValueError:
+            return []
+
+        found = None
+        node = self.roots[address.version]
+        value = int(address)
+        for depth in range(address.max_prefixlen + 1):
+            if node[2] is not None:
+                found = node[2]
+            if depth == address.max_prefixlen:
+                break
+            node = node[(value >> (address.max_prefixlen - 1 - depth)) & 1]
+            if node is None:
+                break
+
+        if found is None:
+            return []
+        return [found]
+
+
+class o365UrlManagement:
+
+    ## Init function (set local variables)
+    def __init__(self):
+        self.customer_endpoint = ""
+        self.service_areas_common = ""
+        self.service_areas_exchange = ""
+        self.service_areas_sharepoint = ""
+        self.service_areas_skype = ""
+        self.output_url_categories = ""
+        self.output_url_datagroups = ""
+        self.output_ip_datagroups = ""
+        self.o365_categories_all = ""
+        self.o365_categories_optimize = ""
+        self.o365_categories_default = ""
+        self.o365_categories_allow = ""
+        self.only_required = ""
+        self.excluded_urls = ""
+        self.included_urls_allow = ""
+        self.included_urls_optimized = ""
+        self.included_urls_default = ""
+        self.included_urls_all = ""
+        self.excluded_ips = ""
+        self.log_level = ""
+        self.ca_bundle = ""
+        self.work_directory = ""
+        self.json_config = ""
+        self.json_config_file = ""
+        self.force_update = False
+        self.config_data = ""
+        self.logdir = ""
+        self.retry_attempts = 0
+        self.retry_delay = 0
+        self.snapshot_retention = 5
+        self.poll_interval = 300
+        self.backend = "tmsh"
+        self.rest_url = "http://localhost:8100"
+        self.url_chunk_size = 5000
+        self.apply_mode = "direct"
+        self.history_keep = 500
+        ## What started the run (cron, manual, force or daemon) and the versions it compared (see commit_history)
+        self.trigger = "cron"
+        self.run_versions = {}
+        self.plan_mode = False
+        self.rest_available = None
+        self.guid = None
+        self.executor = tmshExecutor(self)
+        self.manifests_pending = {}
+        ## Staged apply mode: {data group: shadow generation details}, and the executor of the switch transaction
+        self.staged = {}
+        self.switch = None
+        ## {object name: {"entries", "added", "removed", "load"}} of the objects planned this run
+        self.planned = {}
+        ## Run metrics - {phase: seconds}, {object name: {"generate", "apply"}}, and the run result (see commit_metrics)
+        self.timings = {}
+        self.object_seconds = {}
+        self.run_result = None
+        self.excluded_url_trie = None
+        self.excluded_ip_tree = None
+        self.status_pending = None
+        self.config_loader = configLoader()
+        ## One buffered log handle per process, flushed at the end of each run and at exit
+        self.logger = runLogger()
+        atexit.register(self.logger.close)
+        ## One syslog socket per process, events flushed at the end of each run and at exit
+        self.syslog = syslogSender()
+        atexit.register(self.syslog.close)
+
+
+    ##-----------------------------------------------------------------------
+    ## Logging function
+    ##  Purpose: sends a message to the log file
+    ##  Parameters:
+    ##      lev         = level of this meesage
+    ##      log_lev     = system configured log level (for comparison)
+    ##      log_dir     = location of log file
+    ##      msg         = log message
+    ##  Example:
+    ##      self.log(2, self.log_level, self.logdir, "Application service not found. Creating o365_update.app/o365_update")
+    ##-----------------------------------------------------------------------
+    def log(self, lev, log_lev, log_dir, msg):
+        if int(log_lev) >= int(lev) and log_dir != "":
+            self.logger.write(log_dir, lev, msg)
+        return
+
+    ##-----------------------------------------------------------------------
+    ## Profiled function
+    ##  Purpose: run a function under cProfile (and tracemalloc with profile_memory), then write the
+    ##  profile (profile_<name>_<time>.prof, for pstats/snakeviz) and a summary of the top functions
+    ##  (profile_<name>_<time>.txt) to the log directory - also when the function exits or fails
+    ##  Parameters:
+    ##      name            = run name used in the file names (ex. "update")
+    ##      function        = function to run
+    ##      top             = number of functions in the summary
+    ##      profile_memory  = also capture peak memory and the top allocation sites
+    ##  Example:
+    ##      self.profiled("search", self.search, 30, False)
+    ##-----------------------------------------------------------------------
+    def profiled(self, name, function, top, profile_memory):
+        if profile_memory and tracemalloc is None:
+            sys.stderr.write("WARNING: --profile_memory requires python3 (tracemalloc). Profiling without memory capture.\n")
+            profile_memory = False
+        if profile_memory:
+            tracemalloc.start()
+
+        profiler = cProfile.Profile()
+        start = time.time()
+        try:
+            return profiler.runcall(function)
+        finally:
+            seconds = time.time() - start
+            log_dir = self.logdir or json_config_data["system"]["working_directory"] + "/log"
+            if not os.path.isdir(log_dir):
+                os.makedirs(log_dir)
+            profile_file = log_dir + "/profile_" + name + "_" + datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            profiler.dump_stats(profile_file + ".prof")
+
+            f = open(profile_file + ".txt", "w")
+            f.write("Profile of " + name + " run: " + "%.3f" % seconds + " seconds\n")
+            if profile_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                f.write("Peak memory: " + "%.1f" % (peak / 1048576.0) + " MiB (current: " + "%.1f" % (current / 1048576.0) + " MiB)\n\n")
+                f.write("Top " + str(top) + " allocation sites:\n")
+                for stat in snapshot.statistics("lineno")[:top]:
+                    f.write("  " + str(stat) + "\n")
+            f.write("\n")
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats("cumulative").print_stats(top)
+            stats.sort_stats("tottime").print_stats(top)
+            f.flush()
+            f.close()
+            sys.stderr.write("Profile written to " + profile_file + ".prof and " + profile_file + ".txt\n")
+
+
+    ##-----------------------------------------------------------------------
+    ## Event logging function
+    ##  Purpose: sends a message to syslog (local1 -> /var/log/apm) for tracking events
+    ##  Parameters:
+    ##      lev         = level of this meesage
+    ##      msg         = log message
+    ##  Example:
+    ##      self.event_log(2, "VERSION request to MS web service was successful.")
+    ##-----------------------------------------------------------------------
+    def event_log(self, lev, msg):
+        ## For event logs 1 -> error, 2 -> notice
+        self.syslog.send(lev, msg)
+
+
+    ##-----------------------------------------------------------------------
+    ## Show help function
+    ##  Purpose: shows the help syntax
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def show_help(self):
+        print("Office 365 URL Management Script. Version: " + version)
+        print("\nCommand line options for this application are:\n")
+        print("--help                       -> Show this help message and exit.")
+        print("--install                    -> Install the script.")
+        print("--uninstall                  -> Uninstall the script.")
+        print("--full_uninstall             -> Uninstall the script. Remove everything.")
+        print("--force                      -> Force an update.\n")
+        print("--config CONFIG              -> Used with --install. Provide alternate JSON configuration information from a serialized JSON string object.")
+        print("--config_file CONFIG_FILE    -> Used with --install. Provide alternate JSON configuration information from a JSON file.\n")
+        print("--printconfig                -> Show the running configuration.\n")
+        print("--daemon                     -> Run continuously, checking the O365 VERSION every poll_interval seconds (system config).")
+        print("--rollback                   -> Switch the data groups and URL categories back to the previously applied generation.")
+        print("--plan                       -> Show the changes an update would make and the estimated apply cost, without applying them.")
+        print("--history [N]                -> Show the last N (default 20) runs of the run history and their trends.\n")
+        print("--profile [TOP]              -> Profile the run (cProfile). Writes the profile and a summary of the TOP (default 30) functions to the log directory.")
+        print("--profile_memory             -> Used with --profile. Also capture the peak memory and top allocations (tracemalloc, python3).\n")
+        print("--search                     -> Search the Office365 URL categories (URL) or IP data groups (IP address).")
+        print("--searchfile SEARCH_FILE     -> Search the Office365 URL categories/IP data groups for every URL/hostname/IP in a file (- for stdin).")
+        print("--format FORMAT              -> Used with --searchfile (csv (default) or json) or --history (table (default), csv or json). Output format.\n")
+
+        print("Examples:")
+        print("Install with default configuration           ->  python " + os.path.basename(__file__) + " --install")
+        print("Install with serialized JSON configuration   ->  python " + os.path.basename(__file__) + " --install --config ${json_string}")
+        print("Install with JSON file:                      ->  python " + os.path.basename(__file__) + " --install --configfile file.json")
+        print("Install and force immediate URL update       ->  python " + os.path.basename(__file__) + " --install --force")
+        print("Force an update                              ->  python " + os.path.basename(__file__) + " --force")
+        print("Run in daemon mode                           ->  nohup python " + os.path.basename(__file__) + " --daemon &")
+        print("Roll back the last applied update            ->  python " + os.path.basename(__file__) + " --rollback")
+        print("Show what a forced update would change       ->  python " + os.path.basename(__file__) + " --plan --force")
+        print("Profile an update, with memory               ->  python " + os.path.basename(__file__) + " --force --profile --profile_memory")
+        print("Show the last 50 runs as CSV                 ->  python " + os.path.basename(__file__) + " --history 50 --format csv")
+        print("Uninstall but keep categories/datagroups     ->  python " + os.path.basename(__file__) + " --uninstall")
+        print("Uninstall and remove categories/datagroups   ->  python " + os.path.basename(__file__) + " --full_uninstall")
+        print("Search for a URL in the Office365 categories ->  python " + os.path.basename(__file__) + " --search https://smtp.office365.com")
+        print("Search for an IP in the Office365 data groups->  python " + os.path.basename(__file__) + " --search 40.97.12.5")
+        print("Search for a list of URLs (JSON output)      ->  python " + os.path.basename(__file__) + " --searchfile urls.txt --format json\n\n")
+        sys.exit(0)
+
+
+    ##-----------------------------------------------------------------------
+    ## Get config function
+    ##  Purpose: reads the JSON/iFile configuration into (self) local variables
+    ##  Parameters:
+    ##      required        = abort with help if the configuration is missing (default), otherwise return False
+    ##-----------------------------------------------------------------------
+    def get_config(self, required=True):
+        try:
+            ## Resolve the latest version of the configuration iFile (cached pointer, or a scan of the filestore)
+            o365_config = self.config_loader.resolve()
+
+            if o365_config == "" and not required:
+                return False
+
+            if o365_config == "":
+                sys.stderr.write("\nIt appears that O365 URL Updater configuration has not been saved yet. Aborting (1000).\n\n[help-info] To install this script, issue the command \"" + os.path.basename(__file__) + " --install\"\n")
+                self.show_help()
+
+            try:
+                ## Copy of the parsed configuration - the run changes its status hashes in place
+                o365_config, config_data = self.config_loader.load()
+                self.config_data = copy.deepcopy(config_data)
+
+                ## Read configuration parameters from the json config
+                self.customer_endpoint           = self.config_data["endpoint"]
+                self.service_area_common         = self.config_data["service_areas"]["common"]
+                self.service_area_exchange       = self.config_data["service_areas"]["exchange"]
+                self.service_area_sharepoint     = self.config_data["service_areas"]["sharepoint"]
+                self.service_area_skype          = self.config_data["service_areas"]["skype"]
+                self.output_url_categories       = self.config_data["outputs"]["url_categories"]
+                self.output_url_datagroups       = self.config_data["outputs"]["url_datagroups"]
+                self.output_ip_datagroups        = self.config_data["outputs"]["ip_datagroups"]
+                self.o365_categories_all         = self.config_data["o365_categories"]["all"]
+                self.o365_categories_optimize    = self.config_data["o365_categories"]["optimize"]
+                self.o365_categories_default     = self.config_data["o365_categories"]["default"]
+                self.o365_categories_allow       = self.config_data["o365_categories"]["allow"]
+                self.only_required               = self.config_data["only_required"]
+                self.excluded_urls               = self.config_data["excluded_urls"]
+                self.included_urls_allow         = self.config_data["included_urls"]["allow"]
+                self.included_urls_optimized     = self.config_data["included_urls"]["optimized"]
+                self.included_urls_default       = self.config_data["included_urls"]["default"]
+                self.included_urls_all           = self.config_data["included_urls"]["all"]
+                self.excluded_ips                = self.config_data["excluded_ips"]
+                self.log_level                   = self.config_data["system"]["log_level"]
+                self.ca_bundle                   = self.config_data["system"]["ca_bundle"]
+                self.work_directory              = self.config_data["system"]["working_directory"]
+                self.logdir                      = self.config_data["system"]["working_directory"] + "/log"
+                self.retry_attempts              = self.config_data["system"]["retry_attempts"]
+                self.retry_delay                 = self.config_data["system"]["retry_delay"]
+                self.snapshot_retention          = self.config_data["system"].get("snapshot_retention", 5)
+                self.poll_interval               = self.config_data["system"].get("poll_interval", 300)
+                self.backend                     = self.config_data["system"].get("backend", "tmsh")
+                self.rest_url                    = self.config_data["system"].get("rest_url", "http://localhost:8100")
+                self.url_chunk_size              = self.config_data["system"].get("url_chunk_size", 5000)
+                self.apply_mode                  = self.config_data["system"].get("apply_mode", "direct")
+                self.history_keep                = self.config_data["system"].get("history_keep", 500)
+                self.logger.configure(self.config_data["system"].get("log_max_size", 10), self.config_data["system"].get("log_max_age", 30), self.config_data["system"].get("log_keep", 5), self.config_data["system"].get("log_format", "text"))
+                self.schedule_periods            = self.config_data["schedule"]["periods"]
+                self.schedule_run_date           = self.config_data["schedule"]["run_date"]
+                self.schedule_run_time           = self.config_data["schedule"]["run_time"]
+                self.schedule_start_date         = self.config_data["schedule"]["start_date"]
+                self.schedule_start_time         = self.config_data["schedule"]["start_time"]
+                self.status                      = self.config_data["status"]
+
+            except:
+                if not required:
+                    return False
+                sys.stderr.write("\nERROR: It appears the JSON configuration file is either missing or corrupt. Aborting (1001).\n[help-info] Run the script again with the --install option to repair\n.")
+                self.show_help()
+
+        except:
+            if not required:
+                return False
+            sys.stderr.write("\nERROR: It appears that O365 URL Updater configuration has not been saved yet. Aborting (1002).\n\n[help-info] To install this script, issue the command \"" + os.path.basename(__file__) + " --install\"\n")
+            self.show_help()
+
+        return True
+
+
+    ##-----------------------------------------------------------------------
+    ## Show running configuration function
+    ##  Purpose: prints the running configuration to stdout
+    ##  Parmeters: none
+    ##-----------------------------------------------------------------------
+    def print_config(self):
+        self.get_config()
+
+        ## The last_run time of runs that didn't change the status is only kept in the local status file
+        try:
+            f = open(self.work_directory + "/o365_status.json", "r")
+            status = json.loads(f.read())
+            f.close()
+            if status.get("description") == self.config_data["status"].get("description"):
+                self.config_data["status"]["last_run"] = status["last_run"]
+            if "metrics" in status:
+                self.config_data["status"]["metrics"] = status["metrics"]
+        except:
+            pass
+
+        this_json = json.dumps(self.config_data, indent = 4)
+        print(this_json)
+        sys.exit(1)
+
+    
+    ##-----------------------------------------------------------------------
+    ## Search function
+    ##  Purpose: search for a URL in the Office365 categories, or an IP address in the Office365 IP data groups
+    ##  Parmeters: URL (ex. https://smtp.office365.com) or IP address (ex. 40.97.12.5)
+    ##-----------------------------------------------------------------------
+    def search(self, url):
+        if self.is_ip_search(url):
+            tree = self.get_ip_lookup_tree()
+            found_list = [name + ":\t" + prefix for name, prefix in tree.match(url)]
+            self.print_search(found_list, "IP")
+
+        if not ((url.startswith("https://")) or (url.startswith("http://"))):
+            print("\nURL argument format must include protocol (or be an IP address)")
+            print("Example: python o365_lookup.py https://smtp.office365.com\n")
+            sys.exit(0)
+
+        index = self.get_search_index()
+        found_list = [name + ":\t" + pattern for name, pattern in index.match(url)]
+        self.print_search(found_list)
+
+
+    ##-----------------------------------------------------------------------
+    ## Bulk search function
+    ##  Purpose: search many URLs, hostnames or IP addresses in the Office365 categories and IP data groups,
+    ##  loading each lookup structure once
+    ##  Parameters:
+    ##      search_file     = file with one URL, hostname or IP address per line ("-" for stdin)
+    ##      output_format   = "csv" (url,category,pattern rows) or "json" (one JSON object per URL per line)
+    ##-----------------------------------------------------------------------
+    def bulk_search(self, search_file, output_format):
+        if search_file == "-":
+            f = sys.stdin
+        elif os.path.isfile(search_file):
+            f = open(search_file, "r")
+        else:
+            sys.stderr.write("ERROR: Supplied search file does not exist: " + search_file + "\n")
+            sys.exit(1)
+
+        index = None
+        tree = None
+        if output_format == "csv":
+            writer = csv.writer(sys.stdout)
+            writer.writerow(["url", "category", "pattern"])
+
+        for line in f:
+            url = line.strip()
+            if url == "" or url.startswith("#"):
+                continue
+
+            if self.is_ip_search(url):
+                ## IP addresses report the data group and longest matching prefix
+                if tree is None:
+                    tree = self.get_ip_lookup_tree()
+                matches = tree.match(url)
+            else:
+                ## Bare hostnames (ex. from proxy logs) are searched as https://
+                if not ((url.startswith("https://")) or (url.startswith("http://"))):
+                    url = "https://" + url
+                if index is None:
+                    index = self.get_search_index()
+                matches = index.match(url)
+
+            if output_format == "csv":
+                if not matches:
+                    writer.writerow([url, "", ""])
+                for name, pattern in matches:
+                    writer.writerow([url, name, pattern])
+            else:
+                print(json.dumps({"url": url, "matches": [{"category": name, "pattern": pattern} for name, pattern in matches]}))
+
+        if f is not sys.stdin:
+            f.close()
+        sys.exit(0)
+
+
+    ##-----------------------------------------------------------------------
+    ## IP search check function
+    ##  Purpose: return True if a search argument is an IPv4 or IPv6 address rather than a URL or hostname
+    ##  Parameters:
+    ##      value           = search argument
+    ##-----------------------------------------------------------------------
+    def is_ip_search(self, value):
+        return re.match(r"^\d{1,3}(\.\d{1,3}){3}$|^[0-9a-fA-F.]*:[0-9a-fA-F:.]*$", value) is not None
+
+
+    ##-----------------------------------------------------------------------
+    ## Get search index function
+    ##  Purpose: return the local search index, or an index of the live URL categories if it is missing or stale
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def get_search_index(self):
+        index = None
+        if self.get_config(False):
+            index = self.load_search_index()
+
+        if index is None:
+            index = self.live_search_index()
+
+        return index
+
+
+    ##-----------------------------------------------------------------------
+    ## Get IP lookup tree function
+    ##  Purpose: return a lookup tree of the IPv4/IPv6 data group prefixes from the local search index, or
+    ##  rebuilt from the endpoints snapshot of the current version if the index is missing or stale
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def get_ip_lookup_tree(self):
+        if ipaddress is None:
+            sys.stderr.write("ERROR: IP address search requires the python ipaddress module\n")
+            sys.exit(1)
+
+        if not self.get_config(False):
+            sys.stderr.write("ERROR: IP address search requires an installed configuration\n")
+            sys.exit(1)
+
+        index = self.read_search_index()
+        if index is not None and "networks" in index:
+            return ipLookupTree(index["networks"])
+
+        ## Derive the data group lists the same way the last update did
+        records = None
+        try:
+            f = open(self.work_directory + "/o365_version.txt", "r")
+            version = f.readline()
+            f.close()
+            records = self.load_snapshot(version)
+        except:
+            pass
+
+        if records is None:
+            sys.stderr.write("ERROR: No local O365 endpoint data found. Run an update first (--force).\n")
+            sys.exit(1)
+
+        return ipLookupTree(self.ip_datagroup_networks(self.build_outputs(records)))
+
+
+    ##-----------------------------------------------------------------------
+    ## IP data group networks function
+    ##  Purpose: return the prefix lists written to the IPv4/IPv6 data groups for a set of outputs
+    ##  Parameters:
+    ##      outputs         = output lists (see build_outputs)
+    ##-----------------------------------------------------------------------
+    def ip_datagroup_networks(self, outputs):
+        networks = {}
+        if self.output_ip_datagroups:
+            networks[o365_dg_ipv4] = sorted(self.aggregate_prefixes(outputs["ipv4"]))
+            networks[o365_dg_ipv6] = sorted(self.aggregate_prefixes(outputs["ipv6"]))
+
+        return networks
+
+
+    ##-----------------------------------------------------------------------
+    ## Print search function
+    ##  Purpose: print the search results and exit
+    ##  Parmeters:
+    ##      found_list      = list of "category:\tpattern" strings
+    ##      search_type     = "URL" or "IP"
+    ##-----------------------------------------------------------------------
+    def print_search(self, found_list, search_type="URL"):
+        if (len(found_list) > 0):
+            print("\nThe following " + search_type + " matches were discovered:\n") 
+            for found_url in found_list:
+                print(found_url)
+                
+            print("\n\n")
+
+        else:
+            print("\nNo " + search_type + " matches were found\n")
+
+        sys.exit(1)
+
+
+    ##-----------------------------------------------------------------------
+    ## Save search index function
+    ##  Purpose: write the URL category entries and IP data group prefixes applied this run as the local search index
+    ##  Parameters:
+    ##      outputs         = output lists (see build_outputs)
+    ##      version         = applied version string
+    ##-----------------------------------------------------------------------
+    def save_search_index(self, outputs, version):
+        categories = {}
+        if self.output_url_categories:
+            for enabled, key, category_name in ((self.o365_categories_all, "all", o365_category),
+                                                (self.o365_categories_allow, "allow", o365_category_allow),
+                                                (self.o365_categories_optimize, "optimize", o365_category_optimized),
+                                                (self.o365_categories_default, "default", o365_category_default)):
+                if not enabled:
+                    continue
+
+                ## Index the host patterns (the category holds each one for http:// and https://), without the version marker
+                exact = []
+                glob = []
+                entries = self.url_category_entries(outputs[key], version)
+                for entry in entries:
+                    if entry.startswith("https://") and entry != "https://" + version + "/":
+                        if entries[entry] == "glob-match":
+                            glob.append(entry[8:-1])
+                        else:
+                            exact.append(entry[8:-1])
+                categories[category_name.replace("\\", "")] = {"exact": sorted(exact), "glob": sorted(glob)}
+
+        index = {
+            "instance": self.customer_endpoint,
+            "version": version,
+            "config_hash": self.get_outputs_hash(),
+            "categories": categories,
+            "networks": self.ip_datagroup_networks(outputs)
+        }
+        index_file = self.work_directory + "/o365_search_index.json.gz"
+        f = gzip.open(index_file + ".tmp", "wb")
+        f.write(json.dumps(index).encode('utf-8'))
+        f.close()
+        os.rename(index_file + ".tmp", index_file)
+
+
+    ##-----------------------------------------------------------------------
+    ## Read search index function
+    ##  Purpose: read the local search index (assumes config is loaded)
+    ##  Parameters: none
+    ##  Returns: index dictionary, or None if missing or stale (version or configuration changed since it was written)
+    ##-----------------------------------------------------------------------
+    def read_search_index(self):
+        index_file = self.work_directory + "/o365_search_index.json.gz"
+        try:
+            f = gzip.open(index_file, "rb")
+            index = json.loads(f.read().decode('utf-8'))
+            f.close()
+
+            f = open(self.work_directory + "/o365_version.txt", "r")
+            version = f.readline()
+            f.close()
+        except:
+            return None
+
+        if index["instance"] != self.customer_endpoint or index["version"] != version or index["config_hash"] != self.get_outputs_hash():
+            return None
+
+        return index
+
+
+    ##-----------------------------------------------------------------------
+    ## Load search index function
+    ##  Purpose: return the URL categories of the local search index (assumes config is loaded)
+    ##  Parameters: none
+    ##  Returns: urlSearchIndex, or None if missing or stale
+    ##-----------------------------------------------------------------------
+    def load_search_index(self):
+        index = self.read_search_index()
+        if index is None:
+            return None
+
+        ## The index holds host patterns - every category entry exists for http:// and https://
+        categories = {}
+        for name in index["categories"]:
+            categories[name] = {}
+            for match_type in ("exact", "glob"):
+                categories[name][match_type] = ["https://" + x for x in index["categories"][name][match_type]] + ["http://" + x for x in index["categories"][name][match_type]]
+
+        return urlSearchIndex(categories)
+
+
+    ##-----------------------------------------------------------------------
+    ## Live search index function
+    ##  Purpose: build a search index from the URL categories currently on the BIG-IP
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def live_search_index(self):
+        if self.work_directory != "":
+            self.executor.load_inventory()
+        categories = {}
+        for category_name in (o365_category, o365_category_allow, o365_category_optimized, o365_category_default):
+            entries = self.executor.url_category_entries(category_name) or {}
+            categories[category_name.replace("\\", "")] = {
+                "exact": [x.rstrip("/") for x in entries if entries[x] == "exact-match"],
+                "glob": [x.rstrip("/") for x in entries if entries[x] == "glob-match"]
+            }
+
+        return urlSearchIndex(categories)
+
+
+    ##-----------------------------------------------------------------------
+    ## URL parser function
+    ##  Purpose: clean up an return URLs submitted in JSON config
+    ##      - no http://
+    ##      - no https://
+    ##      - no trailing /
+    ##      - no wildcards (*)
+    ##      - remove resulting duplicates
+    ##  Prameters: URL list
+    ##-----------------------------------------------------------------------
+    def url_parser(self, urllist):
+        urlscleaned = []
+        for url in urllist:
+            ## convert all to lowercase
+            this_url = url.lower()
+
+            ## test for http://www.foo.com => convert to www.foo.com
+            if this_url.startswith("http://"):
+                this_url = this_url.replace("http://","")
+
+            ## test for https://www.foo.com => convert to www.foo.com
+            if this_url.startswith("https://"):
+                this_url = this_url.replace("https://","")
+
+            ## test for and remove trailing /
+            if this_url.endswith("/"):
+                this_url = this_url[:-1]
+
+            ## remove any wildcards (*)
+            this_url = this_url.replace("*","")
+
+            urlscleaned.append(this_url)
+
+        ## de-duplicate and return the remaining list
+        urlsdeduped = list(set(urlscleaned))
+        return urlsdeduped
+
+
+    ##-----------------------------------------------------------------------
+    ## Hash function
+    ##  Purpose: get the hash of a supplied parameter and return the hash value
+    ##  Parameters:
+    ##      jsonstr     = supplied JSON configuration
+    ##-----------------------------------------------------------------------
+    def get_hashedValue(self, input):
+        input.sort()
+        return hashlib.md5(str(input).encode('utf-8')).hexdigest()
+
+    ##-----------------------------------------------------------------------
+    ## JSON update function
+    ##  Purpose: update imported json data to include required attributes and/or defaults if keys are omitted
+    ##  Parameters:
+    ##      jsonstr     = supplied JSON configuration
+    ##-----------------------------------------------------------------------
+    def update_json(self, jsonstr):
+        json_data = copy.deepcopy(json_config_data)
+
+        ##status
+        if "status" in jsonstr:
+            if "description" in jsonstr["status"]:
+                json_data["status"]["description"] = jsonstr["status"]["description"]
+            else:
+                json_data["status"]["description"] = ""
+
+            if "last_run" in jsonstr["status"]:
+                json_data["status"]["last_run"] = jsonstr["status"]["last_run"]
+            else:
+                json_data["status"]["last_run"] = ""
+
+            if "next_run" in jsonstr["status"]:
+                json_data["status"]["next_run"] = jsonstr["status"]["next_run"]
+            else:
+                json_data["status"]["next_run"] = ""
+
+            if "last_hash_includedUrls" in jsonstr["status"]:
+                json_data["status"]["last_hash_includedUrls"] = jsonstr["status"]["last_hash_includedUrls"]
+            else:
+                json_data["status"]["last_hash_includedUrls"] = {}
+
+            if "last_hash_excludedUrls" in jsonstr["status"]:
+                json_data["status"]["last_hash_excludedUrls"] = jsonstr["status"]["last_hash_excludedUrls"]
+            else:
+                json_data["status"]["last_hash_excludedUrls"] = ""
+
+            if "last_hash_excludedIPs" in jsonstr["status"]:
+                json_data["status"]["last_hash_excludedIPs"] = jsonstr["status"]["last_hash_excludedIPs"]
+            else:
+                json_data["status"]["last_hash_excludedIPs"] = ""
+
+        ## endpoint
+        if "endpoint" in jsonstr:
+            json_data["endpoint"] = jsonstr["endpoint"]
+
+            ## Input validation: ensure value is one of: Worldwide, USGovDoD, USGovGCCHigh, China, or Germany
+            if json_data["endpoint"] not in {"Worldwide", "USGovDoD", "USGovGCCHigh", "China", "Germany"}:
+                raise Exception('Endpoint value must be one of: \"Worldwide\", \"USGovDoD\", \"USGovGCCHigh\", \"China\", or \"Germany\". [1014]')
+                sys.exit(1)
+
+        ## service_areas
+        if "service_areas" in jsonstr:
+
+            ## service_areas:common
+            if "common" in jsonstr["service_areas"]:
+                json_data["service_areas"]["common"] = jsonstr["service_areas"]["common"]
+
+                ## Input validation: ensure value is boolean
+                if type(json_data["service_areas"]["common"]) != bool:
+                    raise Exception('Service Areas "common" value must be a Boolean True or False. [1021]')
+                    sys.exit(1)
+            else:
+                ## Default True
+                json_data["service_areas"]["common"] = True
+
+            ## service_areas:exchange
+            if "exchange" in jsonstr["service_areas"]:
+                json_data["service_areas"]["exchange"] = jsonstr["service_areas"]["exchange"]
+
+                ## Input validation: ensure value is boolean
+                if type(json_data["service_areas"]["exchange"]) != bool:
+                    raise Exception('Service Areas "exchange" value must be a Boolean True or False. [1011]')
+                    sys.exit(1)
+            else:
+                ## Default False
+                json_data["service_areas"]["exchange"] = False
+
+            ## service_areas:sharepoint
+            if "sharepoint" in jsonstr["service_areas"]:
+                json_data["service_areas"]["sharepoint"] = jsonstr["service_areas"]["sharepoint"]
+
+                ## Input validation: ensure value is boolean
+                if type(json_data["service_areas"]["sharepoint"]) != bool:
+                    raise Exception('Service Areas "sharepoint" value must be a Boolean True or False. [1012]')
+                    sys.exit(1)
+            else:
+                ## Default False
+                json_data["service_areas"]["sharepoint"] = False
+
+            ## service_areas:skype
+            if "skype" in jsonstr["service_areas"]:
+                json_data["service_areas"]["skype"] = jsonstr["service_areas"]["skype"]
+
+                ## Input validation: ensure value is boolean
+                if type(json_data["service_areas"]["skype"]) != bool:
+                    raise Exception('Service Areas "skype" value must be a Boolean True or False. [1017]')
+                    sys.exit(1)
+            else:
+                ## Default False
+                json_data["service_areas"]["skype"] = False
+        else:
+            ## No service_areas block defined, set defaults
+            json_data["service_areas"]["common"] = True
+            json_data["service_areas"]["exchange"] = False
+            json_data["service_areas"]["sharepoint"] = False
+            json_data["service_areas"]["skype"] = False
+
+        ## outputs
+        if "outputs" in jsonstr:
+
+            ## outputs:url_categories
+            if "url_categories" in jsonstr["outputs"]:
+                json_data["outputs"]["url_categories"] = jsonstr["outputs"]["url_categories"]
+
+                ## Input validation: ensure value is boolean
+                if type(json_data["outputs"]["url_categories"]) != bool:
+                    raise Exception('Outputs "url_categories" value must be a Boolean True or False. [1019]')
+                    sys.exit(1)
+            else:
+                ## Default True
+                json_data["outputs"]["url_categories"] = True
+
+            ## outputs:url_datagroups
+            if "url_datagroups" in jsonstr["outputs"]:
+                json_data["outputs"]["url_datagroups"] = jsonstr["outputs"]["url_datagroups"]
+
+                ## Input validation: ensure value is boolean
+                if type(json_data["outputs"]["url_datagroups"]) != bool:
+                    raise Exception('Outputs "url_datagroups" value must be a Boolean True or False. [1010]')
+                    sys.exit(1)
+            else:
+                ## Default False
+                json_data["outputs"]["url_datagroups"] = False
+
+            ## outputs:ip_datagroups
+            if "ip_datagroups" in jsonstr["outputs"]:
+                json_data["outputs"]["ip_datagroups"] = jsonstr["outputs"]["ip_datagroups"]
+
+                ## Input validation: ensure value is boolean
+                if type(json_data["outputs"]["ip_datagroups"]) != bool:
+                    raise Exception('Outputs "ip_datagroups" value must be a Boolean True or False. [1037]')
+                    sys.exit(1)
+            else:
+                ## Default False
+                json_data["outputs"]["ip_datagroups"] = False
+
+        else:
+            ## No outputs block defined, set defaults
+            json_data["outputs"]["url_categories"] = True
+            json_data["outputs"]["url_datagroups"] = False
+            json_data["outputs"]["ip_datagroups"] = True
+
+        ## o365_categories
+        if "o365_categories" in jsonstr:
+
+            ## o365_categories:all
+            if "all" in jsonstr["o365_categories"]:
+                json_data["o365_categories"]["all"] = jsonstr["o365_categories"]["all"]
+
+                ## Input validation: ensure value is boolean
+                if type(json_data["o365_categories"]["all"]) != bool:
+                    raise Exception('O365 Categories "all" value must be a Boolean True or False. [1013]')
+                    sys.exit(1)
+            else:
+                ## Default True
+                json_data["o365_categories"]["all"] = True
+
+            ## o365_categories:optimize
+            if "optimize" in jsonstr["o365_categories"]:
+                json_data["o365_categories"]["optimize"] = jsonstr["o365_categories"]["optimize"]
+
+                ## Input validation: ensure value is boolean
+                if type(json_data["o365_categories"]["optimize"]) != bool:
+                    raise Exception('O365 Categories "optimize" value must be a Boolean True or False. [1026]')
+                    sys.exit(1)
+            else:
+                ## Default False
+                json_data["o365_categories"]["optimize"] = False
+
+            ## o365_categories:default
+            if "default" in jsonstr["o365_categories"]:
+                json_data["o365_categories"]["default"] = jsonstr["o365_categories"]["default"]
+
+                ## Input validation: ensure value is boolean
+                if type(json_data["o365_categories"]["default"]) != bool:
+                    raise Exception('O365 Categories "default" value must be a Boolean True or False. [1027]')
+                    sys.exit(1)
+            else:
+                ## Default False
+                json_data["o365_categories"]["default"] = False
+
+            ## o365_categories:allow
+            if "allow" in jsonstr["o365_categories"]:
+                json_data["o365_categories"]["allow"] = jsonstr["o365_categories"]["allow"]
+
+                ## Input validation: ensure value is boolean
+                if type(json_data["o365_categories"]["allow"]) != bool:
+                    raise Exception('O365 Categories "allow" value must be a Boolean True or False. [1028]')
+                    sys.exit(1)
+            else:
+                ## Default False
+                json_data["o365_categories"]["allow"] = False
+        else:
+            ## No o365_categories block defined, set defaults
+            json_data["o365_categories"]["all"] = True
+            json_data["o365_categories"]["optimize"] = False
+            json_data["o365_categories"]["default"] = False
+            json_data["o365_categories"]["allow"] = False
+
+        ## only_required
+        if "only_required" in jsonstr:
+            json_data["only_required"] = jsonstr["only_required"]
+
+            ## Input validation: ensure value is boolean
+            if type(json_data["only_required"]) != bool:
+                raise Exception('The "only_required" value must be a Boolean True or False. [1029]')
+                sys.exit(1)
+        else:
+            ## Default True
+            json_data["only_required"] = True
+
+        ## excluded_urls
+        if "excluded_urls" in jsonstr:
+            json_data["excluded_urls"] = self.url_parser(jsonstr["excluded_urls"])
+        else:
+            ## Default []
+            json_data["excluded_urls"] = []
+
+        ## included_urls
+        if "included_urls" in jsonstr:
+            #json_data["included_urls"] = jsonstr["included_urls"]
+            if "allow" in jsonstr["included_urls"]:
+                json_data["included_urls"]["allow"] = self.url_parser(jsonstr["included_urls"]["allow"])
+            if "optimized" in jsonstr["included_urls"]:
+                json_data["included_urls"]["optimized"] = self.url_parser(jsonstr["included_urls"]["optimized"])
+            if "default" in jsonstr["included_urls"]:
+                json_data["included_urls"]["default"] = self.url_parser(jsonstr["included_urls"]["default"])
+            if "all" in jsonstr["included_urls"]:
+                json_data["included_urls"]["all"] = self.url_parser(jsonstr["included_urls"]["all"])
+        else:
+            ## Default []
+            json_data["included_urls"] = {}
+            json_data["included_urls"]["allow"] = []
+            json_data["included_urls"]["optimized"] = []
+            json_data["included_urls"]["default"] = []
+            json_data["included_urls"]["all"] = []
+
+        ## excluded_ips
+        if "excluded_ips" in jsonstr:
+            json_data["excluded_ips"] = jsonstr["excluded_ips"]
+        else:
+            ## Default []
+            json_data["excluded_ips"] = []
+
+        ## system
+        if "system" in jsonstr:
+
+            ## system:log_level
+            if "log_level" in jsonstr["system"]:
+                json_data["system"]["log_level"] = jsonstr["system"]["log_level"]
+
+                ## Input validation: ensure value is an integer
+                if type(json_data["system"]["log_level"]) != int:
+                    raise Exception('The System "log level" value must be an integer between 0 and 2. [1018]')
+                    sys.exit(1)
+
+                ## Input validation: ensure value is an integer between 0 and 2
+                if json_data["system"]["log_level"] < 0 or json_data["system"]["log_level"] > 2:
+                    raise Exception('The System "log level" value must be an integer between 0 and 2. [1031]')
+                    sys.exit(1)
+            else:
+                ## Default 1
+                json_data["system"]["log_level"] = 1
+
+            ## system:ca_bundle
+            if "ca_bundle" in jsonstr["system"]:
+                json_data["system"]["ca_bundle"] = jsonstr["system"]["ca_bundle"]
+            else:
+                ## Default ca-bundle.crt
+                json_data["system"]["ca_bundle"] = "ca-bundle.crt"
+
+            ## system:working_directory
+            if "working_directory" in jsonstr["system"]:
+                json_data["system"]["working_directory"] = jsonstr["system"]["working_directory"]
+            else:
+                ## Default "/shared/o365"
+                json_data["system"]["working_directory"] = "/shared/o365"
+
+            ## system:retry_attempts
+            if "retry_attempts" in jsonstr["system"]:
+
+                ## Input validation: ensure value is an integer
+                if type(json_data["system"]["retry_attempts"]) != int:
+                    raise Exception('The System "retry_attempts" value must be an integer. [1040]')
+                    sys.exit(1)
+
+                ## Input validation: ensure value is an integer 0 or higher
+                if json_data["system"]["retry_attempts"] < 0:
+                    raise Exception('The System "retry_attemps" value must be an integer 0 or higher. A 0 value disables retry attempts. [1041]')
+                    sys.exit(1)
+
+                json_data["system"]["retry_attempts"] = jsonstr["system"]["retry_attempts"]
+            else:
+                ## Default 3 retry attempts
+                json_data["system"]["retry_attempts"] = 3
+
+            ## system:retry_delay
+            if "retry_delay" in jsonstr["system"]:
+
+                ## Input validation: ensure value is an integer
+                if type(json_data["system"]["retry_delay"]) != int:
+                    raise Exception('The System "retry_delay" value must be an integer. [1042]')
+                    sys.exit(1)
+
+                ## Input validation: ensure value is an integer 0 or higher
+                if json_data["system"]["retry_delay"] < 0:
+                    raise Exception('The System "retry_delay" value must be an integer 0 (seconds) or higher. [1043]')
+                    sys.exit(1)
+
+                json_data["system"]["retry_delay"] = jsonstr["system"]["retry_delay"]
+            else:
+                ## Default 300 seconds retry delay
+                json_data["system"]["retry_delay"] = 300
+
+            ## system:snapshot_retention
+            if "snapshot_retention" in jsonstr["system"]:
+                json_data["system"]["snapshot_retention"] = jsonstr["system"]["snapshot_retention"]
+
+                ## Input validation: ensure value is an integer 1 or higher
+                if type(json_data["system"]["snapshot_retention"]) != int or json_data["system"]["snapshot_retention"] < 1:
+                    raise Exception('The System "snapshot_retention" value must be an integer 1 or higher. [1044]')
+                    sys.exit(1)
+            else:
+                ## Default 5 snapshots
+                json_data["system"]["snapshot_retention"] = 5
+
+            ## system:poll_interval
+            if "poll_interval" in jsonstr["system"]:
+                json_data["system"]["poll_interval"] = jsonstr["system"]["poll_interval"]
+
+                ## Input validation: ensure value is an integer 60 (seconds) or higher
+                if type(json_data["system"]["poll_interval"]) != int or json_data["system"]["poll_interval"] < 60:
+                    raise Exception('The System "poll_interval" value must be an integer 60 (seconds) or higher. [1046]')
+                    sys.exit(1)
+            else:
+                ## Default 300 seconds poll interval
+                json_data["system"]["poll_interval"] = 300
+
+            ## system:backend
+            if "backend" in jsonstr["system"]:
+                json_data["system"]["backend"] = jsonstr["system"]["backend"]
+
+                ## Input validation: ensure value is tmsh or rest
+                if json_data["system"]["backend"] not in ("tmsh", "rest"):
+                    raise Exception('The System "backend" value must be "tmsh" or "rest". [1047]')
+                    sys.exit(1)
+            else:
+                ## Default tmsh backend
+                json_data["system"]["backend"] = "tmsh"
+
+            ## system:rest_url
+            if "rest_url" in jsonstr["system"]:
+                json_data["system"]["rest_url"] = jsonstr["system"]["rest_url"]
+
+                ## Input validation: ensure value is an http(s) URL
+                if not re.match(r"^https?://[^:/]+(:\d+)?/?$", str(json_data["system"]["rest_url"])):
+                    raise Exception('The System "rest_url" value must be an http:// or https:// URL (ex. http://localhost:8100). [1048]')
+                    sys.exit(1)
+            else:
+                ## Default local iControl REST port
+                json_data["system"]["rest_url"] = "http://localhost:8100"
+
+            ## system:url_chunk_size
+            if "url_chunk_size" in jsonstr["system"]:
+                json_data["system"]["url_chunk_size"] = jsonstr["system"]["url_chunk_size"]
+
+                ## Input validation: ensure value is an integer 100 or higher
+                if type(json_data["system"]["url_chunk_size"]) != int or json_data["system"]["url_chunk_size"] < 100:
+                    raise Exception('The System "url_chunk_size" value must be an integer 100 or higher. [1049]')
+                    sys.exit(1)
+            else:
+                ## Default 5000 entries per command
+                json_data["system"]["url_chunk_size"] = 5000
+
+            ## system:apply_mode
+            if "apply_mode" in jsonstr["system"]:
+                json_data["system"]["apply_mode"] = jsonstr["system"]["apply_mode"]
+
+                ## Input validation: ensure value is direct or staged
+                if json_data["system"]["apply_mode"] not in ("direct", "staged"):
+                    raise Exception('The System "apply_mode" value must be "direct" or "staged". [1050]')
+                    sys.exit(1)
+            else:
+                ## Default direct apply
+                json_data["system"]["apply_mode"] = "direct"
+
+            ## system:log_max_size
+            if "log_max_size" in jsonstr["system"]:
+                json_data["system"]["log_max_size"] = jsonstr["system"]["log_max_size"]
+
+                ## Input validation: ensure value is an integer 1 (MB) or higher
+                if type(json_data["system"]["log_max_size"]) != int or json_data["system"]["log_max_size"] < 1:
+                    raise Exception('The System "log_max_size" value must be an integer 1 (MB) or higher. [1051]')
+                    sys.exit(1)
+            else:
+                ## Default 10 MB
+                json_data["system"]["log_max_size"] = 10
+
+            ## system:log_max_age
+            if "log_max_age" in jsonstr["system"]:
+                json_data["system"]["log_max_age"] = jsonstr["system"]["log_max_age"]
+
+                ## Input validation: ensure value is an integer 0 (days) or higher
+                if type(json_data["system"]["log_max_age"]) != int or json_data["system"]["log_max_age"] < 0:
+                    raise Exception('The System "log_max_age" value must be an integer 0 (days) or higher. [1052]')
+                    sys.exit(1)
+            else:
+                ## Default 30 days
+                json_data["system"]["log_max_age"] = 30
+
+            ## system:log_keep
+            if "log_keep" in jsonstr["system"]:
+                json_data["system"]["log_keep"] = jsonstr["system"]["log_keep"]
+
+                ## Input validation: ensure value is an integer 1 or higher
+                if type(json_data["system"]["log_keep"]) != int or json_data["system"]["log_keep"] < 1:
+                    raise Exception('The System "log_keep" value must be an integer 1 or higher. [1053]')
+                    sys.exit(1)
+            else:
+                ## Default 5 rotated files
+                json_data["system"]["log_keep"] = 5
+
+            ## system:log_format
+            if "log_format" in jsonstr["system"]:
+                json_data["system"]["log_format"] = jsonstr["system"]["log_format"]
+
+                ## Input validation: ensure value is text or json
+                if json_data["system"]["log_format"] not in ("text", "json"):
+                    raise Exception('The System "log_format" value must be "text" or "json". [1054]')
+                    sys.exit(1)
+            else:
+                ## Default text
+                json_data["system"]["log_format"] = "text"
+
+            ## system:history_keep
+            if "history_keep" in jsonstr["system"]:
+                json_data["system"]["history_keep"] = jsonstr["system"]["history_keep"]
+
+                ## Input validation: ensure value is an integer 1 or higher
+                if type(json_data["system"]["history_keep"]) != int or json_data["system"]["history_keep"] < 1:
+                    raise Exception('The System "history_keep" value must be an integer 1 or higher. [1055]')
+                    sys.exit(1)
+            else:
+                ## Default 500 runs
+                json_data["system"]["history_keep"] = 500
+
+        else:
+            ## No system block defined, set defaults
+            json_data["system"]["log_level"] = 1
+            json_data["system"]["ca_bundle"] = "ca-bundle.crt"
+            json_data["system"]["working_directory"] = "/shared/o365"
+            json_data["system"]["retry_attempts"] = 3
+            json_data["system"]["retry_delay"] = 300
+            json_data["system"]["snapshot_retention"] = 5
+            json_data["system"]["poll_interval"] = 300
+            json_data["system"]["backend"] = "tmsh"
+            json_data["system"]["rest_url"] = "http://localhost:8100"
+            json_data["system"]["url_chunk_size"] = 5000
+            json_data["system"]["apply_mode"] = "direct"
+            json_data["system"]["log_max_size"] = 10
+            json_data["system"]["log_max_age"] = 30
+            json_data["system"]["log_keep"] = 5
+            json_data["system"]["log_format"] = "text"
+            json_data["system"]["history_keep"] = 500
+
+        ## schedule
+        if "schedule" in jsonstr:
+
+            ## schedule:periods
+            if "periods" in jsonstr["schedule"]:
+                json_data["schedule"]["periods"] = jsonstr["schedule"]["periods"]
+
+                ## Input validation: ensure value is one of: monthly, weekly
+                if json_data["schedule"]["periods"] not in {"monthly", "weekly", "daily", "none"}:
+                    raise Exception('The Schedule "periods" value must be one of: \"monthly\", \"weekly\", \"daily\", or \"none\". [1020]')
+                    sys.exit(1)
+            else:
+                ## Default none
+                json_data["schedule"]["periods"] = "none"
+
+            ## schedule:run_date
+            if "run_date" in jsonstr["schedule"]:
+                json_data["schedule"]["run_date"] = jsonstr["schedule"]["run_date"]
+
+                if json_data["schedule"]["run_date"] == "":
+                    ## Value empty, set default 1
+                    json_data["schedule"]["run_date"] = 1
+
+                ## Input validation: validate weekly/monthly values
+                elif json_data["schedule"]["periods"] == "monthly":
+                    ## Input validation: ensure run_date is an integer
+                    if type(json_data["schedule"]["run_date"]) != int:
+                        raise Exception('Schedule "run_date" value for period(monthly) must be an integer between 1 and 31. [1016]')
+                        sys.exit(1)
+
+                    ## Input validation: ensure monthly run_date is a value between 1 and 31
+                    if json_data["schedule"]["run_date"] <= 0 or json_data["schedule"]["run_date"] > 31:
+                        raise Exception('Schedule "run_date" value for period(monthly) must be an integer between 1 and 31. [1008]')
+                        sys.exit(1)
+
+                elif json_data["schedule"]["periods"] == "weekly":
+                    ## Input validation: ensure run_date is an integer
+                    if type(json_data["schedule"]["run_date"]) != int:
+                        raise Exception('Schedule "run_date" value for period(weekly) must be an integer between 0 (Sunday) and 6 (Saturday). [1025]')
+                        sys.exit(1)
+
+                    ## Input validation: ensure weekly run_date is a value between 1 and 7
+                    if json_data["schedule"]["run_date"] < 0 or json_data["schedule"]["run_date"] > 6:
+                        raise Exception('Schedule "run_date" value for period(weekly) must be an integer between 0 (Sunday) and 6 (Saturday). [1030]')
+                        sys.exit(1)
+
+            else:
+                ## Default 1
+                json_data["schedule"]["run_date"] = 1
+
+            ## schedule:run_time
+            if "run_time" in jsonstr["schedule"]:
+                json_data["schedule"]["run_time"] = jsonstr["schedule"]["run_time"]
+
+                if json_data["schedule"]["run_time"] == "":
+                    ## Value empty, set default "04:00"
+                    json_data["schedule"]["run_time"] = "04:00"
+
+                ## Input validation: ensure correct time format
+                elif not re.match(r"[0-9]{1,2}:[0-9]{2}", json_data["schedule"]["run_time"]):
+                    raise Exception('Schedule "run_time" value must be a valid 24-hour time (ex. 14:30). [1033]')
+                    sys.exit(1)
+
+                ## Input validation: ensure first number (hour) between 0 and 23, and second number (minutes) between 0 and 59
+                this_time = json_data["schedule"]["run_time"].split(":")
+                if int(this_time[0]) < 0 or int(this_time[0]) > 23:
+                    raise Exception('Schedule "run_time" hour value must be a valid 24-hour integer between 0 and 23. [1038]')
+                    sys.exit(1)
+                if int(this_time[1]) < 0 or int(this_time[1]) > 59:
+                    raise Exception('Schedule "run_time" minute value must be a valid integer between 0 and 59. [1022]')
+                    sys.exit(1)
+            else:
+                ## Default "04:00"
+                json_data["schedule"]["run_time"] = "04:00"
+
+            ## schedule:start_date
+            if "start_date" in jsonstr["schedule"]:
+                json_data["schedule"]["start_date"] = jsonstr["schedule"]["start_date"]
+
+                if json_data["schedule"]["start_date"] == "":
+                    pass
+
+                ## Input validation: ensure correct m/d/Y format
+                elif not re.match(r"[0-9]{1,2}\/[0-9]{1,2}\/[0-9]{4}", json_data["schedule"]["start_date"]):
+                    raise Exception('Schedule "start_date" value must be in month/day/year format (ex. 03/29/2021). [1023]')
+                    sys.exit(1)
+            else:
+                ## Default ""
+                json_data["schedule"]["start_date"] = ""
+
+            ## schedule:start_time
+            if "start_time" in jsonstr["schedule"]:
+                json_data["schedule"]["start_time"] = jsonstr["schedule"]["start_time"]
+
+                if json_data["schedule"]["start_time"] == "":
+                    pass
+
+                ## Input validation: ensure correct time format
+                elif not re.match(r"[0-9]{1,2}:[0-9]{2}", json_data["schedule"]["start_time"]):
+                    raise Exception('Schedule "start_time" value must be a valid 24-hour time (ex. 14:30). [1034]')
+                    sys.exit(1)
+
+                ## Input validation: ensure first number (hour) between 0 and 23, and second number (minutes) between 0 and 59
+                else:
+                    this_time = json_data["schedule"]["start_time"].split(":")
+                    if int(this_time[0]) < 0 or int(this_time[0]) > 23:
+                        raise Exception('Schedule "start_time" hour value must be a valid 24-hour integer between 0 and 23. [1035]')
+                        sys.exit(1)
+                    if int(this_time[1]) < 0 or int(this_time[1]) > 59:
+                        raise Exception('Schedule "start_time" minute value must be a valid integer between 0 and 59. [1036]')
+                        sys.exit(1)
+            else:
+                ## Default ""
+                json_data["schedule"]["start_time"] = ""
+        else:
+            ## No schedule block defined, set defaults
+            json_data["schedule"]["periods"] = "none"
+            json_data["schedule"]["run_date"] = 1
+            json_data["schedule"]["run_time"] = "04:00"
+            json_data["schedule"]["start_date"] = ""
+            json_data["schedule"]["start_time"] = ""
+
+        return(json_data)
+
+
+    ##-----------------------------------------------------------------------
+    ## addLastRun function
+    ##  Purpose: record last_run information for the run. Status changes are buffered in memory and
+    ##  written once at the end of the run (see commit_status).
+    ##  Parameters:
+    ##      datestr                 = datetime string
+    ##      reason                  = message to insert
+    ##      isHashedValuesChanged   = also record the updated configuration hashes
+    ##      updatedHashedValues     = status dictionary holding the updated hashes
+    ##-----------------------------------------------------------------------
+    def addLastRun(self, datestr, reason, isHashedValuesChanged=False, updatedHashedValues={}):
+        if self.status_pending is None:
+            self.status_pending = {}
+
+        #if URl updates are successful and hashvalues are changed from last run then update these new hashed values in json
+        if isHashedValuesChanged:
+            for key in ("last_hash_includedUrls", "last_hash_excludedUrls", "last_hash_excludedIPs"):
+                self.status_pending[key] = updatedHashedValues[key]
+
+        self.status_pending["last_run"] = str(datestr)
+        self.status_pending["description"] = reason
+
+
+    ##-----------------------------------------------------------------------
+    ## Commit status function
+    ##  Purpose: write the buffered last_run information (assumes config is loaded). The status is always
+    ##  kept in the local status file; the configuration iFile is only modified when the status changes
+    ##  other than the last_run time (ex. a new description or new configuration hashes), so repeated
+    ##  "update bypassed" runs don't create a new iFile revision every time.
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def commit_status(self):
+        if self.status_pending is None:
+            return
+        pending = self.status_pending
+        self.status_pending = None
+
+        ## Get JSON data from the latest configuration iFile and update with last_run information
+        o365_config, config_data = self.config_loader.load()
+        config_data = copy.deepcopy(config_data)
+
+        ## Run metrics change on every run - they are only kept in the local status file
+        metrics = pending.pop("metrics", None)
+        changed = [x for x in pending if x != "last_run" and config_data["status"].get(x) != pending[x]]
+        config_data["status"].update(pending)
+
+        ## Local status file - read by --printconfig for the last_run time and metrics
+        local_status = dict(config_data["status"])
+        if metrics is not None:
+            local_status["metrics"] = metrics
+        f = open(self.work_directory + "/o365_status.json", "w")
+        f.write(json.dumps(local_status))
+        f.flush()
+        f.close()
+
+        if not changed:
+            self.log(2, self.log_level, self.logdir, "Status unchanged except last_run. Configuration iFile not modified.")
+            return
+
+        ## Convert updated JSON data to formatted string
+        json_config_final = json.dumps(config_data, indent = 4)
+
+        ## Write updated JSON data to a temporary file
+        with open(config_data["system"]["working_directory"] + "/config.json", "w") as outfile:
+            outfile.write(json_config_final)
+
+        ## Update the ifile configuration / delete temporary file (own executor - never submits the run's pending changes)
+        executor = self.create_executor()
+        executor.add("modify sys file ifile o365_update.app/o365_config.json source-path file:" + config_data["system"]["working_directory"] + "/config.json", config_data["system"]["working_directory"] + "/config.json")
+        executor.submit()
+        self.config_loader.invalidate()
+
+
+    ##-----------------------------------------------------------------------
+    ## Add timing function
+    ##  Purpose: add the time since start to a phase of the current run (see commit_metrics)
+    ##  Parameters:
+    ##      phase           = phase name (ex. "endpoints_fetch")
+    ##      start           = time.time() at the start of the phase
+    ##-----------------------------------------------------------------------
+    def add_timing(self, phase, start):
+        self.timings[phase] = self.timings.get(phase, 0) + time.time() - start
+
+
+    ##-----------------------------------------------------------------------
+    ## Commit metrics function
+    ##  Purpose: add the phase timings and per-object entry counts/timings of the run to the run status,
+    ##  and write them as a Prometheus textfile (o365_update.prom in the working directory)
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def commit_metrics(self):
+        if self.work_directory == "" or not self.timings:
+            return
+
+        objects = {}
+        for name in set(list(self.planned) + list(self.object_seconds)):
+            ## Counts that couldn't be determined (ex. data group filestore not readable) are left out
+            objects[name] = dict([(x, y) for x, y in self.planned.get(name, {}).items() if y is not None and x != "load"])
+            for step, seconds in self.object_seconds.get(name, {}).items():
+                objects[name][step + "_seconds"] = round(seconds, 3)
+
+        metrics = {
+            "result": self.run_result,
+            "phases": dict([(x, round(self.timings[x], 3)) for x in self.timings]),
+            "objects": objects
+        }
+        if self.status_pending is None:
+            self.status_pending = {}
+        self.status_pending["metrics"] = metrics
+
+        def label(value):
+            return value.replace("\\", "\\\\").replace("\"", "\\\"")
+
+        lines = ["# HELP o365_update_last_run_timestamp_seconds Time of the last update run.",
+                 "# TYPE o365_update_last_run_timestamp_seconds gauge",
+                 "o365_update_last_run_timestamp_seconds %d" % time.time(),
+                 "# HELP o365_update_last_run_result Result of the last update run (1 for the current result).",
+                 "# TYPE o365_update_last_run_result gauge"]
+        for result in ("updated", "bypassed", "failed"):
+            lines.append("o365_update_last_run_result{result=\"%s\"} %d" % (result, result == self.run_result))
+
+        lines += ["# HELP o365_update_phase_seconds Duration of each phase of the last update run.",
+                  "# TYPE o365_update_phase_seconds gauge"]
+        for phase in sorted(self.timings):
+            lines.append("o365_update_phase_seconds{phase=\"%s\"} %.3f" % (phase, self.timings[phase]))
+
+        lines += ["# HELP o365_update_object_seconds Duration of the generate and apply steps of each output object.",
+                  "# TYPE o365_update_object_seconds gauge"]
+        for name in sorted(objects):
+            for step in ("generate", "apply"):
+                if step + "_seconds" in objects[name]:
+                    lines.append("o365_update_object_seconds{object=\"%s\",step=\"%s\"} %.3f" % (label(name), step, objects[name][step + "_seconds"]))
+
+        for key, description in (("entries", "Entries of each output object."), ("added", "Entries added to each output object."), ("removed", "Entries removed from each output object.")):
+            lines += ["# HELP o365_update_object_" + key + " " + description,
+                      "# TYPE o365_update_object_" + key + " gauge"]
+            for name in sorted(objects):
+                if objects[name].get(key) is not None:
+                    lines.append("o365_update_object_%s{object=\"%s\"} %d" % (key, label(name), objects[name][key]))
+
+        ## Written to a temporary file and renamed, so a collector never reads a partial file
+        metrics_file = self.work_directory + "/o365_update.prom"
+        f = open(metrics_file + ".tmp", "w")
+        f.write("\n".join(lines) + "\n")
+        f.flush()
+        f.close()
+        os.rename(metrics_file + ".tmp", metrics_file)
+
+
+    ##-----------------------------------------------------------------------
+    ## Commit history function
+    ##  Purpose: append the run (versions, trigger, result, phase timings, per-object entry counts and
+    ##  deltas) to the run history (o365_history.jsonl in the working directory), keeping history_keep runs
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def commit_history(self):
+        if self.work_directory == "" or self.status_pending is None or "metrics" not in self.status_pending:
+            return
+
+        metrics = self.status_pending["metrics"]
+        objects = metrics["objects"]
+        record = {
+            "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "trigger": self.trigger,
+            "instance": self.customer_endpoint,
+            "version_previous": self.run_versions.get("previous", ""),
+            "version": self.run_versions.get("latest", ""),
+            "result": metrics["result"],
+            "description": self.status_pending.get("description", ""),
+            "phases": metrics["phases"],
+            "objects": objects
+        }
+        for key in ("entries", "added", "removed"):
+            record[key] = sum([objects[x][key] for x in objects if objects[x].get(key) is not None])
+
+        history_file = self.work_directory + "/o365_history.jsonl"
+        try:
+            f = open(history_file, "a")
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+            f.close()
+
+            ## Trimmed in batches (10% over history_keep), so the file is only rewritten every few runs
+            f = open(history_file, "r")
+            lines = f.readlines()
+            f.close()
+            if len(lines) > self.history_keep + max(10, self.history_keep // 10):
+                f = open(history_file + ".tmp", "w")
+                f.writelines(lines[-self.history_keep:])
+                f.close()
+                os.rename(history_file + ".tmp", history_file)
+        except Exception as e:
+            self.log(1, self.log_level, self.logdir, "Run history could not be written: " + str(e))
+
+
+    ##-----------------------------------------------------------------------
+    ## Read history function
+    ##  Purpose: return the runs of the run history, oldest first (unreadable lines are skipped)
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def read_history(self):
+        runs = []
+        try:
+            f = open(self.work_directory + "/o365_history.jsonl", "r")
+        except:
+            return runs
+
+        for line in f:
+            try:
+                runs.append(json.loads(line))
+            except:
+                pass
+        f.close()
+        return runs
+
+
+    ##-----------------------------------------------------------------------
+    ## Print history function
+    ##  Purpose: print the last runs of the run history, and for the table format, the trends of the
+    ##  apply time and entry counts over these runs
+    ##  Parameters:
+    ##      count           = number of runs (0 for all)
+    ##      output_format   = table, csv or json (one run per line)
+    ##  Example: --history 50 --format csv
+    ##-----------------------------------------------------------------------
+    def print_history(self, count, output_format):
+        self.get_config()
+        runs = self.read_history()
+        if count > 0:
+            runs = runs[-count:]
+
+        if output_format == "json":
+            for run in runs:
+                print(json.dumps(run, sort_keys=True))
+            sys.exit(0)
+
+        columns = ["time", "trigger", "result", "version", "total_seconds", "apply_seconds", "entries", "added", "removed"]
+        rows = []
+        for run in runs:
+            phases = run.get("phases", {})
+            rows.append([run.get("time", ""), run.get("trigger", ""), run.get("result", ""), run.get("version", ""),
+                         "%.1f" % phases.get("total", 0), "%.1f" % (phases.get("apply", 0) + phases.get("switch", 0)),
+                         run.get("entries", 0), run.get("added", 0), run.get("removed", 0)])
+
+        if output_format == "csv":
+            writer = csv.writer(sys.stdout)
+            writer.writerow(columns)
+            writer.writerows(rows)
+            sys.exit(0)
+
+        if not runs:
+            print("No run history in " + self.work_directory + "/o365_history.jsonl")
+            sys.exit(0)
+
+        print("\n%-19s  %-7s  %-8s  %-10s  %8s  %8s  %8s  %8s  %8s" % ("time", "trigger", "result", "version", "total s", "apply s", "entries", "added", "removed"))
+        for row in rows:
+            print("%-19s  %-7s  %-8s  %-10s  %8s  %8s  %8s  %8s  %8s" % tuple(row))
+
+        ## Trends
+        results = [run.get("result", "") for run in runs]
+        triggers = [run.get("trigger", "") for run in runs]
+        print("\nRuns: %d from %s to %s (updated %d, bypassed %d, failed %d)" % (len(runs), runs[0].get("time", ""), runs[-1].get("time", ""), results.count("updated"), results.count("bypassed"), results.count("failed")))
+        print("Triggers: " + ", ".join(["%s %d" % (x, triggers.count(x)) for x in sorted(set(triggers))]))
+
+        updated = [run for run in runs if run.get("result") == "updated"]
+        if updated:
+            applies = [run.get("phases", {}).get("apply", 0) + run.get("phases", {}).get("switch", 0) for run in updated]
+            slowest = updated[applies.index(max(applies))]
+            print("Apply seconds (updated runs): avg %.1f, min %.1f, max %.1f (%s, version %s)" % (sum(applies) / len(applies), min(applies), max(applies), slowest.get("time", ""), slowest.get("version", "")))
+            changed = sum([run.get("added", 0) + run.get("removed", 0) for run in updated])
+            if changed > 0:
+                print("Apply seconds per 1000 changed entries: %.2f" % (sum(applies) * 1000.0 / changed))
+
+        ## Entry growth per object, from the first to the last run that reported it
+        first = {}
+        last = {}
+        for run in runs:
+            for name, entry in run.get("objects", {}).items():
+                if entry.get("entries") is not None:
+                    first.setdefault(name, entry["entries"])
+                    last[name] = entry["entries"]
+        if last:
+            print("Entries (first -> last run):")
+            for name in sorted(last):
+                print("  %-32s %8d -> %-8d (%+d)" % (name, first[name], last[name], last[name] - first[name]))
+        print("")
+        sys.exit(0)
+
+
+    ##-----------------------------------------------------------------------
+    ## Create URL categories function
+    ##  Purpose: creates O365 URL categories from supplied URL information. Existing categories are
+    ##  updated in place with only the added and removed entries, compared against the local manifest
+    ##  of the applied entries (or the live category if there is no manifest).
+    ##  Parameters:
+    ##      url_file        = name of the URL category
+    ##      url_list        = list of URLs
+    ##      version_latest  = latest version string
+    ##  Example:
+    ##      self.create_url_categories (o365_category, urls_undup, ms_o365_version_latest)
+    ##-----------------------------------------------------------------------
+    def create_url_categories (self, url_file, url_list, version_latest):
+        ## Desired entries - the latest version as a marker entry, plus every URL for http:// and https://
+        entries = self.url_category_entries(url_list, version_latest)
+
+        if not self.executor.exists("sys application service o365_update.app/o365_update"):
+            self.executor.add("create sys application service o365_update traffic-group traffic-group-local-only device-group none")
+            self.log(2, self.log_level, self.logdir, "Application service not found. Creating o365_update.app/o365_update")
+
+        ## Currently applied entries - from the manifest, otherwise read from the live category. The manifest
+        ## is ignored when the category no longer exists (ex. deleted, UCS restore, failover to a peer).
+        current = None
+        if self.executor.exists("sys url-db url-category o365_update.app/" + url_file):
+            current = self.load_manifest(url_file)
+        if current is None:
+            current = self.executor.url_category_entries(url_file)
+            if current is None:
+                self.url_category_commands(url_file, entries, sorted(entries), [], create=True)
+                self.planned[url_file.replace("\\", "")] = {"entries": len(entries), "added": len(entries), "removed": 0, "load": len(entries)}
+                self.log(2, self.log_level, self.logdir, "O365 custom URL category (" + url_file + ") not found. Created new O365 custom category.")
+                self.manifests_pending[url_file] = entries
+                return
+
+        ## Add before delete, in one command, so the category is never emptied
+        added = sorted([x for x in entries if x not in current])
+        removed = sorted([x for x in current if x not in entries])
+        self.manifests_pending[url_file] = entries
+        self.planned[url_file.replace("\\", "")] = {"entries": len(entries), "added": len(added), "removed": len(removed), "load": len(added) + len(removed)}
+        if not added and not removed:
+            self.log(2, self.log_level, self.logdir, "O365 custom URL category (" + url_file + ") is up to date.")
+            return
+
+        self.url_category_commands(url_file, entries, added, removed)
+        self.log(2, self.log_level, self.logdir, "O365 custom URL category (" + url_file + ") exists. Adding " + str(len(added)) + " and removing " + str(len(removed)) + " entries.")
+
+
+    ##-----------------------------------------------------------------------
+    ## URL category commands function
+    ##  Purpose: queue the changes to a URL category as tmsh commands of at most url_chunk_size entries
+    ##  each, so large categories stay within tmsh/argv limits. Additions are queued before deletions so
+    ##  the category is never emptied, and the first chunk of a new category creates it. In staged mode
+    ##  the commands are queued for the switch transaction.
+    ##  Parameters:
+    ##      url_file        = name of the URL category
+    ##      entries         = desired URL category entries ({url: type})
+    ##      added           = sorted entry URLs to add
+    ##      removed         = sorted entry URLs to delete
+    ##      create          = create the category with the first chunk (replace-all-with)
+    ##-----------------------------------------------------------------------
+    def url_category_commands(self, url_file, entries, added, removed, create=False):
+        ## Staged mode - the categories change in the switch transaction
+        executor = self.switch or self.executor
+        name = "/sys url-db url-category o365_update.app/" + url_file
+        chunks = [("add", added[i:i + self.url_chunk_size]) for i in range(0, len(added), self.url_chunk_size)]
+        chunks += [("delete", removed[i:i + self.url_chunk_size]) for i in range(0, len(removed), self.url_chunk_size)]
+
+        for index, (operation, urls) in enumerate(chunks):
+            start = time.time()
+            if operation == "add":
+                items = self.url_category_items(entries, urls)
+            else:
+                items = "".join([" \"" + x.replace("*", "\\*") + "\"" for x in urls])
+
+            if index == 0:
+                ## Category properties are only set once
+                command = [("create " if create else "modify ") + name, " display-name ", url_file, " app-service o365_update.app/o365_update urls ", "replace-all-with" if create else operation, " {", items, " } default-action allow"]
+            else:
+                command = ["modify ", name, " urls ", operation, " {", items, " }"]
+            command = "".join(command)
+            executor.add(command)
+
+            self.log(2, self.log_level, self.logdir, "O365 custom URL category (" + url_file + ") chunk " + str(index + 1) + "/" + str(len(chunks)) + ": " + operation + " " + str(len(urls)) + " entries, " + str(len(command)) + " bytes, built in " + "%.3f" % (time.time() - start) + " seconds.")
+
+
+    ##-----------------------------------------------------------------------
+    ## URL category entries function
+    ##  Purpose: convert a URL list into URL category entries ({"https://www.foo.com/": "exact-match", ...})
+    ##  Parameters:
+    ##      url_list        = list of URLs
+    ##      version_latest  = latest version string (added as an exact-match marker entry)
+    ##-----------------------------------------------------------------------
+    def url_category_entries(self, url_list, version_latest):
+        entries = {"https://" + version_latest + "/": "exact-match"}
+        for url in url_list:
+            ## Force URL to lower case
+            url = url.lower()
+
+            ## Add * if url starts with "." (if a wildcard included_url is added)
+            if url.startswith("."):
+                url = "*" + url
+
+            ## If URL starts with an asterisk, set as a glob-match URL, otherwise exact-match
+            if ('*' in url):
+                url_type = "glob-match"
+            else:
+                url_type = "exact-match"
+            entries["https://" + url + "/"] = url_type
+            entries["http://" + url + "/"] = url_type
+
+        return entries
+
+
+    ##-----------------------------------------------------------------------
+    ## URL category items function
+    ##  Purpose: format URL category entries as tmsh collection items (asterisks escaped)
+    ##  Parameters:
+    ##      entries         = URL category entries ({url: type})
+    ##      urls            = the entry URLs to format
+    ##-----------------------------------------------------------------------
+    def url_category_items(self, entries, urls):
+        return "".join([" \"" + x.replace("*", "\\*") + "\" { type " + entries[x] + " }" for x in urls])
+
+
+    ##-----------------------------------------------------------------------
+    ## Parse URL category function
+    ##  Purpose: read the entries of a URL category from "tmsh list sys url-db url-category" output
+    ##  Parameters:
+    ##      result          = tmsh list output
+    ##-----------------------------------------------------------------------
+    def parse_url_category(self, result):
+        entries = {}
+        this_url = ""
+        for line in result.splitlines():
+            match = re.match(r'^\s+"?(https?://[^"\s]+)"?\s+\{', line)
+            if match:
+                this_url = match.group(1).replace("\\", "")
+                entries[this_url] = "exact-match"
+            elif this_url != "" and re.match(r'^\s+type\s+glob-match', line):
+                entries[this_url] = "glob-match"
+
+        return entries
+
+
+    ##-----------------------------------------------------------------------
+    ## Load manifest function
+    ##  Purpose: read the local manifest of the entries applied to a URL category
+    ##  Parameters:
+    ##      url_file        = name of the URL category
+    ##  Returns: URL category entries ({url: type}), or None if there is no manifest
+    ##-----------------------------------------------------------------------
+    def load_manifest(self, url_file):
+        manifest_file = self.work_directory + "/manifests/" + url_file.replace("\\", "") + ".json"
+        if not os.path.isfile(manifest_file):
+            return None
+
+        try:
+            f = open(manifest_file, "r")
+            f_content = f.read()
+            f.close()
+            return json.loads(f_content)
+        except:
+            return None
+
+
+    ##-----------------------------------------------------------------------
+    ## Commit manifests function
+    ##  Purpose: write (applied) or discard (failed) the manifests of the URL categories planned this run
+    ##  Parameters:
+    ##      applied         = True if the planned commands were applied successfully
+    ##-----------------------------------------------------------------------
+    def commit_manifests(self, applied):
+        manifest_dir = self.work_directory + "/manifests"
+        if not os.path.isdir(manifest_dir):
+            os.mkdir(manifest_dir)
+
+        for url_file in self.manifests_pending:
+            manifest_file = manifest_dir + "/" + url_file.replace("\\", "") + ".json"
+            if applied and self.load_manifest(url_file) == self.manifests_pending[url_file]:
+                ## Unchanged (ex. --force or a configuration-only run) - the previous generation stays the rollback target
+                continue
+            elif applied:
+                ## The previous generation of the entries is kept for --rollback
+                if os.path.isfile(manifest_file):
+                    os.rename(manifest_file, manifest_dir + "/" + url_file.replace("\\", "") + ".previous.json")
+                f = open(manifest_file, "w")
+                f.write(json.dumps(self.manifests_pending[url_file]))
+                f.flush()
+                f.close()
+            elif os.path.isfile(manifest_file):
+                ## Unknown state - the next run reads the live category
+                os.remove(manifest_file)
+
+        self.manifests_pending = {}
+
+
+    ##-----------------------------------------------------------------------
+    ## Create URL datagroups function
+    ##  Purpose: creates O365 URL datagroups from supplied URL information
+    ##  Parameters:
+    ##      url_file        = name of the URL datagroup
+    ##      url_list        = list of URLs
+    ##  Example:
+    ##      self.create_url_datagroups (o365_dg, urls_undup)
+    ##-----------------------------------------------------------------------
+    def create_url_datagroups (self, url_file, url_list):
+        ## Write data to a file for import into data group
+        fout = open(self.work_directory + "/" + url_file, 'w')
+        for url in (list(sorted(set(url_list)))):
+            ## Replace any asterisk characters with a dot
+            url_processed = re.sub('\*', '', url)
+            fout.write("\"" + str(url_processed.lower()) + "\" := \"\",\n")
+        fout.flush()
+        fout.close()
+        self.plan_datagroup(url_file)
+
+        ## Create URL data group files in TMSH if they don't already exist
+        if not self.executor.exists("sys application service o365_update.app/o365_update"):
+            self.executor.add("create sys application service o365_update traffic-group traffic-group-local-only device-group none")
+            self.log(2, self.log_level, self.logdir, "Application service not found. Creating o365_update.app/o365_update")
+
+        if self.apply_mode == "staged":
+            self.stage_datagroup(url_file, " separator \":=\" type string")
+            return
+
+        if not self.executor.exists("sys file data-group o365_update.app/" + url_file):
+            ## Create (sys) external data group
+            self.executor.add("create /sys file data-group o365_update.app/" + url_file + " separator \":=\" source-path file:" + self.work_directory + "/" + url_file + " type string", self.work_directory + "/" + url_file)
+            self.log(2, self.log_level, self.logdir, "O365 URL data group (" + url_file + ") not found. Created new data group.")
+        else:
+            ## Update (sys) external data group
+            self.executor.add("modify /sys file data-group o365_update.app/" + url_file + " source-path file:" + self.work_directory + "/" + url_file, self.work_directory + "/" + url_file)
+            self.log(2, self.log_level, self.logdir, "O365 URL data group (" + url_file + ") exists. Updated existing data group.")
+
+        ## Create (ltm) link to external data group, or relink it from a staged generation
+        self.link_datagroup(url_file)
+
+
+    ##-----------------------------------------------------------------------
+    ## Create IP datagroups function
+    ##  Purpose: create IP datagroups from supplied IP addresses
+    ##  Parameters:
+    ##      url_file        = name of IP datagroup
+    ##      url_list        = list of IP addresses
+    ##  Example:
+    ##      self.create_ip_datagroups (o365_dg_ipv4, ipv4_undup)
+    ##-----------------------------------------------------------------------
+    def create_ip_datagroups (self, url_file, url_list):
+        ## Collapse overlapping and adjacent prefixes into the minimal covering set
+        unique_count = len(set(url_list))
+        url_list = self.aggregate_prefixes(url_list)
+        self.log(1, self.log_level, self.logdir, "O365 IP data group (" + url_file + ") aggregated from " + str(unique_count) + " to " + str(len(url_list)) + " prefixes.")
+
+        ## Write data to a file for import into data group
+        fout = open(self.work_directory + "/" + url_file, 'w')
+        for ip in (list(sorted(url_list))):
+            fout.write("network " + str(ip) + ",\n")
+        fout.flush()
+        fout.close()
+        self.plan_datagroup(url_file)
+
+        ## Create URL data group files in TMSH if they don't already exist
+        if not self.executor.exists("sys application service o365_update.app/o365_update"):
+            self.executor.add("create sys application service o365_update traffic-group traffic-group-local-only device-group none")
+            self.log(2, self.log_level, self.logdir, "Application service not found. Creating o365_update.app/o365_update")
+
+        if self.apply_mode == "staged":
+            self.stage_datagroup(url_file, " type ip")
+            return
+
+        if not self.executor.exists("sys file data-group o365_update.app/" + url_file):
+            self.executor.add("create /sys file data-group o365_update.app/" + url_file + " source-path file:" + self.work_directory + "/" + url_file + " type ip", self.work_directory + "/" + url_file)
+            self.log(2, self.log_level, self.logdir, "O365 IP data group (" + url_file + ") not found. Created new data group.")
+        else:
+            self.executor.add("modify /sys file data-group o365_update.app/" + url_file + " source-path file:" + self.work_directory + "/" + url_file, self.work_directory + "/" + url_file)
+            self.log(2, self.log_level, self.logdir, "O365 IP data group (" + url_file + ") exists. Updated existing data group.")
+
+        ## Create (ltm) link to external data group, or relink it from a staged generation
+        self.link_datagroup(url_file)
+
+
+    ##-----------------------------------------------------------------------
+    ## Link datagroup function
+    ##  Purpose: direct apply mode - link the ltm external data group to its sys file data group. A data
+    ##  group still linked to a staged generation (apply_mode changed from staged) is relinked, and the
+    ##  staged generations are deleted so they can't be switched back to (--rollback).
+    ##  Parameters:
+    ##      url_file        = name of the data group
+    ##-----------------------------------------------------------------------
+    def link_datagroup(self, url_file):
+        if not self.executor.exists("ltm data-group external o365_update.app/" + url_file):
+            self.executor.add("create /ltm data-group external o365_update.app/" + url_file + " external-file-name o365_update.app/" + url_file)
+            return
+
+        linked = self.executor.external_file_name(url_file)
+        if linked is not None and linked != "o365_update.app/" + url_file:
+            self.executor.add("modify /ltm data-group external o365_update.app/" + url_file + " external-file-name o365_update.app/" + url_file)
+            self.log(1, self.log_level, self.logdir, "O365 data group (" + url_file + ") linked to " + linked + ". Relinked to o365_update.app/" + url_file + " (direct apply mode).")
+            for generation in ("_blue", "_green"):
+                if self.executor.exists("sys file data-group o365_update.app/" + url_file + generation):
+                    self.executor.add("delete sys file data-group o365_update.app/" + url_file + generation)
+
+
+    ##-----------------------------------------------------------------------
+    ## Plan datagroup function
+    ##  Purpose: record the entry count of a data group file written this run and the entries
+    ##  added/removed against the copy currently loaded on the BIG-IP (data group filestore)
+    ##  Parameters:
+    ##      url_file        = name of the data group (its file is in the working directory)
+    ##-----------------------------------------------------------------------
+    def plan_datagroup(self, url_file):
+        f = open(self.work_directory + "/" + url_file, "r")
+        lines = set([x.strip() for x in f.read().splitlines() if x.strip() != ""])
+        f.close()
+
+        planned = {"entries": len(lines), "added": None, "removed": None, "load": len(lines)}
+
+        ## The file of the linked generation (staged mode), otherwise of the data group itself
+        linked = self.executor.external_file_name(url_file) or "o365_update.app/" + url_file
+        try:
+            loaded = [datagroup_directory + x for x in os.listdir(datagroup_directory) if fnmatch.fnmatch(x, ":Common:" + linked.replace("/", ":") + "_[0-9]*")]
+        except:
+            loaded = []
+
+        if loaded:
+            f = open(max(loaded, key=os.path.getmtime), "r")
+            current = set([x.strip() for x in f.read().splitlines() if x.strip() != ""])
+            f.close()
+            planned["added"] = len(lines - current)
+            planned["removed"] = len(current - lines)
+        elif not self.executor.exists("sys file data-group " + linked):
+            planned["added"] = len(lines)
+            planned["removed"] = 0
+
+        self.planned[url_file] = planned
+
+
+    ##-----------------------------------------------------------------------
+    ## Stage datagroup function
+    ##  Purpose: load a data group file into the shadow generation (<name>_blue or <name>_green - the one
+    ##  the ltm external data group is not linked to). The link is switched by switch_staged once the
+    ##  loaded copy is verified, and the previous generation is kept for --rollback.
+    ##  Parameters:
+    ##      url_file        = name of the data group (its file is in the working directory)
+    ##      create_options  = tmsh options used when the shadow data group is created
+    ##-----------------------------------------------------------------------
+    def stage_datagroup(self, url_file, create_options):
+        source = self.work_directory + "/" + url_file
+        f = open(source, "rb")
+        content = f.read()
+        f.close()
+
+        current = self.executor.external_file_name(url_file)
+        if current == "o365_update.app/" + url_file + "_blue":
+            shadow = url_file + "_green"
+        else:
+            shadow = url_file + "_blue"
+
+        if self.executor.exists("sys file data-group o365_update.app/" + shadow):
+            self.executor.add("modify /sys file data-group o365_update.app/" + shadow + " source-path file:" + source, source)
+        else:
+            self.executor.add("create /sys file data-group o365_update.app/" + shadow + create_options + " source-path file:" + source, source)
+
+        self.staged[url_file] = {
+            "shadow": shadow,
+            "linked": current is not None,
+            "entries": content.count(b"\n"),
+            "checksum": "SHA1:" + str(len(content)) + ":" + hashlib.sha1(content).hexdigest()
+        }
+        self.log(2, self.log_level, self.logdir, "O365 data group (" + url_file + ") staged in " + shadow + " (" + str(self.staged[url_file]["entries"]) + " entries, live generation: " + str(current) + ").")
+
+
+    ##-----------------------------------------------------------------------
+    ## Switch staged function
+    ##  Purpose: verify the staged data groups (checksum of the loaded copy against the local file), then
+    ##  link them and apply the URL category changes in one transaction. Nothing is switched if any
+    ##  shadow fails verification, and a failed transaction is not replayed.
+    ##  Parameters: none
+    ##  Returns: list of {"command", "ok", "output"} dictionaries
+    ##-----------------------------------------------------------------------
+    def switch_staged(self):
+        results = []
+        for url_file in sorted(self.staged):
+            staged = self.staged[url_file]
+            checksum = self.executor.read_property("sys file data-group o365_update.app/" + staged["shadow"], "checksum")
+            if checksum != staged["checksum"]:
+                results.append({"command": "verify o365_update.app/" + staged["shadow"], "ok": False, "output": "staged copy checksum " + str(checksum) + " does not match " + staged["checksum"]})
+                continue
+
+            self.log(2, self.log_level, self.logdir, "O365 data group (" + url_file + ") verified " + str(staged["entries"]) + " entries in " + staged["shadow"] + ".")
+            if staged["linked"]:
+                self.switch.add("modify /ltm data-group external o365_update.app/" + url_file + " external-file-name o365_update.app/" + staged["shadow"])
+            else:
+                self.switch.add("create /ltm data-group external o365_update.app/" + url_file + " external-file-name o365_update.app/" + staged["shadow"])
+
+        self.staged = {}
+        if results:
+            self.switch.commands = []
+            return results
+
+        results = self.switch.submit(True, False)
+        if not [x for x in results if not x["ok"]]:
+            self.log(1, self.log_level, self.logdir, "Staged apply: switched " + str(len(results)) + " objects in one transaction.")
+        return results
+
+
+    ##-----------------------------------------------------------------------
+    ## Run parallel function
+    ##  Purpose: run independent tasks on a bounded pool of worker threads (max_workers). Most of the
+    ##  time of an output task is spent waiting on tmsh, so the tasks overlap instead of adding up.
+    ##  Parameters:
+    ##      tasks           = list of (object name, function, argument tuple)
+    ##  Returns: list of {"object", "ok", "output", "seconds"} dictionaries in task order
+    ##-----------------------------------------------------------------------
+    def run_parallel(self, tasks):
+        results = [None] * len(tasks)
+        pending = list(range(len(tasks)))
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    i = pending.pop(0)
+
+                name, function, args = tasks[i]
+                start = time.time()
+                try:
+                    function(*args)
+                    results[i] = {"object": name, "ok": True, "output": "", "seconds": time.time() - start}
+                except Exception as e:
+                    results[i] = {"object": name, "ok": False, "output": str(e), "seconds": time.time() - start}
+
+        threads = [threading.Thread(target=worker) for x in range(min(max_workers, len(tasks)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for result in results:
+            self.log(2, self.log_level, self.logdir, "Prepared " + result["object"] + " in " + "%.2f" % result["seconds"] + " seconds (ok: " + str(result["ok"]) + ").")
+
+        return results
+
+
+    ##-----------------------------------------------------------------------
+    ## Aggregate prefixes function
+    ##  Purpose: collapse a list of IP/CIDR prefixes into the minimal set of prefixes covering the same addresses
+    ##  (ex. 40.96.0.0/14 + 40.100.0.0/14 -> 40.96.0.0/13). Entries that are not valid networks are kept as-is.
+    ##  Parameters:
+    ##      ip_list         = list of IP/CIDR strings
+    ##-----------------------------------------------------------------------
+    def aggregate_prefixes(self, ip_list):
+        ip_list = list(set(ip_list))
+        if ipaddress is None:
+            return ip_list
+
+        networks = {4: [], 6: []}
+        aggregated = []
+        for ip in ip_list:
+            try:
+                network = ipaddress.ip_network(u"" + ip.strip(), strict=False)
+                networks[network.version].append(network)
+            except ValueError:
+                aggregated.append(ip)
+
+        for version in (4, 6):
+            aggregated += [str(x) for x in ipaddress.collapse_addresses(networks[version])]
+
+        return aggregated
+
+
+    ##-----------------------------------------------------------------------
+    ## URL fetch function
+    ##  Purpose: generate an HTTP request to O365 API and return resulting JSON
+    ##  Parameters:
+    ##      req_string      = request URL
+    ##      fatal           = abort the run if all attempts fail (default), otherwise return None
+    ##      retry           = retry failed attempts (defaults to the value of fatal)
+    ##-----------------------------------------------------------------------
+    def url_fetch(self, req_string, fatal=True, retry=None):
+        if retry is None:
+            retry = fatal
+
+        # we don't pass --force to cron, so force_update comes from user or update worker, try only once
+        if self.retry_attempts > 0 and not self.force_update and retry:
+            attempts = self.retry_attempts - 1
+        else:
+            attempts = 0
+
+        def sleep(attempts):
+            if attempts >= 0:
+                time.sleep(self.retry_delay)
+
+        count = 1
+        error = ""
+        while attempts >= 0:
+            attempts -= 1
+            try:
+                if self.proxyip != None:
+                    localproxy = 'http://' + self.proxyip + ':' + str(self.proxyport)
+                    proxyctl = urlrequest.ProxyHandler({'https': localproxy,'http': localproxy})
+                    context = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, cafile=self.cafile)
+                    handler = urlrequest.HTTPSHandler(context=context)
+                    opener = urlrequest.build_opener(handler, proxyctl)
+                    urlrequest.install_opener(opener)
+                    res = urlrequest.urlopen(req_string)
+                else:
+                    context = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, cafile=self.cafile)
+                    handler = urlrequest.HTTPSHandler(context=context)
+                    opener = urlrequest.build_opener(handler)
+                    urlrequest.install_opener(opener)
+                    res = urlrequest.urlopen(req_string)
+
+            except urlrequest.URLError as e:
+                present = datetime.datetime.now()
+                self.log(1, self.log_level, self.logdir, "ERROR: Attempt (" + str(count) + ") to request O365 information failed (1004): " + str(e.reason) + "\n")
+                self.event_log(1, "ERROR: Attempt (" + str(count) + ") to request O365 information failed (1004): " + str(e.reason) + "\n")
+                self.addLastRun(present.strftime("%Y-%m-%d %H:%M"), "ERROR: Attempt (" + str(count) + ") to request O365 information failed (1004): " + str(e.reason) + "\n")
+                sys.stderr.write("ERROR: Attempt (" + str(count) + ") to request O365 information failed (1004): " + str(e.reason) + "\n")
+                count += 1
+                error = str(e.reason)
+                sleep(attempts)
+                continue
+
+            except Exception as e:
+                present = datetime.datetime.now()
+                self.log(1, self.log_level, self.logdir, "ERROR: Attempt (" + str(count) + ") to request O365 information failed (1005): " + str(e.reason))
+                self.event_log(1, "ERROR: Attempt (" + str(count) + ") to request O365 information failed (1005): " + str(e.reason))
+                self.addLastRun(present.strftime("%Y-%m-%d %H:%M"), "ERROR: Attempt (" + str(count) + ") to request O365 information failed (1005): " + str(e.reason))
+                sys.stderr.write("ERROR: Attempt (" + str(count) + ") to request O365 information failed (1005): " + str(e.reason) + "\n")
+                count += 1
+                error = str(e.reason)
+                sleep(attempts)
+                continue
+
+            if res.getcode() != 200:
+                present = datetime.datetime.now()
+                self.log(1, self.log_level, self.logdir, "ERROR: Attempt (" + str(count) + ") to request O365 information failed (1006): " + str(e.reason))
+                self.event_log(1, "ERROR: Attempt (" + str(count) + ") to request O365 information failed (1006): " + str(e.reason))
+                self.addLastRun(present.strftime("%Y-%m-%d %H:%M"), "ERROR: Attempt (" + str(count) + ") to request O365 information failed (1006): " + str(e.reason))
+                sys.stderr.write("ERROR: Attempt (" + str(count) + ") to request O365 information failed (1006): " + str(e.reason) + "\n")
+                count += 1
+                error = str(e.reason)
+                sleep(attempts)
+                continue
+            else:
+                ## Looks good - return response
+                return res
 
-                ## Input validation: ensure value is an integer 0 or higher
-                if json_data["system"]["retry_delay"] < 0:
-                    raise Exception('The System "retry_delay" value must be an integer 0 (seconds) or higher. [1043]')
-                    sys.exit(1)
+        if not fatal:
+            self.log(1, self.log_level, self.logdir, "Request for O365 information failed, continuing with fallback: " + error)
+            return None
 
-                json_data["system"]["retry_delay"] = jsonstr["system"]["retry_delay"]
-            else:
-                ## Default 300 seconds retry delay
-                json_data["system"]["retry_delay"] = 300
+        self.fetch_abort(error)
 
-        else:
-            ## No system block defined, set defaults
-            json_data["system"]["log_level"] = 1
-            json_data["system"]["ca_bundle"] = "ca-bundle.crt"
-            json_data["system"]["working_directory"] = "/shared/o365"
-            json_data["system"]["retry_attempts"] = 3
-            json_data["system"]["retry_delay"] = 300
 
-        ## schedule
-        if "schedule" in jsonstr:
+    ##-----------------------------------------------------------------------
+    ## Fetch abort function
+    ##  Purpose: record a failed O365 information request and abort the run
+    ##  Parameters:
+    ##      error           = error message
+    ##-----------------------------------------------------------------------
+    def fetch_abort(self, error):
+        present = datetime.datetime.now()
+        self.log(1, self.log_level, self.logdir, "ERROR: Failed all attempts to request O365 information. Aborting until next scheduled run. " + error)
+        self.event_log(1, "ERROR: Failed all attempts to request O365 information. Aborting until next scheduled run. " + error)
+        self.addLastRun(present.strftime("%Y-%m-%d %H:%M"), "ERROR: Failed all attempts to request O365 information. Aborting until next scheduled run. " + error)
+        sys.stderr.write("ERROR: Failed all attempts to request O365 information. Aborting until next scheduled run. " + error + "\n")
+        sys.exit(1)
 
-            ## schedule:periods
-            if "periods" in jsonstr["schedule"]:
-                json_data["schedule"]["periods"] = jsonstr["schedule"]["periods"]
 
-                ## Input validation: ensure value is one of: monthly, weekly
-                if json_data["schedule"]["periods"] not in {"monthly", "weekly", "daily", "none"}:
-                    raise Exception('The Schedule "periods" value must be one of: \"monthly\", \"weekly\", \"daily\", or \"none\". [1020]')
-                    sys.exit(1)
-            else:
-                ## Default none
-                json_data["schedule"]["periods"] = "none"
+    ##-----------------------------------------------------------------------
+    ## Snapshot path function
+    ##  Purpose: return the path of the compressed endpoints snapshot for an instance and version
+    ##  Parameters:
+    ##      version         = version string of the endpoints document
+    ##-----------------------------------------------------------------------
+    def snapshot_path(self, version):
+        return self.work_directory + "/snapshots/" + self.customer_endpoint + "_" + version + ".json.gz"
 
-            ## schedule:run_date
-            if "run_date" in jsonstr["schedule"]:
-                json_data["schedule"]["run_date"] = jsonstr["schedule"]["run_date"]
 
-                if json_data["schedule"]["run_date"] == "":
-                    ## Value empty, set default 1
-                    json_data["schedule"]["run_date"] = 1
+    ##-----------------------------------------------------------------------
+    ## Save snapshot function
+    ##  Purpose: persist an endpoints document (record set) as a compressed, versioned snapshot and apply the retention policy
+    ##  Parameters:
+    ##      version         = version string of the endpoints document
+    ##      records         = list of O365 endpoint records
+    ##-----------------------------------------------------------------------
+    def save_snapshot(self, version, records):
+        snapshot_dir = self.work_directory + "/snapshots"
+        if not os.path.isdir(snapshot_dir):
+            os.mkdir(snapshot_dir)
+
+        ## Write to a temporary file first so an interrupted run never leaves a partial snapshot
+        snapshot_file = self.snapshot_path(version)
+        f = gzip.open(snapshot_file + ".tmp", "wb")
+        f.write(json.dumps(records).encode('utf-8'))
+        f.close()
+        os.rename(snapshot_file + ".tmp", snapshot_file)
 
-                ## Input validation: validate weekly/monthly values
-                elif json_data["schedule"]["periods"] == "monthly":
-                    ## Input validation: ensure run_date is an integer
-                    if type(json_data["schedule"]["run_date"]) != int:
-                        raise Exception('Schedule "run_date" value for period(monthly) must be an integer between 1 and 31. [1016]')
-                        sys.exit(1)
+        ## Retention: keep the newest snapshot_retention versions for this instance
+        for old_version in self.list_snapshots()[self.snapshot_retention:]:
+            try:
+                os.remove(self.snapshot_path(old_version))
+                self.log(2, self.log_level, self.logdir, "Removed expired snapshot " + self.snapshot_path(old_version))
+            except:
+                pass
 
-                    ## Input validation: ensure monthly run_date is a value between 1 and 31
-                    if json_data["schedule"]["run_date"] <= 0 or json_data["schedule"]["run_date"] > 31:
-                        raise Exception('Schedule "run_date" value for period(monthly) must be an integer between 1 and 31. [1008]')
-                        sys.exit(1)
 
-                elif json_data["schedule"]["periods"] == "weekly":
-                    ## Input validation: ensure run_date is an integer
-                    if type(json_data["schedule"]["run_date"]) != int:
-                        raise Exception('Schedule "run_date" value for period(weekly) must be an integer between 0 (Sunday) and 6 (Saturday). [1025]')
-                        sys.exit(1)
+    ##-----------------------------------------------------------------------
+    ## List snapshots function
+    ##  Purpose: return the snapshot versions held for the configured instance, newest first
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def list_snapshots(self):
+        snapshot_dir = self.work_directory + "/snapshots"
+        if not os.path.isdir(snapshot_dir):
+            return []
 
-                    ## Input validation: ensure weekly run_date is a value between 1 and 7
-                    if json_data["schedule"]["run_date"] < 0 or json_data["schedule"]["run_date"] > 6:
-                        raise Exception('Schedule "run_date" value for period(weekly) must be an integer between 0 (Sunday) and 6 (Saturday). [1030]')
-                        sys.exit(1)
+        versions = []
+        for entry in os.listdir(snapshot_dir):
+            match = re.match("^" + re.escape(self.customer_endpoint) + "_([0-9]{10})\\.json\\.gz$", entry)
+            if match:
+                versions.append(match.group(1))
+        return sorted(versions, reverse=True)
 
-            else:
-                ## Default 1
-                json_data["schedule"]["run_date"] = 1
 
-            ## schedule:run_time
-            if "run_time" in jsonstr["schedule"]:
-                json_data["schedule"]["run_time"] = jsonstr["schedule"]["run_time"]
+    ##-----------------------------------------------------------------------
+    ## Load snapshot function
+    ##  Purpose: read a compressed endpoints snapshot
+    ##  Parameters:
+    ##      version         = version string of the endpoints document
+    ##  Returns: list of O365 endpoint records, or None if missing/unreadable
+    ##-----------------------------------------------------------------------
+    def load_snapshot(self, version):
+        snapshot_file = self.snapshot_path(version)
+        if not os.path.isfile(snapshot_file):
+            return None
 
-                if json_data["schedule"]["run_time"] == "":
-                    ## Value empty, set default "04:00"
-                    json_data["schedule"]["run_time"] = "04:00"
+        try:
+            f = gzip.open(snapshot_file, "rb")
+            f_content = f.read()
+            f.close()
+            records = json.loads(f_content.decode('utf-8'))
+        except Exception as e:
+            self.log(1, self.log_level, self.logdir, "Snapshot " + snapshot_file + " is unreadable: " + str(e))
+            return None
 
-                ## Input validation: ensure correct time format
-                elif not re.match(r"[0-9]{1,2}:[0-9]{2}", json_data["schedule"]["run_time"]):
-                    raise Exception('Schedule "run_time" value must be a valid 24-hour time (ex. 14:30). [1033]')
-                    sys.exit(1)
+        if not isinstance(records, list):
+            return None
 
-                ## Input validation: ensure first number (hour) between 0 and 23, and second number (minutes) between 0 and 59
-                this_time = json_data["schedule"]["run_time"].split(":")
-                if int(this_time[0]) < 0 or int(this_time[0]) > 23:
-                    raise Exception('Schedule "run_time" hour value must be a valid 24-hour integer between 0 and 23. [1038]')
-                    sys.exit(1)
-                if int(this_time[1]) < 0 or int(this_time[1]) > 59:
-                    raise Exception('Schedule "run_time" minute value must be a valid integer between 0 and 59. [1022]')
-                    sys.exit(1)
-            else:
-                ## Default "04:00"
-                json_data["schedule"]["run_time"] = "04:00"
+        return records
 
-            ## schedule:start_date
-            if "start_date" in jsonstr["schedule"]:
-                json_data["schedule"]["start_date"] = jsonstr["schedule"]["start_date"]
 
-                if json_data["schedule"]["start_date"] == "":
-                    pass
+    ##-----------------------------------------------------------------------
+    ## Load records function
+    ##  Purpose: read the last applied O365 endpoint record set (the base for incremental updates)
+    ##  Parameters:
+    ##      version         = version string the record set must match
+    ##  Returns: dictionary with "version", "config_hash" and "records", or None if missing/stale
+    ##-----------------------------------------------------------------------
+    def load_records(self, version):
+        applied_file = self.work_directory + "/o365_applied.json"
+        if not os.path.isfile(applied_file):
+            return None
 
-                ## Input validation: ensure correct m/d/Y format
-                elif not re.match(r"[0-9]{1,2}\/[0-9]{1,2}\/[0-9]{4}", json_data["schedule"]["start_date"]):
-                    raise Exception('Schedule "start_date" value must be in month/day/year format (ex. 03/29/2021). [1023]')
-                    sys.exit(1)
-            else:
-                ## Default ""
-                json_data["schedule"]["start_date"] = ""
+        try:
+            f = open(applied_file, "r")
+            f_content = f.read()
+            f.close()
+            applied = json.loads(f_content)
+        except Exception as e:
+            self.log(1, self.log_level, self.logdir, "Last applied state is unreadable, a full update will be made: " + str(e))
+            return None
 
-            ## schedule:start_time
-            if "start_time" in jsonstr["schedule"]:
-                json_data["schedule"]["start_time"] = jsonstr["schedule"]["start_time"]
+        if applied.get("instance") != self.customer_endpoint or applied.get("version") != version:
+            self.log(2, self.log_level, self.logdir, "Last applied state does not match previous VERSION " + version + ". A full update will be made.")
+            return None
 
-                if json_data["schedule"]["start_time"] == "":
-                    pass
+        applied["records"] = self.load_snapshot(version)
+        if applied["records"] is None:
+            return None
 
-                ## Input validation: ensure correct time format
-                elif not re.match(r"[0-9]{1,2}:[0-9]{2}", json_data["schedule"]["start_time"]):
-                    raise Exception('Schedule "start_time" value must be a valid 24-hour time (ex. 14:30). [1034]')
-                    sys.exit(1)
+        return applied
 
-                ## Input validation: ensure first number (hour) between 0 and 23, and second number (minutes) between 0 and 59
-                else:
-                    this_time = json_data["schedule"]["start_time"].split(":")
-                    if int(this_time[0]) < 0 or int(this_time[0]) > 23:
-                        raise Exception('Schedule "start_time" hour value must be a valid 24-hour integer between 0 and 23. [1035]')
-                        sys.exit(1)
-                    if int(this_time[1]) < 0 or int(this_time[1]) > 59:
-                        raise Exception('Schedule "start_time" minute value must be a valid integer between 0 and 59. [1036]')
-                        sys.exit(1)
-            else:
-                ## Default ""
-                json_data["schedule"]["start_time"] = ""
-        else:
-            ## No schedule block defined, set defaults
-            json_data["schedule"]["periods"] = "none"
-            json_data["schedule"]["run_date"] = 1
-            json_data["schedule"]["run_time"] = "04:00"
-            json_data["schedule"]["start_date"] = ""
-            json_data["schedule"]["start_time"] = ""
 
-        return(json_data)
+    ##-----------------------------------------------------------------------
+    ## Save records function
+    ##  Purpose: snapshot the applied O365 endpoint record set and record it as the base for the next incremental update
+    ##  Parameters:
+    ##      version         = version string of the record set
+    ##      records         = list of O365 endpoint records
+    ##-----------------------------------------------------------------------
+    def save_records(self, version, records):
+        if self.load_snapshot(version) is None:
+            self.save_snapshot(version, records)
+
+        applied_file = self.work_directory + "/o365_applied.json"
+        applied = {
+            "instance": self.customer_endpoint,
+            "version": version,
+            "config_hash": self.get_outputs_hash()
+        }
+        f = open(applied_file, "w")
+        f.write(json.dumps(applied))
+        f.flush()
+        f.close()
 
 
     ##-----------------------------------------------------------------------
-    ## addLastRun function
-    ##  Purpose: update last_run information in the JSON iFile data (assumes config is loaded)
+    ## Fetch changes function
+    ##  Purpose: request the changes since the previous version and apply them to the local record set
     ##  Parameters:
-    ##      datestr         = datetime string
-    ##      reason          = message to insert
+    ##      guid            = client request id
+    ##      version         = previous version string
+    ##      records         = list of O365 endpoint records at the previous version
+    ##  Returns: updated list of O365 endpoint records, or None if a full update is required
     ##-----------------------------------------------------------------------
-    def addLastRun(self, datestr, reason, isHashedValuesChanged=False, updatedHashedValues={}):
-        # Find all versions of the configuration iFile
-        o365_config = ""
-        entry_array = []
-        fileList = os.listdir('/config/filestore/files_d/Common_d/ifile_d/')
-        pattern = "*o365_config.json*"
-        for entry in fileList:
-            if fnmatch.fnmatch(entry, pattern):
-                entry_array.append("/config/filestore/files_d/Common_d/ifile_d/" + entry)
+    def fetch_changes(self, guid, version, records):
+        request_string = "/changes/" + self.customer_endpoint + "/" + version + "?ClientRequestId=" + guid
+        req_string = "https://" + url_ms_o365_endpoints + request_string
 
-        ## Get JSON data from configuration file and update with last_run information
-        o365_config = max(entry_array, key=os.path.getctime)
-        f = open(o365_config, "r")
-        f_content = f.read()
-        f.close()
-        config_data = json.loads(f_content)
-        #if URl updates are successful and hashvalues are changed from last run then update these new hashed values in json
-        if isHashedValuesChanged:
-            config_data["status"] = updatedHashedValues
+        ## Call url_fetch function - a failure here falls back to a full update
+        res = self.url_fetch(req_string, False)
+        if res is None:
+            return None
 
-        config_data["status"]["last_run"] = str(datestr)
-        config_data["status"]["description"] = reason
+        try:
+            ## Data fetched - validate and convert to JSON
+            res = res.read()
+            start = time.time()
+            changes = json.loads(res)
+            self.add_timing("parse", start)
+            if not isinstance(changes, list):
+                raise ValueError("changes response is not a list")
+        except Exception as e:
+            self.log(1, self.log_level, self.logdir, "CHANGES response was invalid, a full update will be made: " + str(e))
+            return None
 
-        ## Convert updated JSON data to formatted string
-        json_config_final = json.dumps(config_data, indent = 4)
+        self.log(2, self.log_level, self.logdir, "CHANGES request to MS web service was successful.")
+        self.event_log(2, "CHANGES request to MS web service was successful.")
 
-        ## Write updated JSON data to a temporary file
-        with open(config_data["system"]["working_directory"] + "/config.json", "w") as outfile:
-            outfile.write(json_config_final)
+        records_updated = self.apply_changes(records, changes)
+        if records_updated is None:
+            self.log(1, self.log_level, self.logdir, "CHANGES could not be applied to the local record set, a full update will be made.")
 
-        ## Update the ifile configuration / delete temporary file
-        result = shell.getoutput("tmsh -a modify sys file ifile o365_update.app/o365_config.json source-path file:" + config_data["system"]["working_directory"] + "/config.json")
-        os.remove(config_data["system"]["working_directory"] + "/config.json")
+        return records_updated
 
 
     ##-----------------------------------------------------------------------
-    ## Create URL categories function
-    ##  Purpose: creates O365 URL categories from supplied URL information
+    ## Apply changes function
+    ##  Purpose: apply "changes" web method records to a copy of an endpoint record set
     ##  Parameters:
-    ##      url_file        = name of the URL category
-    ##      url_list        = list of URLs
-    ##      version_latest  = latest version string
-    ##  Example:
-    ##      self.create_url_categories (o365_category, urls_undup, ms_o365_version_latest)
+    ##      records         = list of O365 endpoint records
+    ##      changes         = list of O365 change records (add/remove/change dispositions)
+    ##  Returns: updated list of O365 endpoint records, or None if the result is incomplete
     ##-----------------------------------------------------------------------
-    def create_url_categories (self, url_file, url_list, version_latest):
-        ## Initialize the url string
-        str_urls_to_bypass = ""
-
-        ## Create new or clean out existing URL category - add the latest version as first entry
-        result = shell.getoutput("tmsh -a list sys application service o365_update.app/o365_update")
-        if "was not found" in result:
-            result2 = shell.getoutput("tmsh -a create sys application service o365_update traffic-group traffic-group-local-only device-group none")
-            self.log(2, self.log_level, self.logdir, "Application service not found. Creating o365_update.app/o365_update")
-
-        result = shell.getoutput("tmsh -a list sys url-db url-category o365_update.app/" + url_file)
-        if "was not found" in result:
-            result2 = shell.getoutput("tmsh -a create /sys url-db url-category o365_update.app/" + url_file + " display-name " + url_file + " app-service o365_update.app/o365_update urls replace-all-with { https://" + version_latest + "/ { type exact-match } } default-action allow")
-            self.log(2, self.log_level, self.logdir, "O365 custom URL category (" + url_file + ") not found. Created new O365 custom category.")
-        else:
-            result2 = shell.getoutput("tmsh -a modify /sys url-db url-category o365_update.app/" + url_file + " display-name " + url_file + " app-service o365_update.app/o365_update urls replace-all-with { https://" + version_latest + "/ { type exact-match } } default-action allow")
-            self.log(2, self.log_level, self.logdir, "O365 custom URL category (" + url_file + ") exists. Clearing entries for new data.")
-
-        ## Loop through URLs and insert into URL category
-        for url in url_list:
-            ## Force URL to lower case
-            url = url.lower()
+    def apply_changes(self, records, changes):
+        record_map = {}
+        for record in copy.deepcopy(records):
+            record_map[record["id"]] = record
+
+        count_added = 0
+        count_removed = 0
+        for change in sorted(changes, key=lambda x: (str(x.get("version", "")), x.get("id", 0))):
+            if "endpointSetId" not in change:
+                return None
+            set_id = change["endpointSetId"]
+            disposition = str(change.get("disposition", "")).lower()
+
+            ## The whole endpoint set was removed
+            if disposition == "remove":
+                if set_id in record_map:
+                    count_removed += len(record_map[set_id].get("urls", [])) + len(record_map[set_id].get("ips", []))
+                    del record_map[set_id]
+                continue
 
-            ## Add * if url starts with "." (if a wildcard included_url is added)
-            if url.startswith("."):
-                url = "*" + url
+            if set_id not in record_map:
+                record_map[set_id] = {"id": set_id}
+            record = record_map[set_id]
+
+            ## Changed attributes (serviceArea, category, required, ...) are carried in "current"
+            if "current" in change:
+                for key in change["current"]:
+                    record[key] = change["current"][key]
+
+            if "remove" in change:
+                for key in ("urls", "ips"):
+                    if key in change["remove"] and key in record:
+                        removed = set(change["remove"][key])
+                        count_removed += len([x for x in record[key] if x in removed])
+                        record[key] = [x for x in record[key] if x not in removed]
+                        if not record[key]:
+                            del record[key]
+
+            if "add" in change:
+                for key in ("urls", "ips"):
+                    if key in change["add"]:
+                        existing = record.get(key, [])
+                        added = [x for x in change["add"][key] if x not in existing]
+                        count_added += len(added)
+                        record[key] = existing + added
+
+        ## Every record must carry the attributes the outputs are built from
+        for record in record_map.values():
+            if "serviceArea" not in record or "required" not in record:
+                return None
+
+        self.log(1, self.log_level, self.logdir, "Applied " + str(len(changes)) + " O365 change records: " + str(count_added) + " URL/IP entries added, " + str(count_removed) + " removed.")
+        return sorted(record_map.values(), key=lambda x: x["id"])
 
-            ## If URL starts with an asterisk, set as a glob-match URL, otherwise exact-match. Send to a string.
-            if ('*' in url):
-                ## Escaping any asterisk characters
-                url_processed = re.sub('\*', '\\*', url)
-                str_urls_to_bypass = str_urls_to_bypass + " urls add { \"https://" + url_processed + "/\" { type glob-match } } urls add { \"http://" + url_processed + "/\" { type glob-match } }"
-            else:
-                str_urls_to_bypass = str_urls_to_bypass + " urls add { \"https://" + url + "/\" { type exact-match } } urls add { \"http://" + url + "/\" { type exact-match } }"
 
-        ## Import the URL entries
-        result = shell.getoutput("tmsh -a modify /sys url-db url-category o365_update.app/" + url_file + " app-service o365_update.app/o365_update" + str_urls_to_bypass)
+    ##-----------------------------------------------------------------------
+    ## Outputs hash function
+    ##  Purpose: hash of every configuration value that shapes the output lists
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def get_outputs_hash(self):
+        output_config = {}
+        for key in ("service_areas", "outputs", "o365_categories", "only_required", "excluded_urls", "included_urls", "excluded_ips"):
+            output_config[key] = self.config_data[key]
+        return hashlib.md5(json.dumps(output_config, sort_keys=True).encode('utf-8')).hexdigest()
 
 
     ##-----------------------------------------------------------------------
-    ## Create URL datagroups function
-    ##  Purpose: creates O365 URL datagroups from supplied URL information
+    ## Output changed function
+    ##  Purpose: compare an output list against the previously applied one (delta mode)
     ##  Parameters:
-    ##      url_file        = name of the URL datagroup
-    ##      url_list        = list of URLs
-    ##  Example:
-    ##      self.create_url_datagroups (o365_dg, urls_undup)
+    ##      key             = output key ("all", "optimize", "default", "allow", "ipv4", "ipv6")
+    ##      outputs         = current output lists
+    ##      outputs_previous = previously applied output lists, or None for a full update
     ##-----------------------------------------------------------------------
-    def create_url_datagroups (self, url_file, url_list):
-        ## Write data to a file for import into data group
-        fout = open(self.work_directory + "/" + url_file, 'w')
-        for url in (list(sorted(set(url_list)))):
-            ## Replace any asterisk characters with a dot
-            url_processed = re.sub('\*', '', url)
-            fout.write("\"" + str(url_processed.lower()) + "\" := \"\",\n")
-        fout.flush()
-        fout.close()
-
-        ## Create URL data group files in TMSH if they don't already exist
-        result = shell.getoutput("tmsh -a list sys application service o365_update.app/o365_update")
-        if "was not found" in result:
-            result2 = shell.getoutput("tmsh -a create sys application service o365_update traffic-group traffic-group-local-only device-group none")
-            self.log(2, self.log_level, self.logdir, "Application service not found. Creating o365_update.app/o365_update")
+    def output_changed(self, key, outputs, outputs_previous):
+        if outputs_previous is None:
+            return True
 
-        result = shell.getoutput("tmsh -a list /sys file data-group o365_update.app/" + url_file)
-        if "was not found" in result:
-            ## Create (sys) external data group
-            result2 = shell.getoutput("tmsh -a create /sys file data-group o365_update.app/" + url_file + " separator \":=\" source-path file:" + self.work_directory + "/" + url_file + " type string")
-            ## Create (ltm) link to external data group
-            result3 = shell.getoutput("tmsh -a create /ltm data-group external o365_update.app/" + url_file + " external-file-name o365_update.app/" + url_file)
-            self.log(2, self.log_level, self.logdir, "O365 URL data group (" + url_file + ") not found. Created new data group.")
-        else:
-            ## Update (sys) external data group
-            result2 = shell.getoutput("tmsh -a modify /sys file data-group o365_update.app/" + url_file + " source-path file:" + self.work_directory + "/" + url_file)
-            ## Update (ltm) link to external data group
-            result3 = shell.getoutput("tmsh -a create /ltm data-group external o365_update.app/" + url_file + " external-file-name o365_update.app/" + url_file)
-            self.log(2, self.log_level, self.logdir, "O365 URL data group (" + url_file + ") exists. Updated existing data group.")
+        if set(outputs[key]) == set(outputs_previous[key]):
+            self.log(2, self.log_level, self.logdir, "O365 " + key + " output unchanged since previous VERSION. Skipping.")
+            return False
 
-        os.remove(self.work_directory + "/" + url_file)
+        return True
 
 
     ##-----------------------------------------------------------------------
-    ## Create IP datagroups function
-    ##  Purpose: create IP datagroups from supplied IP addresses
+    ## Classify records function
+    ##  Purpose: single pass over the O365 endpoint records that assigns each URL and IP a membership mask
+    ##  (mask_all, O365 category, service area and required bits, OR'ed over every record it appears in).
+    ##  Records outside the configured service areas / required setting are skipped.
     ##  Parameters:
-    ##      url_file        = name of IP datagroup
-    ##      url_list        = list of IP addresses
-    ##  Example:
-    ##      self.create_ip_datagroups (o365_dg_ipv4, ipv4_undup)
+    ##      records         = list of O365 endpoint records (endpoints web method format)
+    ##  Returns: (url_masks, ip_masks) dictionaries of {entry: mask}
     ##-----------------------------------------------------------------------
-    def create_ip_datagroups (self, url_file, url_list):
-        ## Write data to a file for import into data group
-        fout = open(self.work_directory + "/" + url_file, 'w')
-        for ip in (list(sorted(url_list))):
-            fout.write("network " + str(ip) + ",\n")
-        fout.flush()
-        fout.close()
+    def classify_records(self, records):
+        url_masks = {}
+        ip_masks = {}
+
+        service_areas = {}
+        if self.service_area_common:
+            service_areas["Common"] = mask_common
+        if self.service_area_exchange:
+            service_areas["Exchange"] = mask_exchange
+        if self.service_area_sharepoint:
+            service_areas["SharePoint"] = mask_sharepoint
+        if self.service_area_skype:
+            service_areas["Skype"] = mask_skype
+
+        for dict_o365_record in records:
+            service_area = str(dict_o365_record['serviceArea'])
+            if service_area not in service_areas:
+                continue
+
+            required = str(dict_o365_record['required']) == "True"
+            if self.only_required and not required:
+                continue
+
+            mask = mask_all | service_areas[service_area]
+            if required:
+                mask |= mask_required
+            if 'category' in dict_o365_record and dict_o365_record['category'] in category_masks:
+                mask |= category_masks[dict_o365_record['category']]
 
-        ## Create URL data group files in TMSH if they don't already exist
-        result = shell.getoutput("tmsh -a list sys application service o365_update.app/o365_update")
-        if "was not found" in result:
-            result2 = shell.getoutput("tmsh -a create sys application service o365_update traffic-group traffic-group-local-only device-group none")
-            self.log(2, self.log_level, self.logdir, "Application service not found. Creating o365_update.app/o365_update")
+            for url in dict_o365_record.get('urls', []):
+                url_masks[url] = url_masks.get(url, 0) | mask
 
-        result = shell.getoutput("tmsh -a list /sys file data-group o365_update.app/" + url_file)
-        if "was not found" in result:
-            result2 = shell.getoutput("tmsh -a create /sys file data-group o365_update.app/" + url_file + " source-path file:" + self.work_directory + "/" + url_file + " type ip")
-            result3 = shell.getoutput("tmsh -a create /ltm data-group external o365_update.app/" + url_file + " external-file-name o365_update.app/" + url_file)
-            self.log(2, self.log_level, self.logdir, "O365 IP data group (" + url_file + ") not found. Created new data group.")
-        else:
-            result2 = shell.getoutput("tmsh -a modify /sys file data-group o365_update.app/" + url_file + " source-path file:" + self.work_directory + "/" + url_file)
-            result3 = shell.getoutput("tmsh -a create /ltm data-group external o365_update.app/" + url_file + " external-file-name o365_update.app/" + url_file)
-            self.log(2, self.log_level, self.logdir, "O365 IP data group (" + url_file + ") exists. Updated existing data group.")
+            for ip in dict_o365_record.get('ips', []):
+                ip_masks[ip] = ip_masks.get(ip, 0) | mask
 
-        os.remove(self.work_directory + "/" + url_file)
+        return url_masks, ip_masks
 
 
     ##-----------------------------------------------------------------------
-    ## URL fetch function
-    ##  Purpose: generate an HTTP request to O365 API and return resulting JSON
+    ## Build outputs function
+    ##  Purpose: derives the de-duplicated URL and IP lists for each output from the classified records
     ##  Parameters:
-    ##      req_string      = request URL
+    ##      records         = list of O365 endpoint records (endpoints web method format)
+    ##      timed           = add the time to the classification/filtering phases (the latest records only)
+    ##  Returns: dictionary of lists keyed by "all", "optimize", "default", "allow", "ipv4", "ipv6"
     ##-----------------------------------------------------------------------
-    def url_fetch(self, req_string):
-        # we don't pass --force to cron, so force_update comes from user or update worker, try only once
-        if self.retry_attempts > 0 and not self.force_update:
-            attempts = self.retry_attempts - 1
-        else:
-            attempts = 0
+    def build_outputs(self, records, timed=True):
+        start = time.time()
+        url_masks, ip_masks = self.classify_records(records)
+        if timed:
+            self.add_timing("classification", start)
+        start = time.time()
+        outputs = {"all": [], "optimize": [], "default": [], "allow": [], "ipv4": [], "ipv6": []}
+
+        if self.output_url_categories or self.output_url_datagroups:
+            ## Included URLs join only the category they are configured for
+            for urls, mask in ((self.included_urls_all, mask_all), (self.included_urls_optimized, mask_optimize),
+                               (self.included_urls_default, mask_default), (self.included_urls_allow, mask_allow)):
+                for url in urls:
+                    url_masks[url] = url_masks.get(url, 0) | mask
+
+            ## Enabled categories, as (output key, mask bit)
+            categories = []
+            if self.o365_categories_all:
+                categories.append(("all", mask_all))
+            if self.o365_categories_optimize:
+                categories.append(("optimize", mask_optimize))
+            if self.o365_categories_default:
+                categories.append(("default", mask_default))
+            if self.o365_categories_allow:
+                categories.append(("allow", mask_allow))
+
+            # Remove set of excluded URLs - the exclusion trie is built once per run and shared by every URL category and data group
+            if self.excluded_url_trie is None:
+                self.excluded_url_trie = urlSuffixTrie(self.excluded_urls)
+
+            for url in url_masks:
+                if self.excluded_url_trie.match(url):
+                    continue
+                for key, mask in categories:
+                    if url_masks[url] & mask:
+                        outputs[key].append(url)
+
+        if self.output_ip_datagroups:
+            ## The exclusion prefix tree is built once per run and subtracts excluded networks (splitting prefixes where needed)
+            if self.excluded_ip_tree is None:
+                self.excluded_ip_tree = ipPrefixTree(self.excluded_ips)
+
+            outputs["ipv4"] = self.excluded_ip_tree.subtract([x for x in ip_masks if ":" not in x])
+            outputs["ipv6"] = self.excluded_ip_tree.subtract([x for x in ip_masks if ":" in x])
+
+        if timed:
+            self.add_timing("filtering", start)
+        return outputs
 
-        def sleep(attempts):
-            if attempts >= 0:
-                time.sleep(self.retry_delay)
 
-        count = 1
-        error = ""
-        while attempts >= 0:
-            attempts -= 1
-            try:
-                if self.proxyip != None:
-                    localproxy = 'http://' + self.proxyip + ':' + str(self.proxyport)
-                    proxyctl = urlrequest.ProxyHandler({'https': localproxy,'http': localproxy})
-                    context = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, cafile=self.cafile)
-                    handler = urlrequest.HTTPSHandler(context=context)
-                    opener = urlrequest.build_opener(handler, proxyctl)
-                    urlrequest.install_opener(opener)
-                    res = urlrequest.urlopen(req_string)
-                else:
-                    context = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, cafile=self.cafile)
-                    handler = urlrequest.HTTPSHandler(context=context)
-                    opener = urlrequest.build_opener(handler)
-                    urlrequest.install_opener(opener)
-                    res = urlrequest.urlopen(req_string)
+    ##-----------------------------------------------------------------------
+    ## Create executor function
+    ##  Purpose: return a new executor for the configured backend (assumes config is loaded). The REST
+    ##  backend falls back to tmsh if the iControl REST API doesn't answer.
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def create_executor(self):
+        if self.backend == "rest":
+            executor = restExecutor(self, self.rest_url)
+            if self.rest_available is None:
+                self.rest_available = executor.available()
+                if not self.rest_available:
+                    self.log(1, self.log_level, self.logdir, "iControl REST (" + self.rest_url + ") is not available. Falling back to tmsh.")
+            if self.rest_available:
+                return executor
 
-            except urlrequest.URLError as e:
-                present = datetime.datetime.now()
-                self.log(1, self.log_level, self.logdir, "ERROR: Attempt (" + str(count) + ") to request O365 information failed (1004): " + str(e.reason) + "\n")
-                self.event_log(1, "ERROR: Attempt (" + str(count) + ") to request O365 information failed (1004): " + str(e.reason) + "\n")
-                self.addLastRun(present.strftime("%Y-%m-%d %H:%M"), "ERROR: Attempt (" + str(count) + ") to request O365 information failed (1004): " + str(e.reason) + "\n")
-                sys.stderr.write("ERROR: Attempt (" + str(count) + ") to request O365 information failed (1004): " + str(e.reason) + "\n")
-                count += 1
-                error = str(e.reason)
-                sleep(attempts)
-                continue
+        return tmshExecutor(self)
 
-            except Exception as e:
-                present = datetime.datetime.now()
-                self.log(1, self.log_level, self.logdir, "ERROR: Attempt (" + str(count) + ") to request O365 information failed (1005): " + str(e.reason))
-                self.event_log(1, "ERROR: Attempt (" + str(count) + ") to request O365 information failed (1005): " + str(e.reason))
-                self.addLastRun(present.strftime("%Y-%m-%d %H:%M"), "ERROR: Attempt (" + str(count) + ") to request O365 information failed (1005): " + str(e.reason))
-                sys.stderr.write("ERROR: Attempt (" + str(count) + ") to request O365 information failed (1005): " + str(e.reason) + "\n")
-                count += 1
-                error = str(e.reason)
-                sleep(attempts)
-                continue
 
-            if res.getcode() != 200:
-                present = datetime.datetime.now()
-                self.log(1, self.log_level, self.logdir, "ERROR: Attempt (" + str(count) + ") to request O365 information failed (1006): " + str(e.reason))
-                self.event_log(1, "ERROR: Attempt (" + str(count) + ") to request O365 information failed (1006): " + str(e.reason))
-                self.addLastRun(present.strftime("%Y-%m-%d %H:%M"), "ERROR: Attempt (" + str(count) + ") to request O365 information failed (1006): " + str(e.reason))
-                sys.stderr.write("ERROR: Attempt (" + str(count) + ") to request O365 information failed (1006): " + str(e.reason) + "\n")
-                count += 1
-                error = str(e.reason)
-                sleep(attempts)
-                continue
-            else:
-                ## Looks good - return response
-                return res
+    ##-----------------------------------------------------------------------
+    ## Prepare environment function
+    ##  Purpose: detect the system proxy and CA bundle, and read (or create) the client request GUID.
+    ##  Done once per process - a daemon keeps the result until the configuration changes.
+    ##  Parameters: none
+    ##  Returns: GUID string
+    ##-----------------------------------------------------------------------
+    def prepare_environment(self):
+        if self.guid is not None:
+            return self.guid
+
+        ## -----------------------------------------------------------------------
+        ## System Proxy Detection (System : Configuration : Devices : Upstream Proxy)
+        ## -----------------------------------------------------------------------
+        result = shell.getoutput("tmsh -a list sys management-proxy-config proxy-ip-addr proxy-port")
+        if result != "":
+            for line in result.split('\n'):
+                if "proxy-ip-addr" in line:
+                    self.proxyip = line.strip().split()[1]
+                if "proxy-port" in line:
+                    self.proxyport = line.strip().split()[1]
+
+            ## Test if the proxyport is an integer or (string) service name
+            try:
+                self.proxyport = int(self.proxyport)
+            except:
+                ## proxyport is a string service name - resolve to port number
+                result = shell.getoutput("getent services " + self.proxyport)
+                result = re.sub('.*\s(\d+)\/.*', r'\1', result)
+                self.proxyport = int(result)
 
-        present = datetime.datetime.now()
-        self.log(1, self.log_level, self.logdir, "ERROR: Failed all attempts to request O365 information. Aborting until next scheduled run. " + error)
-        self.event_log(1, "ERROR: Failed all attempts to request O365 information. Aborting until next scheduled run. " + error)
-        self.addLastRun(present.strftime("%Y-%m-%d %H:%M"), "ERROR: Failed all attempts to request O365 information. Aborting until next scheduled run. " + error)
-        sys.stderr.write("ERROR: Failed all attempts to request O365 information. Aborting until next scheduled run. " + error + "\n")
-        sys.exit(1)
+        else:
+            self.proxyip = None
+            self.proxyport = None
+
+
+        ## -----------------------------------------------------------------------
+        ## System CA bundle selection (defaults to ca-bundle.crt if none selected)
+        ## -----------------------------------------------------------------------
+        result = shell.getoutput("tmsh -a list sys file ssl-cert " + self.ca_bundle + " system-path")
+        if result != "":
+            for line in result.split('\n'):
+                if "system-path" in line:
+                    self.cafile = line.strip().split()[1]
+        else:
+            self.cafile = "ca-bundle.crt"
+
+
+        ## -----------------------------------------------------------------------
+        ## GUID management
+        ## -----------------------------------------------------------------------
+        ## Create the guid file if it doesn't exist
+        if not os.path.isdir(self.work_directory):
+            os.mkdir(self.work_directory)
+            self.log(1, self.log_level, self.logdir, "Created work directory " + self.work_directory + " because it did not exist.")
+        if not os.path.exists(self.work_directory + "/guid.txt"):
+            f = open(self.work_directory + "/guid.txt", "w")
+            f.write("\n")
+            f.flush()
+            f.close()
+            self.log(1, self.log_level, self.logdir, "Created GUID file " + self.work_directory + "/guid.txt because it did not exist.")
+
+        ## Read guid from file and validate.  Create one if not existent
+        f = open(self.work_directory + "/guid.txt", "r")
+        f_content = f.readline()
+        f.close()
+        if re.match('[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', f_content):
+            guid = f_content
+            self.log(2, self.log_level, self.logdir, "Valid GUID is read from local file " + self.work_directory + "/guid.txt.")
+        else:
+            guid = str(uuid.uuid4())
+            f = open(self.work_directory + "/guid.txt", "w")
+            f.write(guid)
+            f.flush()
+            f.close()
+            self.log(1, self.log_level, self.logdir, "Generated a new GUID, and saved it to " + self.work_directory + "/guid.txt.")
+
+        self.guid = guid
+        return guid
 
 
     ##-----------------------------------------------------------------------
     ## Update O365 function
-    ##  Purpose: main work function. Processes O365 URLs and updates URL categories and datagroups
+    ##  Purpose: runs an update and writes its status once, however the run ends
     ##  Parameters: none
     ##-----------------------------------------------------------------------
     def update_o365(self):
+        start = time.time()
+        self.timings = {}
+        self.object_seconds = {}
+        self.planned = {}
+        self.run_result = "failed"
+        self.run_versions = {}
+        try:
+            self.run_update()
+        finally:
+            ## Any run that didn't complete (failed commands, an aborted fetch, an exception) restores the
+            ## previous version, so the next run retries the update instead of bypassing it
+            if self.run_result not in ("updated", "bypassed") and "previous" in self.run_versions and not self.plan_mode:
+                f = open(self.work_directory + "/o365_version.txt", "w")
+                f.write(self.run_versions["previous"])
+                f.flush()
+                f.close()
+            self.add_timing("total", start)
+            self.commit_metrics()
+            self.commit_history()
+            self.commit_status()
+            self.logger.flush()
+            self.syslog.flush()
+
 
-        list_urls_to_bypass = []
-        list_optimized_urls_to_bypass = []
-        list_default_urls_to_bypass = []
-        list_allow_urls_to_bypass = []
-        list_ipv4_to_pbr = []
-        list_ipv6_to_pbr = []
+    ##-----------------------------------------------------------------------
+    ## Run update function
+    ##  Purpose: main work function. Processes O365 URLs and updates URL categories and datagroups
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def run_update(self):
 
         self.get_config()
         if self.work_directory != "":
@@ -1338,71 +4468,13 @@ class o365UrlManagement:
                     sys.exit()
 
 
-            ## -----------------------------------------------------------------------
-            ## System Proxy Detection (System : Configuration : Devices : Upstream Proxy)
-            ## -----------------------------------------------------------------------
-            result = shell.getoutput("tmsh -a list sys management-proxy-config proxy-ip-addr proxy-port")
-            if result != "":
-                for line in result.split('\n'):
-                    if "proxy-ip-addr" in line:
-                        self.proxyip = line.strip().split()[1]
-                    if "proxy-port" in line:
-                        self.proxyport = line.strip().split()[1]
-
-                ## Test if the proxyport is an integer or (string) service name
-                try:
-                    self.proxyport = int(self.proxyport)
-                except:
-                    ## proxyport is a string service name - resolve to port number
-                    result = shell.getoutput("getent services " + self.proxyport)
-                    result = re.sub('.*\s(\d+)\/.*', r'\1', result)
-                    self.proxyport = int(result)
-
-            else:
-                self.proxyip = None
-                self.proxyport = None
-
-
-            ## -----------------------------------------------------------------------
-            ## System CA bundle selection (defaults to ca-bundle.crt if none selected)
-            ## -----------------------------------------------------------------------
-            result = shell.getoutput("tmsh -a list sys file ssl-cert " + self.ca_bundle + " system-path")
-            if result != "":
-                for line in result.split('\n'):
-                    if "system-path" in line:
-                        self.cafile = line.strip().split()[1]
-            else:
-                self.cafile = "ca-bundle.crt"
-
-
-            ## -----------------------------------------------------------------------
-            ## GUID management
-            ## -----------------------------------------------------------------------
-            ## Create the guid file if it doesn't exist
-            if not os.path.isdir(self.work_directory):
-                os.mkdir(self.work_directory)
-                self.log(1, self.log_level, self.logdir, "Created work directory " + self.work_directory + " because it did not exist.")
-            if not os.path.exists(self.work_directory + "/guid.txt"):
-                f = open(self.work_directory + "/guid.txt", "w")
-                f.write("\n")
-                f.flush()
-                f.close()
-                self.log(1, self.log_level, self.logdir, "Created GUID file " + self.work_directory + "/guid.txt because it did not exist.")
+            ## Proxy, CA bundle and GUID (detected once per process)
+            start = time.time()
+            guid = self.prepare_environment()
+            self.add_timing("environment", start)
 
-            ## Read guid from file and validate.  Create one if not existent
-            f = open(self.work_directory + "/guid.txt", "r")
-            f_content = f.readline()
-            f.close()
-            if re.match('[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', f_content):
-                guid = f_content
-                self.log(2, self.log_level, self.logdir, "Valid GUID is read from local file " + self.work_directory + "/guid.txt.")
-            else:
-                guid = str(uuid.uuid4())
-                f = open(self.work_directory + "/guid.txt", "w")
-                f.write(guid)
-                f.flush()
-                f.close()
-                self.log(1, self.log_level, self.logdir, "Generated a new GUID, and saved it to " + self.work_directory + "/guid.txt.")
+            ## BIG-IP change backend for this run (tmsh, or iControl REST)
+            self.executor = self.create_executor()
 
 
             ## -----------------------------------------------------------------------
@@ -1419,18 +4491,20 @@ class o365UrlManagement:
                     self.log(2, self.log_level, self.logdir, "Valid previous VERSION found in " + self.work_directory + "/o365_version.txt.")
                 else:
                     ms_o365_version_previous = "1970010200"
+                    if not self.plan_mode:
+                        f = open(self.work_directory + "/o365_version.txt", "w")
+                        f.write(ms_o365_version_previous)
+                        f.flush()
+                        f.close()
+                        self.log(1, self.log_level, self.logdir, "Valid previous VERSION was not found.  Wrote dummy value in " + self.work_directory + "/o365_version.txt.")
+            else:
+                ms_o365_version_previous = "1970010200"
+                if not self.plan_mode:
                     f = open(self.work_directory + "/o365_version.txt", "w")
                     f.write(ms_o365_version_previous)
                     f.flush()
                     f.close()
                     self.log(1, self.log_level, self.logdir, "Valid previous VERSION was not found.  Wrote dummy value in " + self.work_directory + "/o365_version.txt.")
-            else:
-                ms_o365_version_previous = "1970010200"
-                f = open(self.work_directory + "/o365_version.txt", "w")
-                f.write(ms_o365_version_previous)
-                f.flush()
-                f.close()
-                self.log(1, self.log_level, self.logdir, "Valid previous VERSION was not found.  Wrote dummy value in " + self.work_directory + "/o365_version.txt.")
 
 
             ## -----------------------------------------------------------------------
@@ -1441,11 +4515,13 @@ class o365UrlManagement:
             req_string = "https://" + url_ms_o365_version + request_string
 
             ## Call url_fetch function
+            start = time.time()
             res = self.url_fetch(req_string)
 
             try:
                 ## Data fetched - validate and convert to JSON
                 dict_o365_version = json.loads(res.read())
+                self.add_timing("version_fetch", start)
                 self.log(2, self.log_level, self.logdir, "VERSION request to MS web service was successful.")
                 self.event_log(2, "VERSION request to MS web service was successful.")
             except Exception as e:
@@ -1456,20 +4532,16 @@ class o365UrlManagement:
                 sys.stderr.write("ERROR: Good response but invalid (non-JSON) data encountered. Aborting (1007): " + str(e) + "\n")
                 sys.exit(1)
 
-            ms_o365_version_latest = ""
-            for record in dict_o365_version:
-                if 'instance' in record :
-                    if record["instance"] == self.customer_endpoint and "latest" in record:
-                        latest = record["latest"]
-                        if re.match('[0-9]{10}', latest):
-                            ms_o365_version_latest = latest
-                            f = open(self.work_directory + "/o365_version.txt", "w")
-                            f.write(ms_o365_version_latest)
-                            f.flush()
-                            f.close()
+            ms_o365_version_latest = self.latest_version(dict_o365_version)
+            if ms_o365_version_latest != "" and not self.plan_mode:
+                f = open(self.work_directory + "/o365_version.txt", "w")
+                f.write(ms_o365_version_latest)
+                f.flush()
+                f.close()
 
             self.log(2, self.log_level, self.logdir, "Previous VERSION is " + ms_o365_version_previous)
             self.log(2, self.log_level, self.logdir, "Latest VERSION is " + ms_o365_version_latest)
+            self.run_versions = {"previous": ms_o365_version_previous, "latest": ms_o365_version_latest}
 
             ## -----------------------------------------------------------------------
             ## check the hash of excluded IPs and excluded urls to check if they are changed, if yes, run the schdule
@@ -1496,14 +4568,23 @@ class o365UrlManagement:
                 isIncludedUrlsSame = False
 
             isHashedValuesSame = isIncludedUrlsSame and isExcludedUrlsSame and isExcludedIPsSame
+            updatedHashedValues = self.status
             if not isHashedValuesSame:
                 self.status["last_hash_includedUrls"] = currentHash_includedUrls
                 self.status["last_hash_excludedUrls"] = currentHash_excludeUrls
                 self.status["last_hash_excludedIPs"] = currentHash_excludeIPs
-                updatedHashedValues = self.status
+
+            # Other configuration changes (ex. service areas, outputs) are detected against the last applied state
+            applied_config_hash = self.applied_config_hash()
+            isConfigSame = applied_config_hash is None or applied_config_hash == self.get_outputs_hash()
 
             # If there is no change in included_url, excluded_url and excluded_ip after last run and guid is also same then no need to run the fetcha again
-            if ms_o365_version_latest == ms_o365_version_previous and isHashedValuesSame:
+            if ms_o365_version_latest == ms_o365_version_previous and isHashedValuesSame and isConfigSame and self.plan_mode and not self.force_update:
+                print("Plan: nothing to apply. Latest MS O365 URL/IP Address list already applied: " + ms_o365_version_latest + ". Use --force to plan a forced update.")
+                return
+
+            elif ms_o365_version_latest == ms_o365_version_previous and isHashedValuesSame and isConfigSame:
+                self.run_result = "bypassed"
                 present = datetime.datetime.now()
                 self.log(1, self.log_level, self.logdir, "Latest MS O365 URL/IP Address list already exists: " + ms_o365_version_latest + ". Aborting at " + present.strftime("%Y-%m-%d %H:%M"))
                 self.addLastRun(present.strftime("%Y-%m-%d %H:%M"), "URLs exists - update bypassed")
@@ -1515,199 +4596,498 @@ class o365UrlManagement:
                 pass
 
             ## -----------------------------------------------------------------------
-            ## Request O365 endpoints list and store in dictionaries
+            ## Request O365 endpoints list - from the snapshot cache when only the configuration
+            ## changed, incremental (changes web method) when the last applied record set matches
+            ## the previous version, otherwise full (endpoints web method)
             ## -----------------------------------------------------------------------
-            ## Make the request to fetch JSON data from Microsoft
-            request_string = "/endpoints/" + self.customer_endpoint + "?ClientRequestId=" + guid
-            req_string = "https://" + url_ms_o365_endpoints + request_string
+            records_previous = self.load_records(ms_o365_version_previous)
+            records = None
+            delta_mode = False
+            start = time.time()
+            if ms_o365_version_latest == ms_o365_version_previous and not self.force_update:
+                records = self.load_snapshot(ms_o365_version_latest)
+                if records is not None:
+                    self.log(1, self.log_level, self.logdir, "Configuration change only. Rebuilding from cached snapshot " + self.snapshot_path(ms_o365_version_latest))
+
+            if records is None and records_previous is not None and not self.force_update:
+                records = self.fetch_changes(guid, ms_o365_version_previous, records_previous["records"])
+                delta_mode = records is not None
+            self.add_timing("endpoints_fetch", start)
+
+            if records is None:
+                ## Make the request to fetch JSON data from Microsoft
+                request_string = "/endpoints/" + self.customer_endpoint + "?ClientRequestId=" + guid
+                req_string = "https://" + url_ms_o365_endpoints + request_string
+
+                ## Call url_fetch function - on failure fall back to the last good snapshot
+                start = time.time()
+                res = self.url_fetch(req_string, False, True)
+                if res is None:
+                    snapshots = self.list_snapshots()
+                    if snapshots:
+                        records = self.load_snapshot(snapshots[0])
+
+                    if records is None:
+                        self.fetch_abort("No cached snapshot available.")
+
+                    ## Record the snapshot version as current so the next run retries the latest version
+                    ms_o365_version_latest = snapshots[0]
+                    self.run_versions["latest"] = ms_o365_version_latest
+                    if not self.plan_mode:
+                        f = open(self.work_directory + "/o365_version.txt", "w")
+                        f.write(ms_o365_version_latest)
+                        f.flush()
+                        f.close()
+                    self.log(1, self.log_level, self.logdir, "ENDPOINTS request failed. Falling back to last good snapshot VERSION " + ms_o365_version_latest)
+                    self.event_log(1, "ENDPOINTS request failed. Falling back to last good snapshot VERSION " + ms_o365_version_latest)
 
-            ## Call url_fetch function
-            res = self.url_fetch(req_string)
+                else:
+                    try:
+                        ## Data fetched - validate and convert to JSON
+                        res = res.read()
+                        self.add_timing("endpoints_fetch", start)
+                        start = time.time()
+                        dict_o365_all = json.loads(res)
+                        self.add_timing("parse", start)
+                        self.log(2, self.log_level, self.logdir, "ENDPOINTS request to MS web service was successful.")
+                        self.event_log(2, "ENDPOINTS request to MS web service was successful.")
+                    except Exception as e:
+                        present = datetime.datetime.now()
+                        self.log(2, self.log_level, self.logdir, "Error: Good response but invalid (non-JSON) data encountered. Aborting (1024): " + str(e))
+                        self.event_log(2, "Error: Good response but invalid (non-JSON) data encountered. Aborting (1024): " + str(e))
+                        self.addLastRun(present.strftime("%Y-%m-%d %H:%M"), "Error: Good response but invalid (non-JSON) data encountered. Aborting (1024): " + str(e))
+                        sys.stderr.write("ERROR: Good response but invalid (non-JSON) data encountered. Aborting (1024): " + str(e) + "\n")
+                        sys.exit(1)
+                    records = dict_o365_all
 
-            try:
-                ## Data fetched - validate and convert to JSON
-                dict_o365_all = json.loads(res.read())
-                self.log(2, self.log_level, self.logdir, "ENDPOINTS request to MS web service was successful.")
-                self.event_log(2, "ENDPOINTS request to MS web service was successful.")
-            except Exception as e:
-                present = datetime.datetime.now()
-                self.log(2, self.log_level, self.logdir, "Error: Good response but invalid (non-JSON) data encountered. Aborting (1024): " + str(e))
-                self.event_log(2, "Error: Good response but invalid (non-JSON) data encountered. Aborting (1024): " + str(e))
-                self.addLastRun(present.strftime("%Y-%m-%d %H:%M"), "Error: Good response but invalid (non-JSON) data encountered. Aborting (1024): " + str(e))
-                sys.stderr.write("ERROR: Good response but invalid (non-JSON) data encountered. Aborting (1024): " + str(e) + "\n")
-                sys.exit(1)
+            ## Persist the fetched (or delta-built) endpoints document in the snapshot cache (not with --plan)
+            if self.load_snapshot(ms_o365_version_latest) is None and not self.plan_mode:
+                self.save_snapshot(ms_o365_version_latest, records)
+
+
+            ## Churn the endpoint records into separate URL and IP lists
+            outputs = self.build_outputs(records)
 
+            ## In delta mode, with the same output configuration as the last applied run, only objects whose content changed are pushed
+            outputs_previous = None
+            if delta_mode and records_previous["config_hash"] == self.get_outputs_hash():
+                ## Timed as its own phase, so classification/filtering stay the cost of the latest records
+                start = time.time()
+                outputs_previous = self.build_outputs(records_previous["records"], False)
+                self.add_timing("baseline", start)
 
-            ## Process for each record(id) of the endpoint JSON data - this churns the JSON data into separate URL lists
-            for dict_o365_record in dict_o365_all:
-                service_area = str(dict_o365_record['serviceArea'])
-                id = str(dict_o365_record['id'])
-
-                if (self.only_required == 0) or (self.only_required and str(dict_o365_record['required']) == "True"):
-
-                    if (self.service_area_common and service_area == "Common") \
-                        or (self.service_area_exchange and service_area == "Exchange") \
-                        or (self.service_area_sharepoint and service_area == "SharePoint") \
-                        or (self.service_area_skype and service_area == "Skype"):
-
-                        if self.output_url_categories or self.output_url_datagroups:
-                            ## Append "urls" if existent in each record (full list)
-                            if self.o365_categories_all and 'urls' in dict_o365_record:
-                                list_urls = list(dict_o365_record['urls'])
-                                for url in list_urls:
-                                    list_urls_to_bypass.append(url)
-
-                            # Append "optimized" URLs if required (optimized list)
-                            if self.o365_categories_optimize and 'urls' in dict_o365_record and 'category' in dict_o365_record and dict_o365_record['category'] == "Optimize":
-                                list_optimized_urls = list(dict_o365_record['urls'])
-                                for url in list_optimized_urls:
-                                    list_optimized_urls_to_bypass.append(url)
-
-                            # Append "default" URLs if required (default list)
-                            if self.o365_categories_default and 'urls' in dict_o365_record and 'category' in dict_o365_record and dict_o365_record['category'] == "Default":
-                                list_default_urls = list(dict_o365_record['urls'])
-                                for url in list_default_urls:
-                                    list_default_urls_to_bypass.append(url)
-
-                            # Append "allow" URLs if required (allow list)
-                            if self.o365_categories_allow and 'urls' in dict_o365_record and 'category' in dict_o365_record and dict_o365_record['category'] == "Allow":
-                                list_allow_urls = list(dict_o365_record['urls'])
-                                for url in list_allow_urls:
-                                    list_allow_urls_to_bypass.append(url)
-
-                        if self.output_ip_datagroups:
-                            # Append "ips" if existent in each record
-                            if 'ips' in dict_o365_record:
-                                list_ips = list(dict_o365_record['ips'])
-                                for ip in list_ips:
-                                    if re.match('^.+:', ip):
-                                        list_ipv6_to_pbr.append(ip)
-                                    else:
-                                        list_ipv4_to_pbr.append(ip)
+            self.log(1, self.log_level, self.logdir, "Number of unique ENDPOINTS to import : URL:" + str(len(outputs["all"])) + ", IPv4 host/net:" + str(len(outputs["ipv4"])) + ", IPv6 host/net:" + str(len(outputs["ipv6"])))
 
 
             # -----------------------------------------------------------------------
-            # Re-process URLs/IPs to add included urls (all-urls category)
+            # O365 endpoint URLs re-formatted to fit into custom URL categories and/or data groups
             # -----------------------------------------------------------------------
+            # This generates the temp files, data groups, and URL categories
+            url_sets = [
+                (self.o365_categories_all, "all", o365_category, o365_dg),
+                (self.o365_categories_optimize, "optimize", o365_category_optimized, o365_dg_optimize),
+                (self.o365_categories_default, "default", o365_category_default, o365_dg_default),
+                (self.o365_categories_allow, "allow", o365_category_allow, o365_dg_allow)
+            ]
+
+            ## The output objects are independent - each task writes its files, checks the existing object and queues its changes
+            tasks = []
             if self.output_url_categories or self.output_url_datagroups:
-                # Append included_urls_all
-                for url in self.included_urls_all:
-                    list_urls_to_bypass.append(url)
+                for enabled, key, category_name, dg_name in url_sets:
+                    if not enabled or not self.output_changed(key, outputs, outputs_previous):
+                        continue
 
-                # Append included_urls_optimized
-                for url in self.included_urls_optimized:
-                    list_optimized_urls_to_bypass.append(url)
+                    if self.output_url_categories:
+                        tasks.append((category_name, self.create_url_categories, (category_name, outputs[key], ms_o365_version_latest)))
 
-                # Append included_urls_default
-                for url in self.included_urls_default:
-                    list_default_urls_to_bypass.append(url)
+                    if self.output_url_datagroups:
+                        tasks.append((dg_name, self.create_url_datagroups, (dg_name, outputs[key])))
 
-                # Append included_urls_allow
-                for url in self.included_urls_allow:
-                    list_allow_urls_to_bypass.append(url)
+            if self.output_ip_datagroups:
+                if self.output_changed("ipv4", outputs, outputs_previous):
+                    tasks.append((o365_dg_ipv4, self.create_ip_datagroups, (o365_dg_ipv4, outputs["ipv4"])))
+
+                if self.output_changed("ipv6", outputs, outputs_previous):
+                    tasks.append((o365_dg_ipv6, self.create_ip_datagroups, (o365_dg_ipv6, outputs["ipv6"])))
+
+            ## Staged mode - live objects only change in the switch transaction
+            self.switch = None
+            if self.apply_mode == "staged":
+                self.switch = self.create_executor()
+
+            ## One listing of the existing objects for every create/modify decision
+            self.planned = {}
+            start = time.time()
+            if tasks:
+                self.executor.load_inventory()
+            self.add_timing("inventory", start)
+            start = time.time()
+            prepared = self.run_parallel(tasks)
+            self.add_timing("generate", start)
+            for task in prepared:
+                self.object_seconds[task["object"].replace("\\", "")] = {"generate": task["seconds"]}
+                if not task["ok"]:
+                    self.log(1, self.log_level, self.logdir, "ERROR: Failed to prepare " + task["object"] + ": " + task["output"])
+
+            ## --plan: report the planned changes instead of submitting them
+            if self.plan_mode:
+                self.print_plan(prepared, ms_o365_version_previous, ms_o365_version_latest)
+                return
+
+            ## Submit all planned object changes through one tmsh session (staged mode: the shadow data groups)
+            start = time.time()
+            results = [x for x in prepared if not x["ok"]] + self.executor.submit()
+            failed = [x for x in results if not x["ok"]]
+            self.add_timing("apply", start)
+            if self.switch is not None:
+                switch_start = time.time()
+                if not failed:
+                    results += self.switch_staged()
+                    failed = [x for x in results if not x["ok"]]
+                self.switch = None
+                self.staged = {}
+                self.add_timing("switch", switch_start)
+
+            ## Per-object apply time, where commands were applied one at a time (a transaction applies them together).
+            ## Objects that failed preparation have no command, their time is the generate time.
+            for result in results:
+                if "seconds" in result and "command" in result and self.executor.object_name(result["command"]) != "":
+                    seconds = self.object_seconds.setdefault(self.executor.object_name(result["command"]), {})
+                    seconds["apply"] = seconds.get("apply", 0) + result["seconds"]
+            self.commit_manifests(not failed)
+            if failed:
+                ## The previous version is restored (update_o365) so the next run retries this update
+                present = datetime.datetime.now()
+                self.log(1, self.log_level, self.logdir, "ERROR: " + str(len(failed)) + " of " + str(len(results)) + " tmsh commands failed (1045). The update will be retried on the next run.")
+                self.event_log(1, "ERROR: " + str(len(failed)) + " of " + str(len(results)) + " tmsh commands failed (1045). The update will be retried on the next run.")
+                self.addLastRun(present.strftime("%Y-%m-%d %H:%M"), "ERROR: " + str(len(failed)) + " of " + str(len(results)) + " tmsh commands failed (1045): " + failed[0]["output"])
+                sys.stderr.write("ERROR: " + str(len(failed)) + " of " + str(len(results)) + " tmsh commands failed (1045): " + failed[0]["output"] + "\n")
+                sys.exit(1)
 
+            ## Measured apply cost, used to calibrate the --plan estimate
+            if results:
+                self.record_apply_cost(len(results), sum([x["load"] for x in self.planned.values()]), time.time() - start)
 
-            # -----------------------------------------------------------------------
-            # Re-process URLs/IPs to remove duplicates and excluded values
-            # -----------------------------------------------------------------------
-            if self.output_url_categories or self.output_url_datagroups:
-                # Remove duplicate URLs in the list (full list) and remove set of excluded URLs from the list of collected URLs
+            ## Persist the applied record set as the base for the next incremental update
+            self.save_records(ms_o365_version_latest, records)
+            self.save_search_index(outputs, ms_o365_version_latest)
 
-                # Full list
-                if self.o365_categories_all:
-                    urls_undup = list(set(list_urls_to_bypass))
-                    for x_url in self.excluded_urls:
-                        urls_undup = [x for x in urls_undup if not x.endswith(x_url)]
+            if self.force_update:
+                forcebool = "True"
+            else:
+                forcebool = "False"
 
-                # Optimized list
-                if self.o365_categories_optimize:
-                    urls_optimized_undup = list(set(list_optimized_urls_to_bypass))
-                    for x_url in self.excluded_urls:
-                        urls_optimized_undup = [x for x in urls_optimized_undup if not x.endswith(x_url)]
+            present = datetime.datetime.now()
+            self.log(1, self.log_level, self.logdir, "Completed O365 URL/IP address update process (force update: " + forcebool + "). Last run at: " + present.strftime("%Y-%m-%d %H:%M"))
+            self.addLastRun(present.strftime("%Y-%m-%d %H:%M"), "O365 URLs are updated successfully.", not isHashedValuesSame, updatedHashedValues)
+            self.run_result = "updated"
+            print("[force-success]O365 URLs/IP Addresses are updated successfully.")
 
-                # Default list
-                if self.o365_categories_default:
-                    urls_default_undup = list(set(list_default_urls_to_bypass))
-                    for x_url in self.excluded_urls:
-                        urls_default_undup = [x for x in urls_default_undup if not x.endswith(x_url)]
 
-                # Allow list
-                if self.o365_categories_allow:
-                    urls_allow_undup = list(set(list_allow_urls_to_bypass))
-                    for x_url in self.excluded_urls:
-                        urls_allow_undup = [x for x in urls_allow_undup if not x.endswith(x_url)]
+    ##-----------------------------------------------------------------------
+    ## Rollback function
+    ##  Purpose: switch back to the previously applied generation in one transaction - data groups are
+    ##  relinked to their other staged generation (_blue/_green), URL categories are restored from the
+    ##  previous manifest. The applied state is cleared so the next update is a full update.
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def rollback(self):
+        self.get_config()
+        self.executor = self.create_executor()
+        self.executor.load_inventory()
+
+        for dg_name in (o365_dg, o365_dg_optimize, o365_dg_default, o365_dg_allow, o365_dg_ipv4, o365_dg_ipv6):
+            current = self.executor.external_file_name(dg_name)
+            for generation, previous in (("_blue", "_green"), ("_green", "_blue")):
+                if current == "o365_update.app/" + dg_name + generation and self.executor.exists("sys file data-group o365_update.app/" + dg_name + previous):
+                    self.executor.add("modify /ltm data-group external o365_update.app/" + dg_name + " external-file-name o365_update.app/" + dg_name + previous)
+                    print("..Data group " + dg_name + " switched back to " + dg_name + previous)
+
+        for category_name in (o365_category, o365_category_optimized, o365_category_default, o365_category_allow):
+            current = self.load_manifest(category_name)
+            previous = self.load_manifest(category_name + ".previous")
+            if current is None or previous is None:
+                continue
+            added = sorted([x for x in previous if x not in current])
+            removed = sorted([x for x in current if x not in previous])
+            if added or removed:
+                self.url_category_commands(category_name, previous, added, removed)
+                print("..URL category " + category_name.replace("\\", "") + " restored (" + str(len(added)) + " added, " + str(len(removed)) + " removed)")
+
+        if not self.executor.commands:
+            print("[info] Nothing to roll back. Only the last applied generation is available.\n")
+            return
+
+        results = self.executor.submit(True, False)
+        failed = [x for x in results if not x["ok"]]
+        if failed:
+            self.log(1, self.log_level, self.logdir, "ERROR: Rollback failed, no changes applied: " + failed[0]["output"])
+            sys.stderr.write("ERROR: Rollback failed, no changes applied: " + failed[0]["output"] + "\n")
+            sys.exit(1)
+
+        ## The previous generation is now the applied one
+        for category_name in (o365_category, o365_category_optimized, o365_category_default, o365_category_allow):
+            manifest_file = self.work_directory + "/manifests/" + category_name.replace("\\", "")
+            if os.path.isfile(manifest_file + ".json") and os.path.isfile(manifest_file + ".previous.json"):
+                os.rename(manifest_file + ".json", manifest_file + ".rollback.json")
+                os.rename(manifest_file + ".previous.json", manifest_file + ".json")
+                os.rename(manifest_file + ".rollback.json", manifest_file + ".previous.json")
+        if os.path.isfile(self.work_directory + "/o365_applied.json"):
+            os.remove(self.work_directory + "/o365_applied.json")
+
+        self.log(1, self.log_level, self.logdir, "Rolled back " + str(len(results)) + " objects to the previously applied generation.")
+        print("[success-info] ..Rollback complete. Use --force to apply the latest O365 version again.\n")
 
 
-            if self.output_ip_datagroups:
-                # Remove duplicate IPv4 addresses in the list
-                ipv4_undup = list(set(list_ipv4_to_pbr))
+    ##-----------------------------------------------------------------------
+    ## Plan function
+    ##  Purpose: dry run - fetch (or read the cached snapshot), classify and filter as an update would,
+    ##  then print the planned object operations and an apply cost estimate without changing the BIG-IP
+    ##  or the local state
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def plan(self):
+        self.plan_mode = True
+        self.run_update()
 
-                ## Remove set of excluded IPv4 addresses from the list of collected IPv4 addresses
-                for x_ip in self.excluded_ips:
-                    ipv4_undup = [x for x in ipv4_undup if not x.endswith(x_ip)]
 
-                # Remove duplicate IPv6 addresses in the list
-                ipv6_undup = list(set(list_ipv6_to_pbr))
+    ##-----------------------------------------------------------------------
+    ## Print plan function
+    ##  Purpose: print the queued commands, entry counts and deltas per object, and the estimated apply
+    ##  cost, then discard the queued commands and their files
+    ##  Parameters:
+    ##      prepared        = output task results (see run_parallel)
+    ##      version_previous= applied version string
+    ##      version_latest  = latest version string
+    ##-----------------------------------------------------------------------
+    def print_plan(self, prepared, version_previous, version_latest):
+        commands = list(self.executor.commands)
+        if self.switch is not None:
+            ## Staged mode - the switch transaction (the links assume the staged copies verify)
+            commands += self.switch.commands
+            for url_file in sorted(self.staged):
+                staged = self.staged[url_file]
+                commands.append(("modify" if staged["linked"] else "create") + " /ltm data-group external o365_update.app/" + url_file + " external-file-name o365_update.app/" + staged["shadow"])
+
+        print("\nPlan: O365 version " + version_previous + " -> " + version_latest + " (instance: " + self.customer_endpoint + ", backend: " + self.executor.__class__.__name__ + ", apply mode: " + self.apply_mode + ")\n")
+        for task in prepared:
+            if not task["ok"]:
+                print("  ERROR preparing " + task["object"].replace("\\", "") + ": " + task["output"])
+
+        print("Operations:")
+        for command in commands:
+            tokens = self.executor.tokenize(command)
+            for module in rest_modules:
+                if " ".join(tokens[1:len(module.split()) + 1]).lstrip("/") == module:
+                    break
+            name = tokens[len(module.split()) + 1]
+            detail = ""
+            if "urls" in tokens:
+                i = tokens.index("urls")
+                detail = tokens[i + 1] + " " + str(len(self.executor.parse_block(tokens, i + 2)[0])) + " entries"
+            elif "source-path" in tokens:
+                detail = "load " + tokens[tokens.index("source-path") + 1].replace("file:", "")
+            elif "external-file-name" in tokens:
+                detail = "link to " + tokens[tokens.index("external-file-name") + 1]
+            print("  %-7s %-24s %-45s %s" % (tokens[0], module, name, detail))
+        if not commands:
+            print("  (none)")
+
+        print("\nObjects:")
+        for name in sorted(self.planned):
+            planned = self.planned[name]
+            added = "?" if planned["added"] is None else str(planned["added"])
+            removed = "?" if planned["removed"] is None else str(planned["removed"])
+            print("  %-45s entries %7d   added %7s   removed %7s" % (name, planned["entries"], added, removed))
+
+        load = sum([x["load"] for x in self.planned.values()])
+        estimate, runs = self.estimate_apply_cost(len(commands), load)
+        print("\nTotal: " + str(len(commands)) + " commands, " + str(load) + " entries to load.")
+        if runs:
+            print("Estimated apply cost: %.1f seconds (calibrated from %d previous runs)\n" % (estimate, runs))
+        else:
+            print("Estimated apply cost: %.1f seconds (default model, no previous runs measured)\n" % estimate)
 
-                ## Remove set of excluded IPv6 addresses from the list of collected IPv6 addresses
-                for x_ip in self.excluded_ips:
-                    ipv6_undup = [x for x in ipv6_undup if not x.endswith(x_ip)]
+        ## Nothing is submitted
+        for cleanup_file in self.executor.cleanup:
+            try:
+                os.remove(cleanup_file)
+            except:
+                pass
+        self.executor.commands = []
+        self.executor.cleanup = []
+        self.manifests_pending = {}
+        self.staged = {}
+        self.switch = None
 
-            if not self.o365_categories_all:
-                urls_undup = []
 
-            if not self.output_ip_datagroups:
-                ipv4_undup = []
-                ipv6_undup = []
+    ##-----------------------------------------------------------------------
+    ## Estimate apply cost function
+    ##  Purpose: estimate the seconds to apply a plan - the default cost model, scaled by the ratio of
+    ##  measured to modeled cost of previous runs
+    ##  Parameters:
+    ##      commands        = number of commands
+    ##      load            = number of entries to load (URL category changes, data group entries)
+    ##  Returns: (estimated seconds, number of previous runs used)
+    ##-----------------------------------------------------------------------
+    def estimate_apply_cost(self, commands, load):
+        estimate = plan_cost_submit + commands * plan_cost_command + load * plan_cost_entry
+        history = self.read_apply_costs()
+        modeled = sum([plan_cost_submit + x["commands"] * plan_cost_command + x["load"] * plan_cost_entry for x in history])
+        if history and modeled > 0:
+            estimate = estimate * sum([x["seconds"] for x in history]) / modeled
 
-            self.log(1, self.log_level, self.logdir, "Number of unique ENDPOINTS to import : URL:" + str(len(urls_undup)) + ", IPv4 host/net:" + str(len(ipv4_undup)) + ", IPv6 host/net:" + str(len(ipv6_undup)))
+        return estimate, len(history)
 
 
-            # -----------------------------------------------------------------------
-            # O365 endpoint URLs re-formatted to fit into custom URL categories and/or data groups
-            # -----------------------------------------------------------------------
-            # This generates the temp files, data groups, and URL categories
-            if self.output_url_categories or self.output_url_datagroups:
+    ##-----------------------------------------------------------------------
+    ## Read apply costs function
+    ##  Purpose: return the measured apply cost of previous runs ([{"commands", "load", "seconds"}])
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def read_apply_costs(self):
+        try:
+            f = open(self.work_directory + "/o365_apply_cost.json", "r")
+            history = json.loads(f.read())
+            f.close()
+            return history
+        except:
+            return []
+
+
+    ##-----------------------------------------------------------------------
+    ## Record apply cost function
+    ##  Purpose: keep the measured apply cost of the last 20 runs
+    ##  Parameters:
+    ##      commands        = number of commands submitted
+    ##      load            = number of entries loaded
+    ##      seconds         = submit time
+    ##-----------------------------------------------------------------------
+    def record_apply_cost(self, commands, load, seconds):
+        history = self.read_apply_costs()[-19:] + [{"commands": commands, "load": load, "seconds": round(seconds, 3)}]
+        f = open(self.work_directory + "/o365_apply_cost.json", "w")
+        f.write(json.dumps(history))
+        f.flush()
+        f.close()
+
 
-                if self.output_url_categories:
-                    if self.o365_categories_all:
-                        self.create_url_categories (o365_category, urls_undup, ms_o365_version_latest)
+    ##-----------------------------------------------------------------------
+    ## Latest version function
+    ##  Purpose: return the latest version of the configured instance from a version web method response
+    ##  Parameters:
+    ##      dict_o365_version   = parsed version web method response
+    ##  Returns: version string, or "" if the instance isn't listed
+    ##-----------------------------------------------------------------------
+    def latest_version(self, dict_o365_version):
+        ms_o365_version_latest = ""
+        for record in dict_o365_version:
+            if 'instance' in record :
+                if record["instance"] == self.customer_endpoint and "latest" in record:
+                    latest = record["latest"]
+                    if re.match('[0-9]{10}', latest):
+                        ms_o365_version_latest = latest
 
-                    if self.o365_categories_optimize:
-                        self.create_url_categories (o365_category_optimized, urls_optimized_undup, ms_o365_version_latest)
+        return ms_o365_version_latest
 
-                    if self.o365_categories_default:
-                        self.create_url_categories (o365_category_default, urls_default_undup, ms_o365_version_latest)
 
-                    if self.o365_categories_allow:
-                        self.create_url_categories (o365_category_allow, urls_allow_undup, ms_o365_version_latest)
+    ##-----------------------------------------------------------------------
+    ## Applied config hash function
+    ##  Purpose: return the configuration hash of the last applied state (assumes config is loaded)
+    ##  Parameters: none
+    ##  Returns: hash string, or None if there is no applied state for this instance
+    ##-----------------------------------------------------------------------
+    def applied_config_hash(self):
+        try:
+            f = open(self.work_directory + "/o365_applied.json", "r")
+            applied = json.loads(f.read())
+            f.close()
+        except:
+            return None
 
-                if self.output_url_datagroups:
-                    if self.o365_categories_all:
-                        self.create_url_datagroups (o365_dg, urls_undup)
+        if applied.get("instance") != self.customer_endpoint:
+            return None
 
-                    if self.o365_categories_optimize:
-                        self.create_url_datagroups (o365_dg_optimize, urls_optimized_undup)
+        return applied.get("config_hash")
 
-                    if self.o365_categories_default:
-                        self.create_url_datagroups (o365_dg_default, urls_default_undup)
 
-                    if self.o365_categories_allow:
-                        self.create_url_datagroups (o365_dg_allow, urls_allow_undup)
+    ##-----------------------------------------------------------------------
+    ## Daemon function
+    ##  Purpose: long-running mode. Runs an update, then polls only the version web method every
+    ##  poll_interval seconds and runs the full update again when the latest version or the
+    ##  configuration changes. Proxy, CA bundle and GUID stay in memory between updates.
+    ##  Parameters: none
+    ##-----------------------------------------------------------------------
+    def daemon(self):
+        self.trigger = "daemon"
+        self.get_config()
+        self.log(1, self.log_level, self.logdir, "Daemon mode started. Checking VERSION every " + str(self.poll_interval) + " seconds.")
+
+        run = True
+        while True:
+            if run:
+                ## Per-run state - the exclusion trie/tree and pending changes are rebuilt for every update
+                self.excluded_url_trie = None
+                self.excluded_ip_tree = None
+                self.manifests_pending = {}
+                try:
+                    self.update_o365()
+                except SystemExit:
+                    pass
+                except Exception as e:
+                    self.log(1, self.log_level, self.logdir, "Daemon: update failed: " + str(e))
+                config_hash = self.get_outputs_hash()
+                ca_bundle = self.ca_bundle
+
+            self.logger.flush()
+            self.syslog.flush()
+            time.sleep(self.poll_interval)
+            run = False
+
+            ## Configuration changes (the loader only re-reads the iFile when a new revision exists)
+            self.get_config()
+            if self.get_outputs_hash() != config_hash or self.ca_bundle != ca_bundle:
+                self.log(1, self.log_level, self.logdir, "Daemon: configuration changed. Starting update.")
+                self.guid = None
+                run = True
+                continue
 
-            if self.output_ip_datagroups:
-                self.create_ip_datagroups (o365_dg_ipv4, ipv4_undup)
-                self.create_ip_datagroups (o365_dg_ipv6, ipv6_undup)
+            ## Version check
+            latest = self.poll_version()
+            self.commit_status()
+            if latest is None or latest == "":
+                continue
 
-            if self.force_update:
-                forcebool = "True"
+            ## No version file yet (ex. the first update stopped before start_date/start_time) - update due
+            current = ""
+            if os.path.isfile(self.work_directory + "/o365_version.txt"):
+                f = open(self.work_directory + "/o365_version.txt", "r")
+                current = f.readline()
+                f.close()
+            if latest != current:
+                self.log(1, self.log_level, self.logdir, "Daemon: VERSION changed from " + current + " to " + latest + ". Starting update.")
+                run = True
             else:
-                forcebool = "False"
+                self.log(2, self.log_level, self.logdir, "Daemon: VERSION " + latest + " unchanged.")
 
-            present = datetime.datetime.now()
-            self.log(1, self.log_level, self.logdir, "Completed O365 URL/IP address update process (force update: " + forcebool + "). Last run at: " + present.strftime("%Y-%m-%d %H:%M"))
-            self.addLastRun(present.strftime("%Y-%m-%d %H:%M"), "O365 URLs are updated successfully.", not isHashedValuesSame, updatedHashedValues)
-            print("[force-success]O365 URLs/IP Addresses are updated successfully.")
+
+    ##-----------------------------------------------------------------------
+    ## Poll version function
+    ##  Purpose: request the latest version of the configured instance (single attempt, never aborts)
+    ##  Parameters: none
+    ##  Returns: version string, or None if the request failed
+    ##-----------------------------------------------------------------------
+    def poll_version(self):
+        guid = self.prepare_environment()
+        req_string = "https://" + url_ms_o365_version + uri_ms_o365_version + guid
+        res = self.url_fetch(req_string, False, False)
+        if res is None:
+            return None
+
+        try:
+            return self.latest_version(json.loads(res.read()))
+        except Exception as e:
+            self.log(1, self.log_level, self.logdir, "Daemon: invalid (non-JSON) VERSION response: " + str(e))
+            return None
 
 
     ##-----------------------------------------------------------------------
@@ -1860,18 +5240,20 @@ class o365UrlManagement:
         print("\n..Uninstall in progress")
 
         # Delete the configuration iFile
-        result = shell.getoutput("tmsh -a delete sys file ifile o365_update.app/o365_config.json")
+        self.executor.add("delete sys file ifile o365_update.app/o365_config.json")
+        self.executor.submit(False)
         print("..Configuration iFile deleted")
         # Get a list of all the file paths that ends with .txt from in specified directory
-        fileList = os.listdir('/config/filestore/files_d/Common_d/ifile_d/')
+        fileList = os.listdir(ifile_directory)
         pattern = "*o365_config.json*"
         # Iterate over the list of filepaths & remove each file.
         for entry in fileList:
             if fnmatch.fnmatch(entry, pattern):
                 try:
-                    os.remove('/config/filestore/files_d/Common_d/ifile_d/' + entry)
+                    os.remove(ifile_directory + entry)
                 except:
                     print("Error while deleting file : ", filePath)
+        self.config_loader.invalidate()
         # Delete working directory files
         try:
             os.remove(self.work_directory + "/guid.txt")
@@ -1882,6 +5264,21 @@ class o365UrlManagement:
             os.remove(self.work_directory + "/o365_version.txt")
         except:
             pass
+
+        try:
+            os.remove(self.work_directory + "/o365_applied.json")
+        except:
+            pass
+
+        try:
+            os.remove(self.work_directory + "/o365_search_index.json.gz")
+        except:
+            pass
+
+        try:
+            os.remove(self.work_directory + "/o365_status.json")
+        except:
+            pass
         print("..Configuration scratch files deleted")
 
         # Delete the cron config
@@ -1896,32 +5293,45 @@ class o365UrlManagement:
             # Use this option to completely remove all working directories, data groups, and URL categories
 
             # Delete ltm data group objects
-            result = shell.getoutput("tmsh -a delete ltm data-group external o365_update.app/Office_365_Managed_All")
-            result = shell.getoutput("tmsh -a delete ltm data-group external o365_update.app/Office_365_Managed_Allow")
-            result = shell.getoutput("tmsh -a delete ltm data-group external o365_update.app/Office_365_Managed_IPv4")
-            result = shell.getoutput("tmsh -a delete ltm data-group external o365_update.app/Office_365_Managed_IPv6")
-            result = shell.getoutput("tmsh -a delete ltm data-group external o365_update.app/Office_365_Managed_Default")
-            result = shell.getoutput("tmsh -a delete ltm data-group external o365_update.app/Office_365_Managed_Optimized")
+            self.executor.add("delete ltm data-group external o365_update.app/Office_365_Managed_All")
+            self.executor.add("delete ltm data-group external o365_update.app/Office_365_Managed_Allow")
+            self.executor.add("delete ltm data-group external o365_update.app/Office_365_Managed_IPv4")
+            self.executor.add("delete ltm data-group external o365_update.app/Office_365_Managed_IPv6")
+            self.executor.add("delete ltm data-group external o365_update.app/Office_365_Managed_Default")
+            self.executor.add("delete ltm data-group external o365_update.app/Office_365_Managed_Optimized")
             print("..LTM data-group objects deleted")
 
             # Delete sys data group objects
-            result = shell.getoutput("tmsh -a delete sys file data-group o365_update.app/Office_365_Managed_All")
-            result = shell.getoutput("tmsh -a delete sys file data-group o365_update.app/Office_365_Managed_Allow")
-            result = shell.getoutput("tmsh -a delete sys file data-group o365_update.app/Office_365_Managed_Default")
-            result = shell.getoutput("tmsh -a delete sys file data-group o365_update.app/Office_365_Managed_IPv4")
-            result = shell.getoutput("tmsh -a delete sys file data-group o365_update.app/Office_365_Managed_IPv6")
+            self.executor.add("delete sys file data-group o365_update.app/Office_365_Managed_All")
+            self.executor.add("delete sys file data-group o365_update.app/Office_365_Managed_Allow")
+            self.executor.add("delete sys file data-group o365_update.app/Office_365_Managed_Default")
+            self.executor.add("delete sys file data-group o365_update.app/Office_365_Managed_IPv4")
+            self.executor.add("delete sys file data-group o365_update.app/Office_365_Managed_IPv6")
+
+            # Delete the staged apply generations
+            self.executor.load_inventory()
+            for dg_name in (o365_dg, o365_dg_optimize, o365_dg_default, o365_dg_allow, o365_dg_ipv4, o365_dg_ipv6):
+                for generation in ("_blue", "_green"):
+                    if self.executor.exists("sys file data-group o365_update.app/" + dg_name + generation):
+                        self.executor.add("delete sys file data-group o365_update.app/" + dg_name + generation)
             print("..System data-group objects deleted")
 
             # Delete URL categories
-            result = shell.getoutput("tmsh -a delete sys url-db url-category o365_update.app/Office_365_All\(Managed\)")
-            result = shell.getoutput("tmsh -a delete sys url-db url-category o365_update.app/Office_365_Allow\(Managed\)")
-            result = shell.getoutput("tmsh -a delete sys url-db url-category o365_update.app/Office_365_Default\(Managed\)")
-            result = shell.getoutput("tmsh -a delete sys url-db url-category o365_update.app/Office_365_Optimized\(Managed\)")
+            self.executor.add("delete sys url-db url-category o365_update.app/Office_365_All\(Managed\)")
+            self.executor.add("delete sys url-db url-category o365_update.app/Office_365_Allow\(Managed\)")
+            self.executor.add("delete sys url-db url-category o365_update.app/Office_365_Default\(Managed\)")
+            self.executor.add("delete sys url-db url-category o365_update.app/Office_365_Optimized\(Managed\)")
             print("..URL categories deleted")
 
             # Delete the application service
-            result = shell.getoutput("tmsh -a delete sys application service o365_update.app/o365_update")
+            self.executor.add("delete sys application service o365_update.app/o365_update")
+            self.executor.submit(False)
             print("..Application service deleted")
+
+            # Delete URL category manifests (the categories no longer exist)
+            if os.path.isdir(self.work_directory + "/manifests"):
+                for entry in os.listdir(self.work_directory + "/manifests"):
+                    os.remove(self.work_directory + "/manifests/" + entry)
             print("If the Office365 configuration is deleted from the command line using the full_uninstall feature of the Python script and created again, the URL Category IDs will change. Therefore, if the SSL Orchestrator security policy uses any of these categories, the policy will need to be redeployed.")
             print("[success-info] ..Full uninstall complete. All unassigned data groups and URL categories have also been deleted.\n\n")
 
@@ -1946,13 +5356,25 @@ def main():
     group.add_argument("--full_uninstall", action='store_const', const='none', help = "Unintall the script. Remove everything.")
     #group.add_argument("--force", action='store_const', const='none', help = "Force an update.")
     group.add_argument("--printconfig", action='store_const', const='none', help = "Show the running configuration.")
-    group.add_argument("--search", help = "Search the Office365 URL categories.")
+    group.add_argument("--search", help = "Search the Office365 URL categories (URL) or IP data groups (IP address).")
+    group.add_argument("--daemon", action='store_const', const='none', help = "Run continuously, checking the O365 VERSION every poll_interval seconds.")
+    group.add_argument("--rollback", action='store_const', const='none', help = "Switch back to the previously applied data groups and URL categories.")
+    group.add_argument("--plan", action='store_const', const='none', help = "Show the changes an update would make and the estimated apply cost.")
+    group.add_argument("--searchfile", help = "Search the Office365 URL categories/IP data groups for every URL/hostname/IP in a file (- for stdin).")
+    group.add_argument("--history", nargs = "?", type = int, const = 20, help = "Show the last N (default 20) runs of the run history and their trends.")
 
     # Add mutually-exclusive config/configfile options
     group1 = parser.add_mutually_exclusive_group()
     group1.add_argument("--config", help = "Used with --install. Provide alternate JSON configuration information from a serialized JSON string object.")
     group1.add_argument("--configfile", help = "used with --install. Provide alternate JSON configuration information from a JSON file.")
 
+    # Add search/history output format option
+    parser.add_argument("--format", choices = ["table", "csv", "json"], help = "Used with --searchfile (csv or json, default csv) or --history (default table). Output format.")
+
+    # Add profiling options
+    parser.add_argument("--profile", nargs = "?", type = int, const = 30, help = "Profile the run. Writes the profile and a summary of the top (default 30) functions to the log directory.")
+    parser.add_argument("--profile_memory", action='store_const', const='none', help = "Used with --profile. Also capture peak memory and top allocations.")
+
     # Parse arguments
     args = parser.parse_args()
 
@@ -1968,29 +5390,63 @@ def main():
     if args.configfile:
         o365.json_config_file = str(args.configfile)
 
+    # --format argument - table is only supported by --history
+    if args.searchfile and args.format == "table":
+        sys.stderr.write("ERROR: --searchfile output format must be csv or json.\n")
+        sys.exit(1)
+
     # --force argument
     if args.force:
         o365.force_update = True
 
-    if args.search:
-        o365.search(args.search)
-
-    # --install/--uninstall arguments
-    if args.install:
-        o365.script_install()
-    elif args.uninstall:
-        o365.script_uninstall("none")
-    elif args.full_uninstall:
-        o365.script_uninstall('full')
-    elif args.config:
-        o365.show_help()
-    elif args.printconfig:
-        o365.print_config()
-    elif args.search:
-        o365.search()
+    # Run trigger recorded in the run history (--daemon sets its own). Cron runs have no terminal.
+    if args.force:
+        o365.trigger = "force"
+    elif sys.stdin.isatty():
+        o365.trigger = "manual"
+
+    def dispatch():
+        if args.search:
+            o365.search(args.search)
+
+        if args.searchfile:
+            o365.bulk_search(args.searchfile, args.format or "csv")
+
+        if args.history is not None:
+            o365.print_history(args.history, args.format or "table")
+
+        # --install/--uninstall arguments
+        if args.install:
+            o365.script_install()
+        elif args.uninstall:
+            o365.script_uninstall("none")
+        elif args.full_uninstall:
+            o365.script_uninstall('full')
+        elif args.config:
+            o365.show_help()
+        elif args.printconfig:
+            o365.print_config()
+        elif args.daemon:
+            o365.daemon()
+        elif args.rollback:
+            o365.rollback()
+        elif args.plan:
+            o365.plan()
+        elif args.search:
+            o365.search()
+        else:
+            # No argument - run utility
+            o365.update_o365()
+
+    # --profile argument - run name from the selected option
+    if args.profile is not None:
+        name = "update"
+        for option in ("install", "uninstall", "full_uninstall", "printconfig", "search", "searchfile", "daemon", "rollback", "plan", "history"):
+            if getattr(args, option) is not None:
+                name = option
+        o365.profiled(name, dispatch, args.profile, args.profile_memory is not None)
     else:
-        # No argument - run utility
-        o365.update_o365()
+        dispatch()
 
 
 if __name__ == '__main__':